@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import click
+import shutil
+import platform
+import itertools
+
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from ooi_hyd_tools.synthetic import write_synthetic_day, FILES_PER_DAY
+from ooi_hyd_tools.archive_server import ArchiveServer
+
+"""
+End-to-end throughput of the audio stage against a local stand-in of the raw data archive.
+Synthetic days are served by archive_server with the given latency, bandwidth and error rate,
+and acoustic_flow_oneday is run over them with every runner and concurrency setting asked
+for. Wall time, files/s, days/hour, failed days and the server's request counters of each
+setting are written to benchmarks/results/load_<label>.json. The prefect runner dispatches
+to cloud workers that cannot reach a local server, so only local and parallel are covered.
+
+    python benchmarks/load_test.py --days 2 --files 24 --latency-ms 80 --bandwidth-mbps 200
+    python benchmarks/load_test.py --runner local --runner parallel --concurrency 2 --concurrency 8
+"""
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = REPO_DIR / "benchmarks" / "results"
+WORK_DIR = REPO_DIR / "benchmarks" / "work" / "load"
+HYD_REFDES = "CE04OSBP-LJ01C-11-HYDBBA105"
+START_DATE = datetime(2000, 1, 1)  # before any OOI deployment, never collides with real data
+
+
+def run_setting(pipeline, runner_name, concurrency, options, dates, base_url, work_dir):
+    """run every date through one runner, returns (wall seconds, {date: error})"""
+    name = f"{runner_name}_{concurrency}"
+    for products in ["data", "output"]:
+        shutil.rmtree(work_dir / products, ignore_errors=True)  # left by the last setting
+
+    if runner_name == "parallel":
+        runner = pipeline.ParallelLocalRunner(
+            options["max_workers"], ledger=str(work_dir / "ledger" / f"{name}.jsonl")
+        )
+    else:
+        runner = pipeline.LocalRunner()
+
+    failed = {}
+    t0 = time.perf_counter()
+    for date in dates:
+        params = pipeline.build_params(
+            date=date,
+            hyd_refdes=HYD_REFDES,
+            format="PCM_24",
+            normalize_traces=False,
+            fudge_factor=0.02,
+            write_wav=False,
+            apply_cals=False,
+            freq_lims=(10, 30000),
+            s3_sync=False,
+            flag="audio",
+            obs_run_type=None,
+            streaming=options["streaming"],
+            max_in_flight=concurrency,
+            backend=options["backend"],
+            async_fetch=options["async_fetch"],
+            max_per_host=concurrency,
+            archive_url=base_url,
+        )
+        try:
+            runner.run(date, params)
+        except Exception as e:  # local runs raise, parallel ones fail in finish
+            failed[params["date"]] = f"{type(e).__name__}: {e}"
+    runner.finish()
+    if runner_name == "parallel":
+        failed.update(runner.failed)
+    return time.perf_counter() - t0, failed
+
+
+@click.command()
+@click.option("--days", type=int, default=1, show_default=True, help="Days of the backfill.")
+@click.option(
+    "--files",
+    type=int,
+    default=FILES_PER_DAY,
+    show_default=True,
+    help="Files per synthetic day, 288 is a full day.",
+)
+@click.option(
+    "--addendum",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Files of each day served from addendum/.",
+)
+@click.option(
+    "--runner",
+    "runners",
+    type=click.Choice(["local", "parallel"]),
+    multiple=True,
+    default=["local"],
+    show_default=True,
+    help="Runners to test, repeatable.",
+)
+@click.option(
+    "--concurrency",
+    type=int,
+    multiple=True,
+    default=[4],
+    show_default=True,
+    help="--max-in-flight and --max-per-host of a setting, repeatable.",
+)
+@click.option("--max-workers", type=int, default=None, help="Days run at once by parallel.")
+@click.option("--streaming", is_flag=True, help="Run the audio stage with --streaming.")
+@click.option("--async-fetch", is_flag=True, help="Run the audio stage with --async-fetch.")
+@click.option(
+    "--backend",
+    type=click.Choice(["thread", "process"]),
+    default="thread",
+    show_default=True,
+)
+@click.option("--latency-ms", type=float, default=50.0, show_default=True)
+@click.option("--jitter-ms", type=float, default=20.0, show_default=True)
+@click.option(
+    "--bandwidth-mbps",
+    type=float,
+    default=None,
+    help="Shared link bandwidth, unlimited by default.",
+)
+@click.option(
+    "--conn-bandwidth-mbps", type=float, default=None, help="Bandwidth of each connection."
+)
+@click.option(
+    "--error-rate",
+    type=float,
+    default=0.0,
+    show_default=True,
+    help="Share of file requests answered with 503.",
+)
+@click.option(
+    "--listing-error-rate",
+    type=float,
+    default=0.0,
+    show_default=True,
+    help="Share of directory listings answered with 503.",
+)
+@click.option(
+    "--label",
+    type=str,
+    default=None,
+    help="Name of the results file, defaults to host and time.",
+)
+@click.option(
+    "--work-dir",
+    type=click.Path(),
+    default=str(WORK_DIR),
+    show_default=True,
+    help="Where the synthetic archive and products are written.",
+)
+def load_test(
+    days,
+    files,
+    addendum,
+    runners,
+    concurrency,
+    max_workers,
+    streaming,
+    async_fetch,
+    backend,
+    latency_ms,
+    jitter_ms,
+    bandwidth_mbps,
+    conn_bandwidth_mbps,
+    error_rate,
+    listing_error_rate,
+    label,
+    work_dir,
+):
+    # pipeline reads its config relative to the repo at import
+    os.chdir(REPO_DIR)
+    from ooi_hyd_tools import pipeline
+
+    work_dir = Path(work_dir).resolve()
+    archive_dir = work_dir / "archive" / f"{files}_{addendum}"  # one archive per layout
+    dates = [START_DATE + timedelta(days=n) for n in range(days)]
+    t0 = time.perf_counter()
+    for date in dates:
+        write_synthetic_day(
+            archive_dir,
+            HYD_REFDES,
+            date.strftime("%Y/%m/%d"),
+            n_files=files,
+            addendum=addendum,
+            gap_every=24,
+            short_every=48,
+        )
+    print(f"Synthetic archive of {days} days ready in {time.perf_counter() - t0:.0f} s")
+    shutil.rmtree(work_dir / "ledger", ignore_errors=True)
+    os.chdir(work_dir)
+
+    network = {
+        "latency_s": latency_ms / 1000,
+        "jitter_s": jitter_ms / 1000,
+        "bandwidth_mbps": bandwidth_mbps,
+        "conn_bandwidth_mbps": conn_bandwidth_mbps,
+        "error_rate": error_rate,
+        "listing_error_rate": listing_error_rate,
+    }
+    options = {
+        "streaming": streaming,
+        "async_fetch": async_fetch,
+        "backend": backend,
+        "max_workers": max_workers,
+    }
+    settings = []
+    for runner_name, n in itertools.product(runners, concurrency):
+        # a fresh server per setting, so its counters and the shared link are its own
+        with ArchiveServer(archive_dir, seed=0, **network) as server:
+            wall_s, failed = run_setting(
+                pipeline, runner_name, n, options, dates, server.base_url, work_dir
+            )
+            stats = server.stats()
+        days_ok = days - len(failed)
+        settings.append(
+            {
+                "runner": runner_name,
+                "concurrency": n,
+                "wall_s": round(wall_s, 2),
+                "files_per_s": round(days_ok * files / wall_s, 3),
+                "days_per_hour": round(days_ok / wall_s * 3600, 2),
+                "failed_days": failed,
+                "server": stats,
+            }
+        )
+        print(
+            f"{runner_name} x{n}: {wall_s:.0f} s, {settings[-1]['files_per_s']} files/s,"
+            f" {len(failed)} of {days} days failed"
+        )
+
+    report = {
+        "setup": {
+            "days": days,
+            "files": files,
+            "addendum": addendum,
+            **network,
+            **options,
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "settings": settings,
+    }
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    label = label or f"{platform.node()}_{time.strftime('%Y%m%dT%H%M%S')}"
+    results_path = RESULTS_DIR / f"load_{label}.json"
+    results_path.write_text(json.dumps(report, indent=2))
+
+    print("| runner | concurrency | wall s | files/s | days/hour | failed | requests | 503s |")
+    print("|---|---|---|---|---|---|---|---|")
+    for s in settings:
+        print(
+            f"| {s['runner']} | {s['concurrency']} | {s['wall_s']:.1f} | {s['files_per_s']}"
+            f" | {s['days_per_hour']} | {len(s['failed_days'])} | {s['server']['requests']}"
+            f" | {s['server']['errors']} |"
+        )
+    print(f"Results written to {results_path}")
+
+
+if __name__ == "__main__":
+    load_test()
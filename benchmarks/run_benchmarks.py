@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import click
+import shutil
+import hashlib
+import platform
+
+from pathlib import Path
+
+from ooi_hyd_tools import metrics
+from ooi_hyd_tools.synthetic import write_synthetic_day, FILES_PER_DAY
+from ooi_hyd_tools.mseed_to_audio import HydrophoneDay, _make_data_dirs, _write_segment
+from ooi_hyd_tools.audio_to_spec import gen_metadata, build_hmb_gen, process_hmb_date
+
+"""
+Benchmarks of the mseed -> audio -> spectrogram path on a synthetic day, no archive access
+needed. Each archive file goes through read (decode), merge, gap repair and FLAC encode, then
+the HMB product and its summary plot are made from the FLAC files as audio_to_spec does.
+Timings and peak RSS of every step are written as a metrics report to benchmarks/results,
+and compared against a baseline report when one is given.
+
+    python benchmarks/run_benchmarks.py --files 288 --label baseline
+    python benchmarks/run_benchmarks.py --files 288 --baseline benchmarks/results/baseline.json
+"""
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = REPO_DIR / "benchmarks" / "results"
+WORK_DIR = REPO_DIR / "benchmarks" / "work"
+HYD_REFDES = "CE04OSBP-LJ01C-11-HYDBBA105"
+DAY = "2000/01/01"  # before any OOI deployment, never collides with real products
+FREQ_LIMS = (10, 30000)
+TOLERANCE = 0.2  # a step 20% slower or larger than its baseline is a regression
+
+
+def timed(run, name, func, *args):
+    t0 = time.perf_counter()
+    with run.stage(name):
+        result = func(*args)
+    run.observe(f"{name}_s", time.perf_counter() - t0)
+    return result
+
+
+def bench_audio(run, hyd, format):
+    """read, merge, repair and encode every file, one file in memory at a time"""
+    flac_dir, _, wav_dir, _ = _make_data_dirs(hyd)
+    for url in hyd.mseed_urls:
+        data = timed(run, "fetch", hyd._fetch_mseed, url)
+        st = timed(run, "read", hyd._decode_mseed, data, format)
+        run.count("bytes_read", len(data))
+        del data
+
+        merge_st = st.copy()
+        merge_st.sort()
+        timed(run, "merge", hyd._merge_by_timestamps, merge_st)
+        del merge_st
+
+        cs, case = timed(run, "repair", hyd._repair_stream, st)
+        run.count(f"case_{case}")
+        if cs is not None:
+            timed(
+                run,
+                "encode_flac",
+                _write_segment,
+                cs,
+                HYD_REFDES,
+                format,
+                False,
+                False,
+                flac_dir,
+                wav_dir,
+            )
+        del st, cs
+
+
+def bench_hmb(run):
+    """HMB netcdf and summary plot of the day from its FLAC files"""
+    start_date = DAY.replace("/", "")
+    with run.stage("metadata"):
+        gen_metadata.fn(start_date, "flac", HYD_REFDES)
+    hmb_gen = build_hmb_gen(HYD_REFDES, FREQ_LIMS)
+    process_hmb_date(hmb_gen, start_date, HYD_REFDES, FREQ_LIMS)  # records hmb and plot
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    """steps slower or larger than the baseline by more than `tolerance`"""
+    for key in ["files", "format", "gap_every", "short_every"]:
+        if baseline.get("setup", {}).get(key) != report["setup"][key]:
+            print(f"Warning: baseline was run with {key}={baseline.get('setup', {}).get(key)}")
+    regressions = []
+    for name, entry in report["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            continue
+        for key in ["wall_s", "peak_rss_mb"]:
+            ratio = entry[key] / base[key] if base[key] > 0 else 1.0
+            flag = " <-- regression" if ratio > 1 + tolerance else ""
+            print(
+                f"{name:12s} {key:12s} {base[key]:10.1f} -> {entry[key]:10.1f}"
+                f" ({ratio:.2f}x){flag}"
+            )
+            if flag:
+                regressions.append((name, key, ratio))
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--files",
+    type=int,
+    default=FILES_PER_DAY,
+    show_default=True,
+    help="Files in the synthetic day, 288 is a full day.",
+)
+@click.option(
+    "--format",
+    type=str,
+    default="PCM_24",
+    show_default=True,
+    help="Audio subtype, as in the pipeline.",
+)
+@click.option(
+    "--jitter-s",
+    type=float,
+    default=1e-4,
+    show_default=True,
+    help="Timing jitter between traces.",
+)
+@click.option(
+    "--overlap-s",
+    type=float,
+    default=0.002,
+    show_default=True,
+    help="Overlap at every other trace boundary.",
+)
+@click.option(
+    "--gap-every",
+    type=int,
+    default=24,
+    show_default=True,
+    help="Every nth file has a large gap (CASE B), 0 for none.",
+)
+@click.option(
+    "--short-every",
+    type=int,
+    default=48,
+    show_default=True,
+    help="Every nth file is truncated (CASE C), 0 for none.",
+)
+@click.option("--skip-hmb", is_flag=True, help="Only benchmark the audio steps.")
+@click.option(
+    "--label",
+    type=str,
+    default=None,
+    help="Name of the results file, defaults to host and time.",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(exists=True),
+    default=None,
+    help="Results file to compare against.",
+)
+@click.option(
+    "--tolerance",
+    type=float,
+    default=TOLERANCE,
+    show_default=True,
+    help="Allowed slowdown or growth before a step counts as a regression.",
+)
+@click.option(
+    "--work-dir",
+    type=click.Path(),
+    default=str(WORK_DIR),
+    show_default=True,
+    help="Where the synthetic archive and products are written.",
+)
+def run_benchmarks(
+    files,
+    format,
+    jitter_s,
+    overlap_s,
+    gap_every,
+    short_every,
+    skip_hmb,
+    label,
+    baseline,
+    tolerance,
+    work_dir,
+):
+    setup = {
+        "files": files,
+        "jitter_s": jitter_s,
+        "overlap_s": overlap_s,
+        "gap_every": gap_every,
+        "short_every": short_every,
+    }
+    setup_hash = hashlib.sha256(json.dumps(setup, sort_keys=True).encode()).hexdigest()[:12]
+    work_dir = Path(work_dir).resolve()
+    archive_dir = work_dir / "archive" / setup_hash  # one synthetic day per setup
+
+    t0 = time.perf_counter()
+    paths = write_synthetic_day(
+        archive_dir,
+        HYD_REFDES,
+        DAY,
+        n_files=files,
+        jitter_s=jitter_s,
+        overlap_s=overlap_s,
+        gap_every=gap_every,
+        short_every=short_every,
+    )
+    print(f"Synthetic day of {len(paths)} files ready in {time.perf_counter() - t0:.0f} s")
+
+    # products and pbp metadata go under the work dir, the attribute yamls come from the repo
+    for products in ["data", "output", "metadata/json"]:
+        shutil.rmtree(work_dir / products, ignore_errors=True)  # left by an earlier setup
+    (work_dir / "metadata").mkdir(parents=True, exist_ok=True)
+    attributes = work_dir / "metadata" / "attributes"
+    if not attributes.exists():
+        attributes.symlink_to(REPO_DIR / "metadata" / "attributes")
+    os.chdir(work_dir)
+
+    run = metrics.start_run(HYD_REFDES, DAY, "benchmark")
+    try:
+        hyd = HydrophoneDay(HYD_REFDES, DAY, 0.02, mseed_urls=[str(p) for p in paths])
+        with run.stage("audio"):
+            bench_audio(run, hyd, format)
+        if not skip_hmb:
+            with run.stage("viz"):
+                bench_hmb(run)
+    finally:
+        metrics.end_run()
+
+    report = run.report()
+    report["setup"] = {
+        **setup,
+        "format": format,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "mem_gb": round(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3, 1),
+    }
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    label = label or f"{platform.node()}_{time.strftime('%Y%m%dT%H%M%S')}"
+    results_path = RESULTS_DIR / f"{label}.json"
+    results_path.write_text(json.dumps(report, indent=2))
+    print(metrics.markdown_report(report))
+    print(f"Results written to {results_path}")
+
+    if baseline is not None:
+        regressions = compare(report, json.loads(Path(baseline).read_text()), tolerance)
+        if regressions:
+            sys.exit(f"{len(regressions)} regressions against {baseline}")
+
+
+if __name__ == "__main__":
+    run_benchmarks()
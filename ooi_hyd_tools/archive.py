@@ -0,0 +1,54 @@
+import os
+import re
+import fsspec
+
+from urllib.parse import unquote
+
+"""
+Helpers for locating hydrophone mseed files on the OOI raw data archive.
+"""
+
+# OOI_RAW_DATA_URL points every run at a mirror or a local stand-in (see archive_server.py)
+RAW_DATA_URL = os.environ.get(
+    "OOI_RAW_DATA_URL", "https://rawdata.oceanobservatories.org/files"
+)
+# mseed names carry the start time, e.g. OO-HYEA2--YDH-2025-01-01T00:05:00.000000.mseed
+MSEED_TIME_RE = re.compile(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?)")
+
+
+def day_url(refdes, day_str, base_url=RAW_DATA_URL):
+    """archive directory for one refdes-day, day_str is YYYY/MM/DD"""
+    return f"{base_url}/{refdes[0:8]}/{refdes[9:14]}/{refdes[18:27]}/{day_str}/"
+
+
+def _mseed_entries(listing):
+    entries = []
+    for f in listing:
+        if f["type"] == "file" and f["name"].endswith(".mseed"):
+            match = MSEED_TIME_RE.search(unquote(f["name"].rsplit("/", 1)[-1]))
+            entries.append(
+                {
+                    "name": f["name"],
+                    "size": f.get("size"),
+                    "start": match.group(1) if match else None,
+                }
+            )
+    return sorted(entries, key=lambda e: e["name"])
+
+
+def list_mseed_entries(refdes, day_str, base_url=RAW_DATA_URL):
+    """
+    List mseed files for a refdes-day, including the `addendum` subdirectory.
+    Raises if the day directory itself cannot be listed.
+    """
+    mainurl = day_url(refdes, day_str, base_url)
+    FS = fsspec.filesystem("http")
+
+    entries = _mseed_entries(FS.ls(mainurl))
+    try:
+        addendum = _mseed_entries(FS.ls(f"{mainurl}/addendum"))
+    except Exception:
+        print(f"No addendum for {day_str}")
+        addendum = []
+
+    return entries + addendum
@@ -0,0 +1,246 @@
+import html
+import json
+import time
+import click
+import random
+import socket
+import asyncio
+import multiprocessing as mp
+import urllib.request
+
+from pathlib import Path
+from aiohttp import web
+from email.utils import formatdate
+
+"""
+Local stand-in for the OOI raw data archive. A directory laid out like the archive (e.g. one
+written by synthetic.write_synthetic_day, addendum/ subdirectories included) is served under
+/files with Apache style directory listings, so HydrophoneDay, ListingIndex, MseedCache and
+AsyncFetcher work against it unchanged when the archive URL points here. Every request waits
+`latency_s` (plus up to `jitter_s`), file bodies are paced to a per-connection and a shared
+link bandwidth, and a share of file and listing requests fail with HTTP 503. Counters are
+served as JSON at /_stats.
+"""
+
+CHUNK_BYTES = 64 * 1024
+READY_TIMEOUT_S = 30
+
+
+class _Pacer:
+    """shared link, each chunk takes the next free slot of `bytes_per_s`"""
+
+    def __init__(self, bytes_per_s):
+        self.bytes_per_s = bytes_per_s
+        self.next_free = 0.0
+
+    async def wait(self, nbytes):
+        if not self.bytes_per_s:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_free)
+        self.next_free = start + nbytes / self.bytes_per_s
+        await asyncio.sleep(self.next_free - now)
+
+
+def _make_app(
+    root,
+    latency_s=0.0,
+    jitter_s=0.0,
+    bandwidth_mbps=None,
+    conn_bandwidth_mbps=None,
+    error_rate=0.0,
+    listing_error_rate=0.0,
+    seed=None,
+):
+    root = Path(root).resolve()
+    rng = random.Random(seed)
+    link = _Pacer(bandwidth_mbps * 1e6 / 8 if bandwidth_mbps else None)
+    conn_bytes_per_s = conn_bandwidth_mbps * 1e6 / 8 if conn_bandwidth_mbps else None
+    stats = {"requests": 0, "listings": 0, "files": 0, "bytes": 0, "errors": 0, "in_flight": 0}
+    stats["max_in_flight"] = 0
+
+    def listing(path):
+        names = sorted(p.name + ("/" if p.is_dir() else "") for p in path.iterdir())
+        links = "\n".join(
+            f'<a href="{html.escape(name)}">{html.escape(name)}</a>' for name in names
+        )
+        return web.Response(
+            text=f"<html><body><pre>\n{links}\n</pre></body></html>", content_type="text/html"
+        )
+
+    async def send_file(request, path):
+        size = path.stat().st_size
+        headers = {
+            "Content-Length": str(size),
+            "Content-Type": "application/octet-stream",
+            "Last-Modified": formatdate(path.stat().st_mtime, usegmt=True),
+        }
+        if request.method == "HEAD":
+            return web.Response(headers=headers)
+        response = web.StreamResponse(headers=headers)
+        await response.prepare(request)
+        conn = _Pacer(conn_bytes_per_s)
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_BYTES):
+                await asyncio.gather(link.wait(len(chunk)), conn.wait(len(chunk)))
+                await response.write(chunk)
+                stats["bytes"] += len(chunk)
+        await response.write_eof()
+        stats["files"] += 1
+        return response
+
+    async def handle(request):
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(latency_s + rng.uniform(0, jitter_s))
+            # the archive tolerates the double slash of day_url + "/addendum"
+            parts = [p for p in request.match_info["tail"].split("/") if p]
+            path = root.joinpath(*parts).resolve()
+            if not path.is_relative_to(root) or not path.exists():
+                raise web.HTTPNotFound()
+            failure_rate = listing_error_rate if path.is_dir() else error_rate
+            if rng.random() < failure_rate:
+                stats["errors"] += 1
+                raise web.HTTPServiceUnavailable()
+            if path.is_dir():
+                stats["listings"] += 1
+                return listing(path)
+            return await send_file(request, path)
+        finally:
+            stats["in_flight"] -= 1
+
+    async def handle_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get("/_stats", handle_stats)
+    app.router.add_route("*", "/files/{tail:.*}", handle)
+    return app
+
+
+def _serve(port, kwargs):
+    web.run_app(_make_app(**kwargs), host="127.0.0.1", port=port, print=None)
+
+
+class ArchiveServer:
+    """
+    Runs the stand-in in its own process, so serving is not slowed down by the pipeline
+    holding the GIL. Use as a context manager, `base_url` is what the archive URL is set to.
+    """
+
+    def __init__(self, root, port=None, **kwargs):
+        self.root = root
+        self.port = port
+        self.kwargs = kwargs
+        self.process = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/files"
+
+    def stats(self):
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/_stats") as r:
+            return json.loads(r.read())
+
+    def start(self):
+        if self.port is None:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                self.port = s.getsockname()[1]
+        self.process = mp.get_context("spawn").Process(
+            target=_serve, args=(self.port, {"root": self.root, **self.kwargs}), daemon=True
+        )
+        self.process.start()
+        deadline = time.monotonic() + READY_TIMEOUT_S
+        while True:
+            try:
+                self.stats()
+                return self
+            except OSError:
+                if time.monotonic() > deadline or not self.process.is_alive():
+                    self.stop()
+                    raise RuntimeError(f"archive stand-in did not start on port {self.port}")
+                time.sleep(0.1)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+@click.command()
+@click.argument("root", type=click.Path(exists=True, file_okay=False))
+@click.option("--port", type=int, default=8080, show_default=True)
+@click.option(
+    "--latency-ms", type=float, default=0.0, show_default=True, help="Added to every request."
+)
+@click.option(
+    "--jitter-ms",
+    type=float,
+    default=0.0,
+    show_default=True,
+    help="Random extra latency up to this.",
+)
+@click.option(
+    "--bandwidth-mbps",
+    type=float,
+    default=None,
+    help="Shared link bandwidth, unlimited by default.",
+)
+@click.option(
+    "--conn-bandwidth-mbps", type=float, default=None, help="Bandwidth of each connection."
+)
+@click.option(
+    "--error-rate",
+    type=float,
+    default=0.0,
+    show_default=True,
+    help="Share of file requests answered with 503.",
+)
+@click.option(
+    "--listing-error-rate",
+    type=float,
+    default=0.0,
+    show_default=True,
+    help="Share of directory listings answered with 503.",
+)
+@click.option("--seed", type=int, default=None, help="Seed of the latency and error draws.")
+def serve_archive(
+    root,
+    port,
+    latency_ms,
+    jitter_ms,
+    bandwidth_mbps,
+    conn_bandwidth_mbps,
+    error_rate,
+    listing_error_rate,
+    seed,
+):
+    """serve ROOT as the raw data archive at http://127.0.0.1:PORT/files"""
+    print(f"Serving {root} at http://127.0.0.1:{port}/files, stats at /_stats")
+    _serve(
+        port,
+        {
+            "root": root,
+            "latency_s": latency_ms / 1000,
+            "jitter_s": jitter_ms / 1000,
+            "bandwidth_mbps": bandwidth_mbps,
+            "conn_bandwidth_mbps": conn_bandwidth_mbps,
+            "error_rate": error_rate,
+            "listing_error_rate": listing_error_rate,
+            "seed": seed,
+        },
+    )
+
+
+if __name__ == "__main__":
+    serve_archive()
@@ -1,7 +1,6 @@
 from pbp.meta_gen.gen_iclisten import IcListenMetadataGenerator
-from datetime import datetime, timezone
+from datetime import datetime
 import xarray as xr
-import polars as pl
 import matplotlib.pyplot as plt
 
 from pbp.simpleapi import HmbGen
@@ -14,7 +13,10 @@ import boto3
 import botocore
 from botocore.config import Config
 
+from ooi_hyd_tools import metrics
 from ooi_hyd_tools.utils import select_logger
+from ooi_hyd_tools.deployments import DEPLOYMENTS
+from ooi_hyd_tools.hmb_zarr import ZARR_DIR, open_hmb_range
 
 
 plt.switch_backend("Agg")  # use non-interactive backend
@@ -25,6 +27,7 @@ VOLTAGE_MULTIPLIER = 1
 # to 128.9 dB (=20log10(2796202)). This offset is applied to the cal files in rca_correction_cals
 # so here we use a voltage multiplier of 1.
 DB_RANGE = (45, 120)
+SPAN_PLOT_SIZE = (1600, 600)  # pixels of long-span plots, at 100 dpi
 
 # metadata files for output netCDF data products
 GLOBAL_ATTRS_YAML = "./metadata/attributes/globalAttributes.yaml"
@@ -94,52 +97,27 @@ def gen_metadata(start_date, file_type, hyd_refdes):
 @task
 def find_cal_file(refdes, date_str):
     logger = select_logger()
-    node = refdes[:8]
-    current_utc_datetime = datetime.now(timezone.utc)
+    # deployments come from a local index of the OOI asset management CSVs
+    cal_file_path, deployment_number = DEPLOYMENTS.cal_file(refdes, date_str)
 
-    date = datetime.strptime(date_str, "%Y%m%d").replace(tzinfo=timezone.utc)
+    logger.info(f"{date_str} falls under deployment < {deployment_number} > for {refdes}")
+    logger.info(f"cal file at {cal_file_path}")
+    return str(cal_file_path)  # pbp wants a string not a path
 
-    # load deployments from OOI asset management
-    df = pl.read_csv(
-        f"https://raw.githubusercontent.com/oceanobservatories/asset-management/refs/heads/master/deployment/{node}_Deploy.csv"
-    )
-
-    df = df.filter(pl.col("Reference Designator") == refdes)
-
-    df = df.with_columns(
-        pl.col("startDateTime")
-        .str.strptime(pl.Datetime)
-        .dt.replace_time_zone("UTC")
-        .alias("startDateTime")
-    )
-    df = df.with_columns(
-        pl.col("stopDateTime")
-        .str.strptime(pl.Datetime)
-        .dt.replace_time_zone("UTC")
-        .alias("stopDateTime")
-    )
-    df = df.with_columns(
-        pl.col("stopDateTime").fill_null(current_utc_datetime).alias("stopDateTime")
-    )
-
-    deploy_df = df.filter((pl.col("startDateTime") < date) & (pl.col("stopDateTime") > date))
-    deployment_number = deploy_df["deploymentNumber"]
 
-    cal_file_path_str = (
-        f"./metadata/rca_correction_cals/{refdes}_{str(deployment_number[0])}.nc"
-    )
-    cal_file_path = Path(cal_file_path_str)
-
-    if not cal_file_path.exists():
-        raise FileNotFoundError(f"No calibration file found for {date_str}")
+def gen_hybrid_millidecade_spectrogram(start_date, hyd_refdes, apply_cals, freq_lims):
+    logger = select_logger()
+    sensitivity_uri = None
+    if apply_cals:
+        logger.info("Applying calibration .nc files from the ooi-hyd-tools metadata folder.")
+        sensitivity_uri = find_cal_file(hyd_refdes, start_date)
 
-    logger.info(f"{date_str} falls under deployment < {deployment_number[0]} > for {refdes}")
-    logger.info(f"cal file at {cal_file_path_str}")
-    return cal_file_path_str  # pbp wants a string not a path
+    hmb_gen = build_hmb_gen(hyd_refdes, freq_lims, sensitivity_uri)
+    process_hmb_date(hmb_gen, start_date, hyd_refdes, freq_lims)
 
 
-def gen_hybrid_millidecade_spectrogram(start_date, hyd_refdes, apply_cals, freq_lims):
-    logger = select_logger()
+def build_hmb_gen(hyd_refdes, freq_lims, sensitivity_uri=None, s3_client=None):
+    """a checked HmbGen, reusable for every date that shares the same calibration file"""
     instrument = hyd_refdes[-9:]
     # set up directories
     download_dir = Path("./downloads")
@@ -159,16 +137,15 @@ def gen_hybrid_millidecade_spectrogram(start_date, hyd_refdes, apply_cals, freq_
     hmb_gen.set_global_attrs_uri(GLOBAL_ATTRS_YAML)
     hmb_gen.set_variable_attrs_uri(VARIABLE_ATTRS_YAML)
     hmb_gen.set_voltage_multiplier(VOLTAGE_MULTIPLIER)
-    hmb_gen.set_subset_to(freq_lims)
+    hmb_gen.set_subset_to(tuple(freq_lims))
 
-    if apply_cals:
-        logger.info("Applying calibration .nc files from the ooi-hyd-tools metadata folder.")
-        sensitivity_uri = find_cal_file(hyd_refdes, start_date)
+    if sensitivity_uri is not None:
         # hmb_gen.set_sensitivity(-170)
         hmb_gen.set_sensitivity(sensitivity_uri)
 
-    config = Config(signature_version=botocore.UNSIGNED)
-    s3_client = boto3.client("s3", config=config)
+    if s3_client is None:
+        config = Config(signature_version=botocore.UNSIGNED)
+        s3_client = boto3.client("s3", config=config)
     hmb_gen.set_s3_client(s3_client)
 
     hmb_gen.set_download_dir(str(download_dir))
@@ -183,15 +160,32 @@ def gen_hybrid_millidecade_spectrogram(start_date, hyd_refdes, apply_cals, freq_
     # A message is returned in case of any errors
     if error:
         raise RuntimeError(f"check_parameters returned:\n{error}")
+    return hmb_gen
+
+
+def process_hmb_date(hmb_gen, start_date, hyd_refdes, freq_lims):
+    """run a YYYYMMDD date through a configured HmbGen and plot the summary"""
+    logger = select_logger()
+    instrument = hyd_refdes[-9:]
+    output_dir = Path("./output")
 
     # The resulting NetCDF file should have been saved under the output directory.
-    result = hmb_gen.process_date(start_date)
+    with metrics.stage("hmb"):
+        result = hmb_gen.process_date(start_date)
+    if isinstance(result, str):  # pbp reports a day without segments as a message
+        raise RuntimeError(result)
     # sanity check
     logger.info(result.dataset)
 
     nc_filename = output_dir / f"{instrument}_{start_date}.nc"
     ds = xr.open_dataset(nc_filename, engine="h5netcdf")
 
+    with metrics.stage("plot"):
+        plot_hmb_summary(ds, hyd_refdes, start_date, freq_lims, output_dir)
+
+
+def plot_hmb_summary(ds, hyd_refdes, start_date, freq_lims, output_dir):
+    instrument = hyd_refdes[-9:]
     plot_dataset_summary(
         ds,
         lat_lon_for_solpos=HYDBB_COORDS[hyd_refdes],
@@ -201,3 +195,55 @@ def gen_hybrid_millidecade_spectrogram(start_date, hyd_refdes, apply_cals, freq_
         jpeg_filename=f"{str(output_dir)}/{instrument}_{start_date}.png",
         show=False,
     )
+
+
+def plot_hmb_span(
+    hyd_refdes,
+    start,
+    end,
+    freq_lims,
+    output_dir=Path("./output"),
+    store_dir=ZARR_DIR,
+    stat="mean",
+):
+    """
+    spectrogram of any span of the yearly zarr stores, read from the pyramid level that
+    matches the plot width so a month costs about as much as a day
+    """
+    logger = select_logger()
+    instrument = hyd_refdes[-9:]
+    width, height = SPAN_PLOT_SIZE
+    ds = open_hmb_range(hyd_refdes, start, end, store_dir, width=width, stat=stat)
+    if ds is None:
+        logger.warning(f"No HMB data in {store_dir} for {instrument} {start} - {end}")
+        return None
+    ds = ds.sel(frequency=slice(*freq_lims))
+    logger.info(f"plotting {ds.sizes['time']} x {ds.sizes['frequency']} cells of {instrument}")
+
+    plt.rcParams["text.usetex"] = False
+    fig, ax = plt.subplots(figsize=(width / 100, height / 100), dpi=100)
+    mesh = ax.pcolormesh(
+        ds["time"].values,
+        ds["frequency"].values,
+        ds["psd"].values.T,
+        shading="nearest",
+        cmap="rainbow",
+        vmin=DB_RANGE[0],
+        vmax=DB_RANGE[1],
+    )
+    ax.set_yscale("log")
+    ax.set_ylim(freq_lims)
+    ax.set_ylabel("Frequency [Hz]")
+    ax.set_title(
+        f"{hyd_refdes}, {HYDBB_COORDS[hyd_refdes][0]}°N, {HYDBB_COORDS[hyd_refdes][1]}°W"
+    )
+    fig.colorbar(mesh, ax=ax, label="dB re 1 µPa²/Hz")
+    fig.autofmt_xdate()
+
+    png_filename = (
+        Path(output_dir)
+        / f"{instrument}_{start.strftime('%Y%m%d')}_{end.strftime('%Y%m%d')}_{stat}.png"
+    )
+    fig.savefig(png_filename, dpi=100, bbox_inches="tight")
+    plt.close(fig)
+    return png_filename
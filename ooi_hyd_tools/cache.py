@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import fsspec
+import concurrent.futures
+
+from pathlib import Path
+from urllib.parse import unquote
+from datetime import datetime, timedelta, timezone
+
+from ooi_hyd_tools.archive import list_mseed_entries, RAW_DATA_URL, MSEED_TIME_RE
+
+"""
+On-disk caches for objects fetched from the OOI raw data archive, so reruns of the same day
+(task retries, a different --format or --fudge-factor) read from local disk instead of
+downloading every mseed file again.
+"""
+
+CACHE_DIR = "./cache/mseed"
+CACHE_MAX_GB = 50
+LISTING_DIR = "./cache/listings"
+LISTING_TTL_S = 15 * 60  # how long a listing of a day that may still change stays valid
+LISTING_SETTLE_HOURS = 48  # after this long past the end of a day its listing is final
+
+
+def _hash(value):
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=Path(path).parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+class MseedCache:
+    """
+    Size-capped LRU cache of raw archive objects.
+
+    Entries are named `{hash(url)}_{hash(size, last-modified)}.mseed`, so a file that changes
+    on the archive gets a new entry and the stale one is dropped. Files that start more than
+    `settle_hours` ago are final like their day's listing, a cached copy of one is served
+    without asking the archive, so only recent files cost a HEAD request on a hit and settled
+    days replay offline. Recency is tracked with the file mtime, which is bumped on every hit.
+    Downloads are written to a temp file in the cache dir and moved into place with
+    `os.replace`, so concurrent workers never see a partial file.
+    """
+
+    def __init__(
+        self,
+        cache_dir=CACHE_DIR,
+        max_bytes=int(CACHE_MAX_GB * 1024**3),
+        settle_hours=LISTING_SETTLE_HOURS,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.settle_hours = settle_hours
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _version(self, url, fs):
+        info = fs.info(url)
+        # Last-Modified over http, mtime for local or other fsspec paths
+        modified = info.get("Last-Modified", info.get("mtime"))
+        return _hash(f"{info.get('size')}|{modified}")[:16]
+
+    def _is_settled(self, url):
+        match = MSEED_TIME_RE.search(unquote(url.rsplit("/", 1)[-1]))
+        if match is None:
+            return False
+        start = datetime.fromisoformat(match.group(1)).replace(tzinfo=timezone.utc)
+        return start + timedelta(hours=self.settle_hours) < datetime.now(timezone.utc)
+
+    def _newest(self, entries):
+        return max(entries, key=lambda p: p.stat().st_mtime)
+
+    def _path(self, url, version):
+        return self.cache_dir / f"{_hash(url)[:32]}_{version}.mseed"
+
+    def _entries(self, url):
+        return list(self.cache_dir.glob(f"{_hash(url)[:32]}_*.mseed"))
+
+    def get(self, url, fetch=None):
+        """
+        return the bytes of `url`, downloading it into the cache on a miss with `fetch(url)`
+        (e.g. AsyncFetcher.get) or a plain fsspec read
+        """
+        if self._is_settled(url):
+            try:
+                return self._read(self._newest(self._entries(url)))
+            except (ValueError, FileNotFoundError):  # not cached, or evicted meanwhile
+                pass
+
+        fs, _ = fsspec.core.url_to_fs(url)
+        try:
+            version = self._version(url, fs)
+        except Exception as e:
+            # archive unreachable, fall back to whatever version we already have
+            entries = self._entries(url)
+            if not entries:
+                raise
+            print(f"Could not validate {url} ({e}), using cached copy")
+            return self._read(self._newest(entries))
+
+        path = self._path(url, version)
+        try:
+            return self._read(path)
+        except FileNotFoundError:
+            pass
+
+        data = fetch(url) if fetch is not None else fs.cat_file(url)
+        self._store(path, data)
+        for stale in self._entries(url):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+        self.evict()
+        return data
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:  # evicted by another worker after we opened it
+            pass
+        return data
+
+    def _store(self, path, data):
+        _atomic_write(path, data)
+
+    def size(self):
+        total = 0
+        for p in self.cache_dir.glob("*.mseed"):
+            try:
+                total += p.stat().st_size
+            except FileNotFoundError:  # evicted by another worker
+                pass
+        return total
+
+    def evict(self):
+        """delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for p in self.cache_dir.glob("*.mseed"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+
+
+class ListingIndex:
+    """
+    Persistent index of archive directory listings keyed by (refdes, day), one JSON manifest
+    per day holding file names, sizes (when the server reports them) and start times.
+
+    Days that ended more than `settle_hours` before they were listed are final and are served
+    from the index without touching the network. More recent days are relisted once their
+    manifest is older than `ttl_s`.
+    """
+
+    def __init__(
+        self,
+        index_dir=LISTING_DIR,
+        ttl_s=LISTING_TTL_S,
+        settle_hours=LISTING_SETTLE_HOURS,
+        base_url=RAW_DATA_URL,
+    ):
+        self.index_dir = Path(index_dir)
+        self.ttl_s = ttl_s
+        self.settle_hours = settle_hours
+        self.base_url = base_url
+
+    def _path(self, refdes, day_str):
+        return self.index_dir / refdes / f"{day_str.replace('/', '_')}.json"
+
+    def _is_fresh(self, record, day_str):
+        day_end = datetime.strptime(day_str, "%Y/%m/%d").replace(tzinfo=timezone.utc)
+        day_end += timedelta(days=1, hours=self.settle_hours)
+        if record["listed_at"] >= day_end.timestamp():
+            return True
+        return time.time() - record["listed_at"] < self.ttl_s
+
+    def get(self, refdes, day_str):
+        """return mseed entries for a refdes-day, listing the archive only when needed"""
+        path = self._path(refdes, day_str)
+        try:
+            record = json.loads(path.read_text())
+            # listings of another archive (e.g. a local stand-in) are never reused
+            if record.get("base_url", RAW_DATA_URL) == self.base_url and self._is_fresh(
+                record, day_str
+            ):
+                return record["files"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+        listed_at = time.time()
+        entries = list_mseed_entries(refdes, day_str, self.base_url)
+        record = {
+            "refdes": refdes,
+            "day": day_str,
+            "base_url": self.base_url,
+            "listed_at": listed_at,
+            "files": entries,
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _atomic_write(path, json.dumps(record).encode())
+        return entries
+
+    def prefetch(self, refdes, day_strs, max_workers=8):
+        """list many days concurrently, returns {day_str: number of files or the error}"""
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.get, refdes, day): day for day in day_strs}
+            for future in concurrent.futures.as_completed(futures):
+                day = futures[future]
+                try:
+                    results[day] = len(future.result())
+                except Exception as e:
+                    results[day] = e
+        return results
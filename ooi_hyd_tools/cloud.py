@@ -4,14 +4,20 @@ from pathlib import Path
 from prefect import task
 
 from ooi_hyd_tools.utils import select_logger, get_s3_kwargs
+from ooi_hyd_tools.hmb_zarr import ZARR_DIR
 
 OOI_DATA_BUCKET = "s3://ooi-hmb-data"
 OOI_VIZ_BUCKET = "s3://ooi-rca-qaqc-prod"
 
 
 @task
-def sync_png_nc_to_s3(hyd_refdes, date, flag, local_dir=Path("./output")):
-    """sync .nc and .png files to S3 based on the given date and refdes."""
+def sync_png_nc_to_s3(
+    hyd_refdes, date, flag, local_dir=Path("./output"), zarr_keys=None, zarr_dir=Path(ZARR_DIR)
+):
+    """
+    sync .nc and .png files to S3 based on the given date and refdes.
+    zarr_keys are the store keys written by append_hmb_to_zarr, only those are uploaded.
+    """
     logger = select_logger()
     instrument = hyd_refdes[-9:]
     year = datetime.strptime(date, "%Y/%m/%d").year
@@ -32,6 +38,12 @@ def sync_png_nc_to_s3(hyd_refdes, date, flag, local_dir=Path("./output")):
                 logger.info(f"Uploading {fp} to {s3_uri}")
                 s3_fs.put(str(fp), s3_uri)
 
+        # Upload changed zarr chunks to hmb_zarr/INSTRUMENT/YYYY.zarr/
+        for key in zarr_keys or []:
+            s3_uri = f"{OOI_DATA_BUCKET}/hmb_zarr/{key}"
+            logger.info(f"Uploading {key} to {s3_uri}")
+            s3_fs.put(str(zarr_dir / key), s3_uri)
+
         # Upload .png files to spectrograms/YYYY/
         png_files = local_dir.glob("*HYD*.png")
         for fp in png_files:
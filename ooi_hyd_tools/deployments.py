@@ -0,0 +1,188 @@
+import io
+import hashlib
+import threading
+import fsspec
+import numpy as np
+import polars as pl
+import xarray as xr
+
+from pathlib import Path
+from datetime import datetime, timezone
+
+from ooi_hyd_tools.cache import _atomic_write
+
+"""
+Offline lookup of OOI deployments and calibration files. The asset-management deployment
+CSVs are kept as local copies in DEPLOY_DIR. A node's CSV is downloaded once, the first time
+the node is needed, and again only by an explicit `refresh` (--refresh-deployments), so a
+miss never sends every day of a backfill to the network. Each node is loaded into a
+per-refdes interval index so the deployment covering a time is a binary search, and times
+outside every deployment are remembered for the process. Calibration datasets are cached by
+(refdes, deployment), and their curves interpolated onto an HMB band grid are cached in
+memory and on disk.
+"""
+
+DEPLOY_URL = (
+    "https://raw.githubusercontent.com/oceanobservatories/asset-management/"
+    "refs/heads/master/deployment/{node}_Deploy.csv"
+)
+DEPLOY_DIR = "./metadata/deployments"
+CAL_DIR = "./metadata/rca_correction_cals"
+SENSITIVITY_CACHE_DIR = "./cache/sensitivity"
+
+
+class DeploymentIndex:
+    def __init__(self, deploy_dir=DEPLOY_DIR, cal_dir=CAL_DIR):
+        self.deploy_dir = Path(deploy_dir)
+        self.cal_dir = Path(cal_dir)
+        self._intervals = {}  # refdes -> (starts, stops, deployment numbers), sorted by start
+        self._cals = {}  # (refdes, deployment) -> (cal file version, sensitivity DataArray)
+        self._misses = set()  # (refdes, time in us) covered by no deployment
+        self._lock = threading.RLock()  # _load may refresh while holding it
+
+    def _csv_path(self, node):
+        return self.deploy_dir / f"{node}_Deploy.csv"
+
+    def refresh(self, nodes):
+        """download the deployment CSVs of `nodes` (e.g. "CE04OSBP"), drop stale intervals"""
+        self.deploy_dir.mkdir(parents=True, exist_ok=True)
+        FS = fsspec.filesystem("http")
+        for node in set(nodes):
+            data = FS.cat_file(DEPLOY_URL.format(node=node))
+            _atomic_write(self._csv_path(node), data)
+            print(f"refreshed deployments for {node}")
+        with self._lock:
+            self._intervals = {
+                refdes: v for refdes, v in self._intervals.items() if refdes[:8] not in nodes
+            }
+            self._misses = {miss for miss in self._misses if miss[0][:8] not in nodes}
+
+    def _load(self, refdes):
+        node = refdes[:8]
+        path = self._csv_path(node)
+        if not path.exists():
+            # first use of the node on this machine, a failed download raises and is not cached
+            self.refresh([node])
+
+        df = pl.read_csv(io.BytesIO(path.read_bytes()))
+        df = df.filter(pl.col("Reference Designator") == refdes)
+        df = df.with_columns(
+            pl.col("startDateTime").str.strptime(pl.Datetime).dt.replace_time_zone("UTC"),
+            pl.col("stopDateTime").str.strptime(pl.Datetime).dt.replace_time_zone("UTC"),
+        ).sort("startDateTime")
+
+        # open deployments have no stop time yet
+        starts = df["startDateTime"].dt.epoch("us").to_numpy()
+        stops = df["stopDateTime"].dt.epoch("us").fill_null(np.iinfo(np.int64).max).to_numpy()
+        numbers = df["deploymentNumber"].to_numpy()
+        return starts, stops, numbers
+
+    def _intervals_for(self, refdes):
+        with self._lock:
+            if refdes not in self._intervals:
+                self._intervals[refdes] = self._load(refdes)
+            return self._intervals[refdes]
+
+    def _find(self, refdes, t_us):
+        starts, stops, numbers = self._intervals_for(refdes)
+        # last deployment starting strictly before t
+        i = np.searchsorted(starts, t_us, side="left") - 1
+        if i >= 0 and stops[i] > t_us:
+            return int(numbers[i])
+        return None
+
+    def deployment(self, refdes, when):
+        """number of the deployment covering `when` (a datetime, naive means UTC)"""
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        t_us = int(when.timestamp() * 1_000_000)
+        number = None if (refdes, t_us) in self._misses else self._find(refdes, t_us)
+        if number is None:
+            # may be a deployment newer than the shipped CSV, --refresh-deployments updates it
+            with self._lock:
+                self._misses.add((refdes, t_us))
+            raise LookupError(f"No deployment of {refdes} covers {when.isoformat()}")
+        return number
+
+    def cal_file(self, refdes, date_str):
+        """calibration file for a YYYYMMDD date"""
+        date = datetime.strptime(date_str, "%Y%m%d").replace(tzinfo=timezone.utc)
+        deployment = self.deployment(refdes, date)
+        cal_file_path = self.cal_dir / f"{refdes}_{deployment}.nc"
+        if not cal_file_path.exists():
+            raise FileNotFoundError(f"No calibration file found for {date_str}")
+        return cal_file_path, deployment
+
+    def sensitivity(self, refdes, deployment):
+        """sensitivity DataArray of a deployment, loaded once per cal file version"""
+        key = (refdes, deployment)
+        path = self.cal_dir / f"{refdes}_{deployment}.nc"
+        stat = path.stat()
+        version = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if key not in self._cals or self._cals[key][0] != version:
+                with xr.open_dataset(path) as ds:
+                    self._cals[key] = (version, ds.sensitivity.load())
+            return self._cals[key][1]
+
+
+DEPLOYMENTS = DeploymentIndex()
+
+
+class SensitivityCache:
+    """
+    Calibration curves interpolated onto the frequency grid of an HMB product, keyed by
+    (refdes, deployment, freq_lims, band layout). The layout is a hash of the grid itself, so
+    any change in sample rate, nfft or band definition gets its own entry. Entries are kept in
+    memory and as small .npz files in `cache_dir` for other processes, and are recomputed when
+    the size or mtime of the cal file changes.
+    """
+
+    def __init__(self, cache_dir=SENSITIVITY_CACHE_DIR, deployments=DEPLOYMENTS):
+        self.cache_dir = Path(cache_dir)
+        self.deployments = deployments
+        self._memory = {}  # key -> (cal version, values)
+        self._lock = threading.Lock()
+
+    def _key(self, refdes, deployment, frequency, freq_lims):
+        layout = hashlib.sha256(frequency.tobytes() + frequency.dtype.str.encode()).hexdigest()
+        lo, hi = freq_lims
+        return f"{refdes}_{deployment}_{lo}-{hi}_{layout[:16]}"
+
+    def _cal_version(self, refdes, deployment):
+        stat = (self.deployments.cal_dir / f"{refdes}_{deployment}.nc").stat()
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    def get(self, refdes, deployment, frequency, freq_lims):
+        """sensitivity at `frequency`, as sensitivity_da.interp(frequency=...)"""
+        frequency = np.asarray(frequency)
+        key = self._key(refdes, deployment, frequency, freq_lims)
+        version = self._cal_version(refdes, deployment)
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        path = self.cache_dir / f"{key}.npz"
+        values = None
+        try:
+            with np.load(path) as npz:
+                if str(npz["cal_version"]) == version:
+                    values = npz["sensitivity"]
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            pass
+
+        if values is None:
+            sensitivity_da = self.deployments.sensitivity(refdes, deployment)
+            values = sensitivity_da.interp(frequency=frequency).values
+            buf = io.BytesIO()
+            np.savez(buf, sensitivity=values, cal_version=np.array(version))
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            _atomic_write(path, buf.getvalue())
+
+        with self._lock:
+            self._memory[key] = (version, values)
+        return values
+
+
+SENSITIVITIES = SensitivityCache()
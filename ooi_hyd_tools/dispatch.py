@@ -0,0 +1,142 @@
+import time
+import httpx
+import asyncio
+
+from collections import deque
+from prefect import get_client
+from prefect.exceptions import ObjectNotFound
+from prefect.deployments import run_deployment
+from prefect.client.schemas.objects import StateType
+
+from ooi_hyd_tools.utils import select_logger
+
+"""
+Non-blocking dispatch of many deployment runs. Runs are created with run_deployment(timeout=0)
+so creating one returns at once, and the states of the runs in flight are polled together.
+At most `limit` runs are in flight, and new runs wait while `max_queued` of them have not
+started yet. The limit is halved when a run fails or a submission errors and grows back by one
+per completed run, so a struggling archive or work pool gets fewer runs, not more. A run that
+cannot be submitted after MAX_SUBMIT_ATTEMPTS tries, or is rejected outright (unknown
+deployment, invalid parameters, no access), is recorded as failed and the rest go on.
+"""
+
+MAX_CONCURRENT_RUNS = 8
+POLL_INTERVAL_S = 15
+SUBMIT_RETRY_S = 30  # wait after a failed submission before trying again
+MAX_SUBMIT_ATTEMPTS = 5
+QUEUED_STATES = [StateType.SCHEDULED, StateType.PENDING, StateType.PAUSED]
+
+
+def is_retryable(error):
+    """False for submissions the API rejected, they fail the same way every time"""
+    if isinstance(error, ObjectNotFound):
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return not (400 <= status < 500) or status in [408, 429]
+    return True
+
+
+async def read_flow_run_state(flow_run_id):
+    async with get_client() as client:
+        flow_run = await client.read_flow_run(flow_run_id)
+    return flow_run.state
+
+
+class DeploymentDispatcher:
+    def __init__(
+        self,
+        deployment_name,
+        max_runs=MAX_CONCURRENT_RUNS,
+        max_queued=None,
+        poll_interval=POLL_INTERVAL_S,
+        submit=run_deployment,
+        read_state=read_flow_run_state,
+    ):
+        self.deployment_name = deployment_name
+        self.max_runs = max_runs
+        self.max_queued = max_queued or max_runs
+        self.poll_interval = poll_interval
+        self.limit = max_runs
+        self._submit = submit  # both are awaited, so tests can pass stubs
+        self._read_state = read_state
+
+    def _backoff(self):
+        self.limit = max(1, self.limit // 2)
+
+    async def _submit_one(self, run_name, params):
+        return await self._submit(
+            name=self.deployment_name,
+            parameters=params,
+            flow_run_name=run_name,
+            timeout=0,
+        )
+
+    async def dispatch(self, jobs):
+        """
+        run every (run name, params) in `jobs` to a final state,
+        returns {run name: final state type name}
+        """
+        logger = select_logger()
+        pending = deque(jobs)
+        in_flight = {}  # flow run id -> [run name, params, last state type]
+        results = {}
+        attempts = {}  # run name -> failed submissions
+        t0 = time.perf_counter()
+
+        while pending or in_flight:
+            queued = sum(state in QUEUED_STATES for _, _, state in in_flight.values())
+            while pending and len(in_flight) < self.limit and queued < self.max_queued:
+                run_name, params = pending[0]
+                try:
+                    flow_run = await self._submit_one(run_name, params)
+                except Exception as e:
+                    attempts[run_name] = attempts.get(run_name, 0) + 1
+                    if not is_retryable(e) or attempts[run_name] >= MAX_SUBMIT_ATTEMPTS:
+                        logger.error(
+                            f"Giving up on {run_name} after {attempts[run_name]} attempts ({e})"
+                        )
+                        pending.popleft()
+                        results[run_name] = StateType.FAILED.name
+                        continue
+                    logger.warning(f"Could not submit {run_name} ({e}), backing off")
+                    self._backoff()
+                    await asyncio.sleep(SUBMIT_RETRY_S)
+                    break
+                pending.popleft()
+                state = flow_run.state.type if flow_run.state else StateType.SCHEDULED
+                in_flight[flow_run.id] = [run_name, params, state]
+                queued += 1
+                logger.info(f"Submitted {run_name} ({len(in_flight)}/{self.limit} in flight)")
+
+            if not in_flight:
+                continue
+            await asyncio.sleep(self.poll_interval)
+
+            ids = list(in_flight)
+            states = await asyncio.gather(
+                *(self._read_state(flow_run_id) for flow_run_id in ids), return_exceptions=True
+            )
+            for flow_run_id, state in zip(ids, states):
+                if isinstance(state, Exception):  # try again on the next poll
+                    continue
+                in_flight[flow_run_id][2] = state.type
+                if not state.is_final():
+                    continue
+                run_name = in_flight.pop(flow_run_id)[0]
+                results[run_name] = state.type.name
+                if state.type == StateType.COMPLETED:
+                    self.limit = min(self.max_runs, self.limit + 1)
+                    logger.info(f"{run_name} completed")
+                else:
+                    self._backoff()
+                    logger.warning(
+                        f"{run_name} ended {state.type.name}, limiting to {self.limit} runs"
+                    )
+
+        failed = sorted(name for name, state in results.items() if state != "COMPLETED")
+        logger.info(
+            f"Dispatched {len(results)} runs in {time.perf_counter() - t0:.0f} s,"
+            f" {len(results) - len(failed)} completed, failed: {failed or 'none'}"
+        )
+        return results
@@ -0,0 +1,286 @@
+import time
+import asyncio
+import threading
+import aiohttp
+
+from urllib.parse import urlsplit
+
+"""
+Async fetch layer for the OOI raw data archive. One pooled keep-alive aiohttp session is
+shared by every download of a day, with a cap on in-flight requests and a token-bucket
+request rate per host so the archive server isn't overloaded. The event loop runs in a
+background thread so the thread/process pools in mseed_to_audio can call `get` synchronously.
+"""
+
+MAX_PER_HOST = 8  # in-flight requests per host
+REQUEST_RATE = 10.0  # requests per second per host
+FETCH_TIMEOUT_S = 300
+FETCH_RETRIES = 2
+CHUNK_SIZE = 1024**2
+ADAPT_INTERVAL_S = 10.0  # how often the adaptive controller re-evaluates its limit
+
+
+class TokenBucket:
+    """refill `rate` tokens per second up to `capacity`, each request takes one token"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:  # FIFO, so waiting requests are served in order
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveConcurrency:
+    """
+    Adjustable cap on in-flight requests in the style of AIMD. Every `interval_s` the
+    throughput of the last interval is compared with the one before: the limit grows by one
+    while throughput keeps up, steps back by one when an increase made things slower, and is
+    cut by `backoff` on any timeout or 5xx. With min_limit == max_limit it is a plain fixed
+    limit that still records throughput. Each evaluation is appended to `history`.
+    """
+
+    def __init__(
+        self,
+        initial,
+        min_limit=1,
+        max_limit=None,
+        interval_s=ADAPT_INTERVAL_S,
+        backoff=0.5,
+        tolerance=0.05,
+    ):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit if max_limit is not None else initial
+        self.interval_s = interval_s
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.history = []
+        self._start = time.monotonic()
+        self._window_start = self._start
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._last_throughput = None
+        self._last_change = 0
+        self._last_backoff = float("-inf")
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, nbytes=0, error=False):
+        async with self._cond:
+            self.in_flight -= 1
+            self._window_bytes += nbytes
+            self._window_errors += int(error)
+            now = time.monotonic()
+            if error and now - self._last_backoff >= self.interval_s:
+                # back off right away, but only once per interval since requests already in
+                # flight under the old limit are likely to fail too
+                self._last_backoff = now
+                self._adjust(now, error=True)
+            elif now - self._window_start >= self.interval_s:
+                # errors after a recent backoff hold the limit instead of growing it
+                self._adjust(now, hold=self._window_errors > 0)
+            self._cond.notify_all()
+
+    def _adjust(self, now, error=False, hold=False):
+        elapsed = max(now - self._window_start, 1e-9)
+        throughput = self._window_bytes / elapsed
+        previous = self.limit
+
+        if error:
+            self.limit = max(self.min_limit, int(self.limit * self.backoff))
+        elif hold:
+            pass
+        elif self._last_throughput is not None and throughput < self._last_throughput * (
+            1 - self.tolerance
+        ):
+            # the last step made things worse, undo it
+            self.limit = max(self.min_limit, self.limit - max(self._last_change, 1))
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+        self.history.append(
+            {
+                "t_s": now - self._start,
+                "limit": previous,
+                "next_limit": self.limit,
+                "throughput_mb_s": throughput / 1e6,
+                "errors": self._window_errors,
+            }
+        )
+        self._last_change = self.limit - previous
+        self._last_throughput = None if error or hold else throughput
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_errors = 0
+
+
+class FetchError(Exception):
+    def __init__(self, url, status, detail=None):
+        super().__init__(f"{url} returned HTTP {status}" + (f", {detail}" if detail else ""))
+        self.url = url
+        self.status = status
+        # server errors and bodies that did not match their headers are worth another try
+        self.retryable = status >= 500 or detail is not None
+
+
+class AsyncFetcher:
+    def __init__(
+        self,
+        max_per_host=MAX_PER_HOST,
+        rate=REQUEST_RATE,
+        timeout_s=FETCH_TIMEOUT_S,
+        retries=FETCH_RETRIES,
+        adaptive=False,
+    ):
+        self.max_per_host = max_per_host
+        self.adaptive = adaptive
+        self.rate = rate
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self.stats = {"requests": 0, "bytes": 0, "errors": 0, "latency_s": []}
+        self._history = {}  # limiter history of hosts from sessions already closed
+        self._reset()
+
+    def _reset(self):
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # loops, sessions and locks don't cross process boundaries, a copy builds its own
+        # limiter, so convert_mseed_to_audio keeps async fetch off the process backend
+        state = self.__dict__.copy()
+        for key in ["_loop", "_thread", "_session", "_hosts", "_lock"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._hosts:
+            if self.adaptive:
+                limiter = AdaptiveConcurrency(
+                    min(4, self.max_per_host), max_limit=self.max_per_host
+                )
+            else:
+                limiter = AdaptiveConcurrency(self.max_per_host, min_limit=self.max_per_host)
+            self._hosts[host] = (limiter, TokenBucket(self.rate))
+        return self._hosts[host]
+
+    async def _open(self):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.max_per_host)
+        self._session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout_s)
+        )
+
+    async def fetch(self, url):
+        """download `url` into memory, retrying timeouts and 5xx responses"""
+        if self._session is None:
+            await self._open()
+        limiter, bucket = self._host(url)
+        for attempt in range(self.retries + 1):
+            await limiter.acquire()
+            await bucket.acquire()
+            t0 = time.perf_counter()
+            try:
+                data = await self._read(url)
+            except (asyncio.TimeoutError, aiohttp.ClientError, FetchError) as e:
+                self.stats["errors"] += 1
+                retryable = not isinstance(e, FetchError) or e.retryable
+                await limiter.release(error=retryable)
+                if not retryable or attempt == self.retries:
+                    raise
+                print(f"{url}: {e!r}, retrying")
+                await asyncio.sleep(2**attempt)
+                continue
+            except BaseException:
+                await limiter.release()
+                raise
+            await limiter.release(len(data))
+            self.stats["requests"] += 1
+            self.stats["bytes"] += len(data)
+            self.stats["latency_s"].append(time.perf_counter() - t0)
+            return data
+
+    async def _read(self, url):
+        async with self._session.get(url) as resp:
+            if resp.status != 200:
+                raise FetchError(url, resp.status)
+            # Content-Length of an encoded body is not the size of the decoded bytes
+            if resp.content_length is not None and "Content-Encoding" not in resp.headers:
+                # size known up front, stream straight into one buffer
+                buf = bytearray(resp.content_length)
+                view = memoryview(buf)
+                offset = 0
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    if offset + len(chunk) > len(buf):
+                        raise FetchError(
+                            url, resp.status, f"body longer than {len(buf)} bytes"
+                        )
+                    view[offset : offset + len(chunk)] = chunk
+                    offset += len(chunk)
+                if offset != len(buf):
+                    raise FetchError(url, resp.status, f"body of {offset} of {len(buf)} bytes")
+                return buf
+            buf = bytearray()
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                buf += chunk
+            return buf
+
+    def concurrency_history(self):
+        """{host: [{t_s, limit, next_limit, throughput_mb_s, errors}, ...]}"""
+        history = dict(self._history)
+        history.update({host: limiter.history for host, (limiter, _) in self._hosts.items()})
+        return history
+
+    async def fetch_many(self, urls):
+        return await asyncio.gather(*(self.fetch(url) for url in urls))
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def get(self, url):
+        """blocking fetch, safe to call from any thread"""
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self.fetch(url), loop).result()
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            if self._session is not None:
+                asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._history = self.concurrency_history()
+            self._reset()
@@ -0,0 +1,291 @@
+import numpy as np
+import xarray as xr
+import scipy.signal as sig
+
+from math import ceil
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+from pbp import get_pbp_version, get_pypam_version
+from pbp.pypam_support import PypamSupport
+from pbp.process_helper import save_dataset_to_netcdf
+from pbp.hmb_metadata import HmbMetadataHelper, parse_attributes, replace_snippets
+
+from ooi_hyd_tools.audio_to_spec import (
+    plot_hmb_summary,
+    GLOBAL_ATTRS_YAML,
+    VARIABLE_ATTRS_YAML,
+    VOLTAGE_MULTIPLIER,
+)
+from ooi_hyd_tools.verify import INT32_SHIFT
+from ooi_hyd_tools.deployments import DEPLOYMENTS, SENSITIVITIES
+from ooi_hyd_tools import metrics
+from ooi_hyd_tools.utils import select_logger
+
+"""
+Fused hybrid millidecade engine. Instead of writing the day's FLAC files, rescanning them with
+gen_metadata and decoding them again in HmbGen.process_date, the repaired segments are handed to
+an HmbAccumulator as mseed_to_audio produces them. Each segment is cut into the same one-minute
+windows pbp extracts from the FLAC files, decoded the way libsndfile reads the file back, and
+full minutes are run through one batched welch call. Band aggregation, calibration and
+freq_lims subsetting are left to pbp's PypamSupport, so the NetCDF has the process_date layout.
+"""
+
+HMB_SEGMENT_S = 60  # pbp computes one spectrum per minute
+MINUTES_PER_DAY = 24 * 60
+HMB_BATCH_MINUTES = 5  # minutes per welch call, ~300 MB of FFT frames at 64 kHz
+SENSITIVITY_FLAT_VALUE = 1.0  # HmbGen's default when no calibration file is set
+
+
+def decoded_samples(data, subtype):
+    """samples as float64, the way pbp reads them back from a file written with `subtype`"""
+    if data.dtype == np.int32 and subtype in INT32_SHIFT:
+        shift = INT32_SHIFT[subtype]
+        return (data >> shift) / float(2 ** (31 - shift))
+    if data.dtype == np.int32:  # int counts written as FLOAT are scaled to [-1, 1)
+        return (data / 2.0**31).astype(np.float32).astype(np.float64)
+    if subtype == "FLOAT":
+        return data.astype(np.float32).astype(np.float64)
+    return data.astype(np.float64)
+
+
+class _BatchPypamSupport(PypamSupport):
+    sensitivity_at = None  # frequency -> interpolated sensitivity, from SensitivityCache
+
+    def add_spectrum(self, dt, num_secs, fbands, spectrum):
+        """same bookkeeping as add_segment, for a spectrum computed in a batch upstream"""
+        self.add_missing_segment(dt)
+        captured = self._captured_segments[-1]
+        captured.num_secs = num_secs
+        captured.spectrum = spectrum
+        self._fbands = fbands
+        self._num_actual_segments += 1
+
+    def _apply_sensitivity_if_given(self, psd_da, sensitivity_da):
+        if sensitivity_da is None or self.sensitivity_at is None:
+            return super()._apply_sensitivity_if_given(psd_da, sensitivity_da)
+        # as in PypamSupport, with the curve already on the band grid
+        psd_da = 10 * np.log10(psd_da)
+        psd_da -= self.sensitivity_at(psd_da.frequency_bins.values)
+        return psd_da
+
+
+class HmbAccumulator:
+    """
+    Collects one day of HMB spectra from repaired segments. Segments may arrive in any order
+    and are put back in mseed_urls order by their index, with `skip` marking positions that
+    produced no segment. A minute is computed as soon as a segment starting after its end is
+    reached, so only the last few minutes are left for `finish`, which writes
+    ./output/{instrument}_{YYYYMMDD}.nc.
+    """
+
+    def __init__(self, hyd_refdes, date, format, apply_cals, freq_lims, output_dir="./output"):
+        self.hyd_refdes = hyd_refdes
+        self.date_str = date.replace("/", "")
+        self.format = format
+        self.apply_cals = apply_cals
+        self.freq_lims = tuple(freq_lims)
+        self.output_dir = Path(output_dir)
+        self.day_start = datetime.strptime(self.date_str, "%Y%m%d").replace(
+            tzinfo=timezone.utc
+        )
+        self.reset()
+
+    def reset(self):
+        """drop everything accumulated so far, e.g. before a task retry"""
+        self.logger = select_logger()
+        self.support = _BatchPypamSupport(self.logger)
+        self.pending = {}  # index -> (start_s, end_s, samples) waiting for earlier segments
+        self.next_index = 0
+        self.pieces = {}  # minute of day -> sample arrays that fall in it
+        self.next_minute = 0  # minutes before this one are already computed
+        self.fbands = None
+        # without cals pbp scales the signal by the flat sensitivity, i.e. the PSD by its square
+        self.flat_gain = 1.0 if self.apply_cals else 10 ** (SENSITIVITY_FLAT_VALUE / 10)
+
+    def add(self, index, st):
+        """take the samples of a prepared segment, before the writer releases them"""
+        tr = st[0]
+        fs = int(tr.stats.sampling_rate)
+        if not self.support.parameters_set:
+            self.support.set_parameters(fs, subset_to=self.freq_lims)
+        elif fs != self.support.fs:
+            self.logger.error(f"samplerate changed from {self.support.fs} to {fs}, skipping")
+            self.skip(index)
+            return
+
+        samples = decoded_samples(tr.data, self.format)
+        if VOLTAGE_MULTIPLIER != 1:
+            samples *= VOLTAGE_MULTIPLIER
+
+        # pbp truncates file start times and durations to whole seconds
+        start_s = int(tr.stats.starttime.timestamp - self.day_start.timestamp())
+        end_s = start_s + int(tr.stats.npts / fs)
+        self.pending[index] = (start_s, end_s, samples)
+        self._drain()
+
+    def skip(self, index):
+        self.pending[index] = None
+        self._drain()
+
+    def _drain(self):
+        while self.next_index in self.pending:
+            segment = self.pending.pop(self.next_index)
+            self.next_index += 1
+            if segment is not None:
+                self._cut(*segment)
+
+    def _cut(self, start_s, end_s, samples):
+        fs = self.support.fs
+        # nothing later can land in minutes that end before this segment starts
+        self._flush(min(max(start_s // HMB_SEGMENT_S, 0), MINUTES_PER_DAY))
+
+        first = max(start_s // HMB_SEGMENT_S, 0)
+        if first < self.next_minute:
+            # e.g. an addendum file listed after the rest of the day
+            self.logger.warning(
+                f"HMB minutes before {self.next_minute} are already computed, "
+                f"dropping the part of the segment at {start_s} s that falls in them"
+            )
+            first = self.next_minute
+        last = min(ceil(end_s / HMB_SEGMENT_S), MINUTES_PER_DAY)
+        for minute in range(first, last):
+            lo = max(start_s, minute * HMB_SEGMENT_S) - start_s
+            hi = min(end_s, (minute + 1) * HMB_SEGMENT_S) - start_s
+            if hi > lo:
+                self.pieces.setdefault(minute, []).append(samples[lo * fs : hi * fs])
+
+    def _flush(self, until):
+        if until <= self.next_minute:
+            return
+        minutes = range(self.next_minute, until)
+        segments = {m: np.concatenate(self.pieces.pop(m)) for m in minutes if m in self.pieces}
+        spectra = self._spectra(segments)
+        for minute in minutes:
+            dt = self.day_start + timedelta(minutes=minute)
+            if minute in segments:
+                num_secs = len(segments[minute]) / self.support.fs
+                self.support.add_spectrum(dt, num_secs, self.fbands, spectra[minute])
+            else:
+                self.support.add_missing_segment(dt)
+        self.next_minute = until
+
+    def _spectra(self, segments):
+        """welch PSDs with pbp's settings (nfft = fs, hann, 50% overlap), batched by length"""
+        fs = self.support.fs
+        nfft = fs
+        by_length = {}
+        for minute, data in segments.items():
+            if len(data) < nfft:  # pypam zero pads short segments to one FFT
+                data = np.pad(data, (0, nfft - len(data)))
+            by_length.setdefault(len(data), []).append((minute, data))
+
+        spectra = {}
+        for group in by_length.values():
+            for i in range(0, len(group), HMB_BATCH_MINUTES):
+                batch = group[i : i + HMB_BATCH_MINUTES]
+                self.fbands, psd = sig.welch(
+                    np.stack([data for _, data in batch]),
+                    fs=fs,
+                    window=sig.get_window("hann", nfft),
+                    nfft=nfft,
+                    noverlap=nfft // 2,
+                    scaling="density",
+                    detrend=False,
+                    axis=-1,
+                )
+                psd *= self.flat_gain
+                spectra.update({minute: psd[j] for j, (minute, _) in enumerate(batch)})
+        return spectra
+
+    def finish(self):
+        """compute the remaining minutes and write the day's NetCDF, returns its path"""
+        for index in sorted(self.pending):  # positions never reported, e.g. failed downloads
+            segment = self.pending.pop(index)
+            if segment is not None:
+                self._cut(*segment)
+        self._flush(MINUTES_PER_DAY)
+
+        sensitivity_da = None
+        if self.apply_cals:
+            self.logger.info(
+                "Applying calibration .nc files from the ooi-hyd-tools metadata folder."
+            )
+            cal_file_path, deployment = DEPLOYMENTS.cal_file(self.hyd_refdes, self.date_str)
+            self.logger.info(f"deployment {deployment}, cal file at {cal_file_path}")
+            sensitivity_da = DEPLOYMENTS.sensitivity(self.hyd_refdes, deployment)
+            self.support.sensitivity_at = lambda frequency: SENSITIVITIES.get(
+                self.hyd_refdes, deployment, frequency, self.freq_lims
+            )
+
+        result = self.support.process_captured_segments(sensitivity_da=sensitivity_da)
+        if result is None:
+            self.logger.warning(
+                f"No segments processed, nothing to aggregate for {self.date_str}."
+            )
+            return None
+
+        ds = self._dataset(result, sensitivity_da)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        nc_filename = self.output_dir / f"{self.hyd_refdes[-9:]}_{self.date_str}.nc"
+        if not save_dataset_to_netcdf(self.logger, ds, str(nc_filename)):
+            raise RuntimeError(f"Unable to save {nc_filename}")
+        return nc_filename
+
+    def _dataset(self, result, sensitivity_da):
+        # mirrors pbp's ProcessHelper.process_day
+        psd_da = result.psd_da.swap_dims(frequency_bins="frequency")
+        data_vars = {"psd": psd_da, "effort": result.effort_da}
+        if sensitivity_da is not None:
+            data_vars["sensitivity"] = xr.DataArray(
+                self.support.sensitivity_at(psd_da.frequency.values),
+                coords={"frequency": psd_da.frequency},
+                dims=["frequency"],
+                name=sensitivity_da.name,
+                attrs=sensitivity_da.attrs,
+            )
+        else:
+            data_vars["sensitivity"] = xr.DataArray(
+                data=[SENSITIVITY_FLAT_VALUE], dims=["1"]
+            ).astype(np.float32)
+
+        md_helper = HmbMetadataHelper(
+            self.logger,
+            parse_attributes(Path(GLOBAL_ATTRS_YAML).read_text(), ".yaml"),
+            parse_attributes(Path(VARIABLE_ATTRS_YAML).read_text(), ".yaml"),
+        )
+        md_helper.add_variable_attributes(psd_da["time"], "time")
+        md_helper.add_variable_attributes(data_vars["effort"], "effort")
+        md_helper.add_variable_attributes(psd_da["frequency"], "frequency")
+        md_helper.add_variable_attributes(data_vars["sensitivity"], "sensitivity")
+        md_helper.add_variable_attributes(data_vars["psd"], "psd")
+
+        coverage_date = self.day_start.strftime("%Y-%m-%d")
+        md_helper.set_some_global_attributes(
+            {
+                "time_coverage_start": f"{coverage_date} 00:00:00Z",
+                "time_coverage_end": f"{coverage_date} 23:59:00Z",
+                "time_coverage_resolution": "PT1M",
+                "time_coverage_duration": "P1D",
+                "date_created": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+            }
+        )
+        global_attrs = md_helper.get_global_attributes()
+        snippets = {
+            "{{PBP_version}}": get_pbp_version(),
+            "{{PyPAM_version}}": get_pypam_version(),
+        }
+        for k, v in global_attrs.items():
+            snippets["{{" + k + "}}"] = v
+
+        return xr.Dataset(data_vars=data_vars, attrs=replace_snippets(global_attrs, snippets))
+
+
+def hmb_to_spec(hmb, hyd_refdes, freq_lims):
+    """finish a fused HMB day and plot it like audio_to_spec does"""
+    with metrics.stage("hmb"):
+        nc_filename = hmb.finish()
+    if nc_filename is not None:
+        ds = xr.open_dataset(nc_filename, engine="h5netcdf")
+        with metrics.stage("plot"):
+            plot_hmb_summary(ds, hyd_refdes, hmb.date_str, tuple(freq_lims), hmb.output_dir)
@@ -0,0 +1,120 @@
+import os
+import time
+import boto3
+import botocore
+import multiprocessing as mp
+import concurrent.futures
+
+from botocore.config import Config
+from datetime import timedelta
+
+from ooi_hyd_tools.audio_to_spec import build_hmb_gen, gen_metadata, process_hmb_date
+from ooi_hyd_tools.deployments import DEPLOYMENTS
+from ooi_hyd_tools.utils import select_logger
+
+"""
+HMB products for a range of days of one hydrophone, from FLAC files already in ./data/flac.
+Calibration files for every day are resolved once up front, and each worker process keeps one
+s3 client and one checked HmbGen per calibration file for all the days it is given, instead of
+rebuilding them per day like audio_to_spec. A day that fails is reported and the others carry on.
+"""
+
+BATCH_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+_worker = {}  # per worker process state, set up by _init_worker
+
+
+def _init_worker():
+    _worker["s3_client"] = boto3.client(
+        "s3", config=Config(signature_version=botocore.UNSIGNED)
+    )
+    _worker["hmb_gens"] = {}  # sensitivity uri -> HmbGen
+
+
+def _hmb_one_day(start_date, hyd_refdes, freq_lims, sensitivity_uri):
+    t0 = time.perf_counter()
+    try:
+        # called directly, worker processes are not inside a prefect flow
+        gen_metadata.fn(start_date, "flac", hyd_refdes)
+        hmb_gens = _worker["hmb_gens"]
+        if sensitivity_uri not in hmb_gens:
+            hmb_gens[sensitivity_uri] = build_hmb_gen(
+                hyd_refdes, freq_lims, sensitivity_uri, _worker["s3_client"]
+            )
+        process_hmb_date(hmb_gens[sensitivity_uri], start_date, hyd_refdes, freq_lims)
+    except Exception as e:
+        return {
+            "date": start_date,
+            "ok": False,
+            "error": f"{type(e).__name__}: {e}",
+            "seconds": time.perf_counter() - t0,
+        }
+    return {"date": start_date, "ok": True, "error": None, "seconds": time.perf_counter() - t0}
+
+
+def run_hmb_batch(hyd_refdes, start, end, apply_cals, freq_lims, workers=BATCH_WORKERS):
+    """
+    HMB netcdf and summary plot for every day from `start` to `end` (datetimes, inclusive),
+    spread over `workers` processes. Returns a summary with the per-day results.
+    """
+    logger = select_logger()
+    freq_lims = tuple(freq_lims)
+    t0 = time.perf_counter()
+
+    results = []
+    days = {}  # YYYYMMDD -> sensitivity uri
+    day = start
+    while day <= end:
+        start_date = day.strftime("%Y%m%d")
+        day += timedelta(days=1)
+        if not apply_cals:
+            days[start_date] = None
+            continue
+        try:
+            cal_file_path, _ = DEPLOYMENTS.cal_file(hyd_refdes, start_date)
+            days[start_date] = str(cal_file_path)  # pbp wants a string not a path
+        except (LookupError, FileNotFoundError) as e:
+            results.append({"date": start_date, "ok": False, "error": str(e), "seconds": 0.0})
+
+    logger.info(f"Generating HMB for {len(days)} days of {hyd_refdes} on {workers} workers")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_worker,
+    ) as pool:
+        futures = {
+            pool.submit(_hmb_one_day, start_date, hyd_refdes, freq_lims, uri): start_date
+            for start_date, uri in days.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:  # worker process died
+                result = {
+                    "date": futures[future],
+                    "ok": False,
+                    "error": f"{type(e).__name__}: {e}",
+                    "seconds": 0.0,
+                }
+            if result["ok"]:
+                logger.info(f"HMB for {result['date']} done in {result['seconds']:.0f} s")
+            else:
+                logger.warning(f"HMB for {result['date']} failed: {result['error']}")
+            results.append(result)
+
+    wall_s = time.perf_counter() - t0
+    ok = sum(r["ok"] for r in results)
+    summary = {
+        "hyd_refdes": hyd_refdes,
+        "days": len(results),
+        "succeeded": ok,
+        "failed": sorted(r["date"] for r in results if not r["ok"]),
+        "wall_s": round(wall_s, 1),
+        "days_per_hour": round(ok / wall_s * 3600, 1) if wall_s > 0 else 0.0,
+        "results": sorted(results, key=lambda r: r["date"]),
+    }
+    logger.info(
+        f"HMB batch of {hyd_refdes}: {ok}/{len(results)} days in {wall_s:.0f} s"
+        f" ({summary['days_per_hour']} days/hour), failed: {summary['failed'] or 'none'}"
+    )
+    return summary
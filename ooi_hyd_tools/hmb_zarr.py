@@ -0,0 +1,267 @@
+import fcntl
+import warnings
+import zarr
+import numpy as np
+import xarray as xr
+
+from pathlib import Path
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from numcodecs import Blosc, Delta
+
+from ooi_hyd_tools.utils import select_logger
+
+"""
+Chunked Zarr archive of daily HMB products. Each instrument gets one store per year with a
+fixed one-minute time axis starting on Jan 1, so a day always lands in the same rows no matter
+in which order days are processed. `psd` is chunked one day per chunk and compressed, so
+appending a day writes one new psd chunk and reading a time range only touches the chunks it
+overlaps. `append` returns the keys it wrote so sync_png_nc_to_s3 can push only those.
+
+Each store also holds a pyramid of time-decimated levels under levels/{minutes per bin}, kept
+up to date day by day from the one-minute rows, with the power mean (in dB) and the median of
+every bin. Level chunks hold one day too, so the keys a day writes never carry other days'
+bins and a worker starting from an empty store can upload them without clobbering S3. `open_hmb_range` given a pixel width reads the coarsest level that still has at
+least one bin per pixel, so plotting a month reads a few hundred rows instead of 43200.
+"""
+
+ZARR_DIR = "./output/zarr"
+MINUTES_PER_DAY = 24 * 60
+TIME_CHUNK = 366 * MINUTES_PER_DAY  # the whole time axis of a year in one small chunk
+COMPRESSOR = Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE)
+# per-day attributes that don't describe the whole store
+DAY_ATTRS = ["time_coverage_start", "time_coverage_end", "date_created"]
+PYRAMID_MINUTES = [10, 60, 360, 1440]  # bin sizes of the decimated levels, each divides a day
+PYRAMID_STATS = ["mean", "median"]
+
+
+class HmbZarrStore:
+    def __init__(self, instrument, year, store_dir=ZARR_DIR):
+        self.store_dir = Path(store_dir)
+        self.key_prefix = f"{instrument}/{year}.zarr"
+        self.path = self.store_dir / self.key_prefix
+        self.year = year
+        self.origin_s = int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp())
+        self.n_rows = (
+            int(datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp()) - self.origin_s
+        ) // 60
+
+    @contextmanager
+    def _locked(self):
+        # one writer at a time, e.g. parallel local runs of several days
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.parent / f".{self.year}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _create(self, ds):
+        root = zarr.open_group(str(self.path), mode="w")
+        root.attrs.update({k: v for k, v in ds.attrs.items() if k not in DAY_ATTRS})
+        nfreq = ds.sizes["frequency"]
+
+        time = root.create_dataset(
+            "time",
+            data=self.origin_s + 60 * np.arange(self.n_rows, dtype="i8"),
+            chunks=(TIME_CHUNK,),
+            compressor=COMPRESSOR,
+            filters=[Delta(dtype="i8")],
+        )
+        frequency = root.create_dataset(
+            "frequency", data=ds["frequency"].values, compressor=COMPRESSOR
+        )
+        effort = root.create_dataset(
+            "effort",
+            shape=(self.n_rows,),
+            chunks=(MINUTES_PER_DAY,),
+            dtype="f4",
+            fill_value=0,
+            compressor=COMPRESSOR,
+        )
+        psd = root.create_dataset(
+            "psd",
+            shape=(self.n_rows, nfreq),
+            chunks=(MINUTES_PER_DAY, nfreq),
+            dtype="f4",
+            fill_value=np.nan,
+            compressor=COMPRESSOR,
+        )
+        for array, dims in [
+            (time, ["time"]),
+            (frequency, ["frequency"]),
+            (effort, ["time"]),
+            (psd, ["time", "frequency"]),
+        ]:
+            array.attrs.update(ds[array.basename].attrs)
+            array.attrs["_ARRAY_DIMENSIONS"] = dims
+        self._create_levels(root)
+
+    def _create_levels(self, root):
+        nfreq = root["frequency"].shape[0]
+        for minutes in PYRAMID_MINUTES:
+            level = root.create_group(f"levels/{minutes}")
+            n_bins = self.n_rows // minutes
+            chunk = MINUTES_PER_DAY // minutes
+            level.create_dataset(
+                "time",
+                data=self.origin_s + 60 * minutes * np.arange(n_bins, dtype="i8"),
+                chunks=(n_bins,),
+                compressor=COMPRESSOR,
+                filters=[Delta(dtype="i8")],
+            )
+            level.create_dataset("frequency", data=root["frequency"][:], compressor=COMPRESSOR)
+            level.create_dataset(
+                "effort",
+                shape=(n_bins,),
+                chunks=(chunk,),
+                dtype="f4",
+                fill_value=0,
+                compressor=COMPRESSOR,
+            )
+            for stat in PYRAMID_STATS:
+                level.create_dataset(
+                    f"psd_{stat}",
+                    shape=(n_bins, nfreq),
+                    chunks=(chunk, nfreq),
+                    dtype="f4",
+                    fill_value=np.nan,
+                    compressor=COMPRESSOR,
+                )
+            for name in level.array_keys():
+                base = "psd" if name.startswith("psd") else name
+                level[name].attrs.update(root[base].attrs)
+            for stat in PYRAMID_STATS:
+                level[f"psd_{stat}"].attrs["cell_methods"] = (
+                    f"time: {stat} ({minutes} minutes)"
+                )
+            level["effort"].attrs["cell_methods"] = f"time: sum ({minutes} minutes)"
+            level["effort"].attrs["long_name"] = (
+                f"Duration of input data available for each {minutes}-minute bin"
+            )
+
+    def _update_levels(self, root, days):
+        """recompute the pyramid bins of whole days from the one-minute rows"""
+        keys = set()
+        for day in days:
+            rows = slice(day * MINUTES_PER_DAY, (day + 1) * MINUTES_PER_DAY)
+            psd = root["psd"][rows]
+            effort = root["effort"][rows]
+            power = 10 ** (psd / 10)
+            for minutes in PYRAMID_MINUTES:
+                level = root[f"levels/{minutes}"]
+                shape = (MINUTES_PER_DAY // minutes, minutes, psd.shape[1])
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", RuntimeWarning)  # bins without data
+                    stats = {
+                        "mean": 10 * np.log10(np.nanmean(power.reshape(shape), axis=1)),
+                        "median": np.nanmedian(psd.reshape(shape), axis=1),
+                    }
+                bins = slice(rows.start // minutes, rows.stop // minutes)
+                for stat in PYRAMID_STATS:
+                    level[f"psd_{stat}"][bins] = stats[stat]
+                level["effort"][bins] = effort.reshape(shape[:2]).sum(axis=1)
+
+                chunk_rows = level["effort"].chunks[0]  # stores made before daily chunks
+                for chunk in range(
+                    bins.start // chunk_rows, (bins.stop - 1) // chunk_rows + 1
+                ):
+                    keys.add(f"levels/{minutes}/effort/{chunk}")
+                    keys.update(
+                        f"levels/{minutes}/psd_{stat}/{chunk}.0" for stat in PYRAMID_STATS
+                    )
+        return keys
+
+    def append(self, ds):
+        """
+        write one day of an HMB dataset opened with decode_times=False into its rows,
+        replacing whatever was there, and return the store keys that changed
+        """
+        rows = (ds["time"].values.astype("i8") - self.origin_s) // 60
+        if rows.min() < 0 or rows.max() >= self.n_rows:
+            raise ValueError(f"{ds['time'].values[0]} is not in {self.year}")
+
+        with self._locked():
+            created = not (self.path / ".zgroup").exists()
+            if created:
+                self._create(ds)
+            root = zarr.open_group(str(self.path), mode="r+")
+            if not np.array_equal(root["frequency"][:], ds["frequency"].values):
+                raise ValueError(
+                    f"frequency grid of {self.path} differs, use another store_dir per freq_lims"
+                )
+
+            root["psd"].set_orthogonal_selection((rows, slice(None)), ds["psd"].values)
+            root["effort"].set_orthogonal_selection(rows, ds["effort"].values)
+
+            days = np.unique(rows // MINUTES_PER_DAY)
+            if "levels" not in root:
+                # store from before the pyramid, build it from every day written so far
+                self._create_levels(root)
+                days = np.flatnonzero(
+                    root["effort"][:].reshape(-1, MINUTES_PER_DAY).sum(axis=1)
+                )
+                created = True
+            level_keys = self._update_levels(root, days)
+            zarr.consolidate_metadata(str(self.path))
+
+        if created:
+            return sorted(
+                str(p.relative_to(self.store_dir)) for p in self.path.rglob("*") if p.is_file()
+            )
+        keys = {".zmetadata"} | level_keys
+        for day in days:
+            keys.update([f"psd/{day}.0", f"effort/{day}"])
+        return sorted(f"{self.key_prefix}/{key}" for key in keys)
+
+
+def append_hmb_to_zarr(hyd_refdes, date, output_dir=Path("./output"), store_dir=ZARR_DIR):
+    """append the day's {instrument}_{YYYYMMDD}.nc to its yearly store, returns the keys written"""
+    logger = select_logger()
+    instrument = hyd_refdes[-9:]
+    day = datetime.strptime(date, "%Y/%m/%d")
+    nc_filename = Path(output_dir) / f"{instrument}_{day.strftime('%Y%m%d')}.nc"
+    if not nc_filename.exists():
+        logger.warning(f"{nc_filename} not found, nothing to append")
+        return []
+    with xr.open_dataset(
+        nc_filename, engine="h5netcdf", decode_times=False, decode_timedelta=False
+    ) as ds:
+        store = HmbZarrStore(instrument, day.year, store_dir)
+        keys = store.append(ds[["psd", "effort"]].load())
+    logger.info(f"appended {nc_filename} to {store.path} ({len(keys)} keys written)")
+    return keys
+
+
+def pyramid_level(start, end, width):
+    """
+    minutes per bin of the coarsest level with at least `width` bins between start and end,
+    None for the one-minute rows
+    """
+    span_minutes = (end - start).total_seconds() / 60
+    levels = [minutes for minutes in PYRAMID_MINUTES if span_minutes / minutes >= width]
+    return max(levels) if levels else None
+
+
+def open_hmb_range(hyd_refdes, start, end, store_dir=ZARR_DIR, width=None, stat="mean"):
+    """
+    HMB psd and effort between two datetimes, reading only the chunks that overlap. With a
+    `width` in pixels psd comes from the matching pyramid level, as its `stat` per bin.
+    """
+    instrument = hyd_refdes[-9:]
+    minutes = pyramid_level(start, end, width) if width else None
+    parts = []
+    for year in range(start.year, end.year + 1):
+        path = Path(store_dir) / instrument / f"{year}.zarr"
+        if not path.exists():
+            continue
+        if minutes is None:
+            ds = xr.open_zarr(path, chunks=None, consolidated=True)
+        else:
+            ds = xr.open_zarr(path, group=f"levels/{minutes}", chunks=None, consolidated=True)
+            ds = ds[[f"psd_{stat}", "effort"]].rename({f"psd_{stat}": "psd"})
+        parts.append(ds.sel(time=slice(start, end)).load())
+    if not parts:
+        return None
+    return xr.concat(parts, dim="time") if len(parts) > 1 else parts[0]
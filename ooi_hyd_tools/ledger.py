@@ -0,0 +1,190 @@
+import json
+import time
+import sqlite3
+import hashlib
+
+from pathlib import Path
+from contextlib import contextmanager
+
+"""
+Persistent ledger of the units of work of acoustic_flow_oneday, one SQLite row per
+(refdes, day, stage, parameter hash) and one row per output file with its size, mtime and
+sha256. Outputs are grouped by `source`, the archive mseed file they came from for the audio
+stage and "" for the day products, so a rerun can redo only the sources whose files went
+missing or changed. Connections are short lived, so parallel local runs can share one file.
+"""
+
+LEDGER_DB = "./output/ledger/runs.sqlite"
+HASH_CHUNK = 1 << 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    refdes TEXT, day TEXT, stage TEXT, params_hash TEXT, params TEXT,
+    status TEXT, started_at TEXT, finished_at TEXT,
+    PRIMARY KEY (refdes, day, stage, params_hash)
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    refdes TEXT, day TEXT, stage TEXT, params_hash TEXT, source TEXT,
+    path TEXT, size INTEGER, mtime_ns INTEGER, sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS outputs_unit ON outputs (refdes, day, stage, params_hash);
+"""
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def output_intact(path, size, mtime_ns, sha256):
+    """
+    whether a recorded output is still on disk as written. The checksum is only computed
+    again when the size matches but the mtime moved.
+    """
+    if path is None:  # the source produced nothing, e.g. a file with too large a gap
+        return True
+    try:
+        stat = Path(path).stat()
+    except FileNotFoundError:
+        return False
+    if stat.st_size != size:
+        return False
+    return stat.st_mtime_ns == mtime_ns or _sha256(path) == sha256
+
+
+class RunLedger:
+    def __init__(self, path=LEDGER_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            with db:  # one transaction
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def params_hash(params):
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+    def _key(self, refdes, day, stage, params):
+        return (refdes, day, stage, self.params_hash(params))
+
+    def start(self, refdes, day, stage, params):
+        key = self._key(refdes, day, stage, params)
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO units VALUES (?, ?, ?, ?, ?, 'running', ?, NULL)"
+                " ON CONFLICT (refdes, day, stage, params_hash)"
+                " DO UPDATE SET status = 'running', started_at = excluded.started_at",
+                (*key, json.dumps(params, sort_keys=True), _now()),
+            )
+
+    def finish(self, refdes, day, stage, params, outputs, status="done"):
+        """
+        record the outputs of a unit, {source: [paths]}, replacing what was recorded for those
+        sources before. Sources that produced nothing are given an empty list.
+        """
+        key = self._key(refdes, day, stage, params)
+        rows = []
+        for source, paths in outputs.items():
+            if not paths:
+                rows.append((*key, source, None, None, None, None))
+            for path in paths:
+                stat = Path(path).stat()
+                rows.append(
+                    (*key, source, str(path), stat.st_size, stat.st_mtime_ns, _sha256(path))
+                )
+        with self._connect() as db:
+            db.executemany(
+                "DELETE FROM outputs WHERE refdes = ? AND day = ? AND stage = ?"
+                " AND params_hash = ? AND source = ?",
+                [(*key, source) for source in outputs],
+            )
+            db.executemany("INSERT INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            db.execute(
+                "UPDATE units SET status = ?, finished_at = ? WHERE refdes = ? AND day = ?"
+                " AND stage = ? AND params_hash = ?",
+                (status, _now(), *key),
+            )
+
+    def fail(self, refdes, day, stage, params):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE units SET status = 'failed', finished_at = ? WHERE refdes = ?"
+                " AND day = ? AND stage = ? AND params_hash = ?",
+                (_now(), *self._key(refdes, day, stage, params)),
+            )
+
+    def run(self, refdes, day, stage, params, func, outputs=None):
+        """
+        run func() as a unit, recording `outputs(result)` ({source: [paths]}) when it returns.
+        None from `outputs` means nothing was produced (e.g. no data yet), the unit is then
+        recorded as empty and runs again next time.
+        """
+        self.start(refdes, day, stage, params)
+        try:
+            result = func()
+        except Exception:
+            self.fail(refdes, day, stage, params)
+            raise
+        recorded = outputs(result) if outputs else {}
+        if recorded is None:
+            self.finish(refdes, day, stage, params, {}, status="empty")
+        else:
+            self.finish(refdes, day, stage, params, recorded)
+        return result
+
+    def invalidate(self, refdes, day, stages):
+        """mark the units of `stages` stale after their inputs were rewritten"""
+        with self._connect() as db:
+            db.executemany(
+                "UPDATE units SET status = 'stale' WHERE refdes = ? AND day = ? AND stage = ?",
+                [(refdes, day, stage) for stage in stages],
+            )
+
+    def _status(self, db, key):
+        row = db.execute(
+            "SELECT status FROM units WHERE refdes = ? AND day = ? AND stage = ?"
+            " AND params_hash = ?",
+            key,
+        ).fetchone()
+        return row[0] if row else None
+
+    def intact_sources(self, refdes, day, stage, params):
+        """sources whose recorded outputs are all still intact"""
+        key = self._key(refdes, day, stage, params)
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT source, path, size, mtime_ns, sha256 FROM outputs WHERE refdes = ?"
+                " AND day = ? AND stage = ? AND params_hash = ?",
+                key,
+            ).fetchall()
+        bad = {source for source, *output in rows if not output_intact(*output)}
+        return {source for source, *_ in rows} - bad
+
+    def is_done(self, refdes, day, stage, params):
+        """finished before with these params and every output is intact"""
+        key = self._key(refdes, day, stage, params)
+        with self._connect() as db:
+            if self._status(db, key) != "done":
+                return False
+            rows = db.execute(
+                "SELECT path, size, mtime_ns, sha256 FROM outputs WHERE refdes = ?"
+                " AND day = ? AND stage = ? AND params_hash = ?",
+                key,
+            ).fetchall()
+        return all(output_intact(*output) for output in rows)
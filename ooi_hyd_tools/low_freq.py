@@ -1,4 +1,4 @@
-import pvlib
+import threading
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -9,10 +9,13 @@ import matplotlib.dates as md
 from datetime import datetime, timedelta
 from pathlib import Path
 from matplotlib import gridspec
+from matplotlib.ticker import FixedLocator, FuncFormatter
 from typing import Optional
 
 from ooipy.request.hydrophone_request import get_acoustic_data_LF
 
+from ooi_hyd_tools.solar import solar_elevation
+
 LOW_FREQ_DICT = {
     "RS01SLBS-MJ01A-05-HYDLFA101": ["HYSB1", (44.50829, -125.40466)],
     "RS03AXBS-MJ03A-05-HYDLFA301": ["AXBA1", (45.82051, -129.73671)],
@@ -20,6 +23,199 @@ LOW_FREQ_DICT = {
     "RS03CCAL-MJ03F-06-HYDLFA305": ["AXCC1", (45.95479, -130.00932)],
     "RS03ECAL-MJ03E-09-HYDLFA304": ["AXEC2", (45.93997, -129.73383)],
 }
+PSD_LABEL = r"Spectrum level (dB re 1 $\mu$Pa$\mathregular{^{2}}$ Hz$\mathregular{^{-1}}$)"
+FREQ_LABEL = "Frequency (Hz)"
+PCT_LEVELS = np.array([1, 10, 25, 50, 75, 90, 99])
+PCT_LABELS = ["L99", "L90", "L75", "L50", "L25", "L10", "L1"]
+FREQ_PIXELS = 600  # rows of the raster spectrogram, about the panel height at 200 dpi
+
+_templates = threading.local()  # matplotlib figures are not thread safe, one set per thread
+
+
+def solar_shading(ds, lat_lon_for_solpos):
+    """
+    solar elevation at ds.time and its gray scale for the day/night bar (1 day, 0 night),
+    plus the indices of the lowest and highest sun for the labels
+    """
+    # looked up in the per-site minute table instead of running the SPA for every plot
+    solpos = solar_elevation(ds.time.values, lat_lon_for_solpos).to_frame()
+    se = solpos.elevation  # isolate solar elevation
+    # map elevation to gray scale
+    seg = 0 * se  # 0 covers nighttime (black)
+    # day (white)
+    d = np.squeeze(np.where(se > 0))
+    seg.iloc[d] = 1
+    # dusk / dawn (gray range)
+    d = np.squeeze(np.where(np.logical_and(se <= 0, se >= -12)))
+    seg.iloc[d] = 1 - abs(
+        se.iloc[d] / np.max(abs(se.iloc[d]), 0)
+    )  # TODO np.max in mbari version?
+    # TODO before the line above would error if only times at night...
+    # Get the indices of the min and max
+    seg1 = pd.Series.to_numpy(solpos.elevation)
+    minidx = np.squeeze(np.where(seg1 == min(seg1)))
+    maxidx = np.squeeze(np.where(seg1 == max(seg1)))
+    return solpos, seg, minidx, maxidx
+
+
+def psd_percentiles(ds):
+    pctls = np.empty((PCT_LEVELS.size, ds.frequency.size))
+    np.nanpercentile(ds.psd, PCT_LEVELS, axis=0, out=pctls)
+    return pctls
+
+
+class SummaryTemplate:
+    """
+    The figure of plot_dataset_summary built once for a layout, with the spectrogram drawn as
+    an image on a fixed frequency pixel grid. `render` only swaps the data of the existing
+    artists, so drawing many days costs about one image resample and savefig each.
+    On a log scale the image axis is linear in log10(frequency) with decade ticks, because
+    images are not resampled onto nonlinear axes.
+    """
+
+    def __init__(self, ylim, yscale, cmlim, cmap):
+        self.yscale = yscale
+        self.log = yscale == "log"
+        lo, hi = ylim
+        if self.log:
+            self.pixel_freqs = np.logspace(np.log10(lo), np.log10(hi), FREQ_PIXELS)
+            self.extent_y = (np.log10(lo), np.log10(hi))
+        else:
+            self.pixel_freqs = np.linspace(lo, hi, FREQ_PIXELS)
+            self.extent_y = (lo, hi)
+
+        self.fig = plt.figure()
+        self.fig.set_figheight(6)
+        self.fig.set_figwidth(12)
+        spec = gridspec.GridSpec(
+            ncols=2,
+            nrows=2,
+            width_ratios=[2.5, 1],
+            wspace=0.02,
+            height_ratios=[0.045, 0.95],
+            hspace=0.09,
+        )
+        self.fig.subplots_adjust(left=0.06, right=0.94, bottom=0.12, top=0.89)
+
+        # Spectrogram
+        self.ax0 = self.fig.add_subplot(spec[2])
+        vmin, vmax = cmlim
+        self.image = self.ax0.imshow(
+            np.full((FREQ_PIXELS, 2), np.nan),
+            origin="lower",
+            aspect="auto",
+            interpolation="nearest",
+            cmap=cmap,
+            vmin=vmin,
+            vmax=vmax,
+            extent=(0, 1, *self.extent_y),
+        )
+        self.ax0.set_ylim(self.extent_y)
+        self.ax0.set_ylabel(FREQ_LABEL)
+        self.ax0.set_xticks([])
+        if self.log:
+            decades = np.arange(np.ceil(self.extent_y[0]), np.floor(self.extent_y[1]) + 1)
+            self.ax0.yaxis.set_major_locator(FixedLocator(decades))
+            self.ax0.yaxis.set_major_formatter(FuncFormatter(lambda y, _: f"$10^{{{y:.0f}}}$"))
+
+        # Percentile
+        self.ax1 = self.fig.add_subplot(spec[3])
+        self.ax1.yaxis.tick_right()
+        self.ax1.yaxis.set_label_position("right")
+        self.pct_lines = self.ax1.plot(np.zeros((2, PCT_LEVELS.size)), [lo, hi], linewidth=1)
+        self.ax1.set_yscale(yscale)
+        self.ax1.set_ylim(list(ylim))
+        self.ax1.set_xlabel(PSD_LABEL)
+        self.ax1.set_ylabel(FREQ_LABEL)
+        self.ax1.legend(loc="lower left", labels=PCT_LABELS)
+
+        # day night, in sample index coordinates like the pcolormesh version
+        self.ax3 = self.fig.add_subplot(spec[0])
+        self.day_night = self.ax3.imshow(
+            np.zeros((1, 2)), aspect="auto", cmap="gray", vmin=0, vmax=1, extent=(0, 2, 0, 50)
+        )
+        self.ax3.set_ylim(0, 50)
+        self.day_label = self.ax3.annotate(
+            "Day", (0, 25), weight="bold", ha="center", va="center"
+        )
+        self.night_label = self.ax3.annotate(
+            "Night", (0, 25), weight="bold", color="white", ha="center", va="center"
+        )
+        self.ax3.set_xticks([])
+        self.ax3.set_yticks([])
+
+        # colorbar for spectrogram
+        r = np.concatenate(np.squeeze(self.ax0.get_position()))
+        cb_ax = self.fig.add_axes([r[0] + 0.09, r[1] - 0.025, r[2] - 0.25, 0.015])
+        q = self.fig.colorbar(self.image, orientation="horizontal", cax=cb_ax)
+        q.set_label(PSD_LABEL)
+
+        # time axes for the day/night panel
+        self.timax = self.fig.add_axes(self.ax3.get_position(), frameon=False)
+        self.timax.tick_params(top=True, labeltop=True, bottom=False, labelbottom=False)
+        self.timax.set_ylim(0, 100)
+        self.timax.set_yticks([])
+        self.timax.xaxis_date()
+        locator = md.AutoDateLocator()
+        self.timax.xaxis.set_major_locator(locator)
+        self.timax.xaxis.set_major_formatter(md.ConciseDateFormatter(locator))
+
+        self.title = self.fig.text(0.5, 0.955, "", fontsize=14, horizontalalignment="center")
+        self.fig.text(0.65, 0.91, "UTC")
+
+    def rasterize(self, ds):
+        """psd resampled to the pixel grid, frequency rows by time columns"""
+        frequency = ds["frequency"].values
+        # nearest source bin for every pixel row, in the plotted coordinate
+        if self.log:
+            src, dst = np.log10(np.clip(frequency, 1e-12, None)), np.log10(self.pixel_freqs)
+        else:
+            src, dst = frequency, self.pixel_freqs
+        idx = np.clip(np.searchsorted(src, dst), 1, len(src) - 1)
+        idx -= dst - src[idx - 1] < src[idx] - dst
+        image = ds["psd"].values[:, idx].T
+        # rows outside the data are blank
+        image[(self.pixel_freqs < frequency[0]) | (self.pixel_freqs > frequency[-1])] = np.nan
+        return image
+
+    def render(self, ds, lat_lon_for_solpos, title, jpeg_filename=None, dpi=200):
+        _, seg, minidx, maxidx = solar_shading(ds, lat_lon_for_solpos)
+        time_values = md.date2num(ds["time"].values)
+        # same x limits as pcolormesh with shading="nearest", half a step past the ends
+        half_step = (time_values[-1] - time_values[0]) / max(len(time_values) - 1, 1) / 2
+        xl = (time_values[0] - half_step, time_values[-1] + half_step)
+
+        self.image.set_data(self.rasterize(ds))
+        self.image.set_extent((*xl, *self.extent_y))
+        self.ax0.set_xlim(xl)
+
+        for line, pctl in zip(self.pct_lines, psd_percentiles(ds)):
+            line.set_data(pctl, ds.frequency)
+        self.ax1.relim()
+        self.ax1.autoscale_view(scalex=True, scaley=False)
+
+        n = len(seg)
+        self.day_night.set_data(np.asarray(seg, dtype=float)[np.newaxis, :])
+        self.day_night.set_extent((0, n, 0, 50))
+        self.ax3.set_xlim(0, n)
+        self.day_label.set_position((maxidx, 25))
+        self.night_label.set_position((minidx, 25))
+
+        self.timax.set_xlim(xl)
+        self.title.set_text(title)
+
+        if jpeg_filename is not None:
+            self.fig.savefig(jpeg_filename, dpi=dpi)
+
+
+def summary_template(ylim, yscale, cmlim, cmap):
+    """the cached SummaryTemplate of a layout for the calling thread"""
+    if not hasattr(_templates, "cache"):
+        _templates.cache = {}
+    key = (tuple(ylim), yscale, tuple(cmlim), cmap)
+    if key not in _templates.cache:
+        _templates.cache[key] = SummaryTemplate(ylim, yscale, cmlim, cmap)
+    return _templates.cache[key]
 
 
 # TODO just call the packaged mbari function one changes are merged to mbari-pbp
@@ -35,6 +231,7 @@ def plot_dataset_summary(
     cmap: str = "rainbow",
     jpeg_filename: Optional[str] = None,
     show: bool = False,
+    render: str = "mesh",
 ):
     """
     Generate a summary plot from the given dataset.
@@ -46,49 +243,34 @@ def plot_dataset_summary(
     :param dpi: DPI to use for the plot.
     :param jpeg_filename: If given, filename to save the plot to.
     :param show: Whether to show the plot.
+    :param render: "mesh" builds a new figure with pcolormesh, "raster" redraws a cached
+        figure with the spectrogram as an image, much faster over many days.
     """
     plt.rcParams["text.usetex"] = False
     plt.rcParams["axes.edgecolor"] = "black"
 
+    if render == "raster":
+        template = summary_template(ylim, yscale, cmlim, cmap)
+        template.render(ds, lat_lon_for_solpos, title, jpeg_filename, dpi)
+        if show:
+            plt.show()
+        return
+
     # Transpose psd array for plotting
     da = xr.DataArray.transpose(ds.psd)
 
     # get solar elevation
-    # Estimate the solar position with a specific SPA defined with the argument 'method'
-    latitude, longitude = lat_lon_for_solpos
-    solpos = pvlib.solarposition.get_solarposition(
-        ds.time, latitude=latitude, longitude=longitude
-    )
-    se = solpos.elevation  # isolate solar elevation
-    # map elevation to gray scale
-    seg = 0 * se  # 0 covers nighttime (black)
-    # day (white)
-    d = np.squeeze(np.where(se > 0))
-    seg.iloc[d] = 1
-    # dusk / dawn (gray range)
-    d = np.squeeze(np.where(np.logical_and(se <= 0, se >= -12)))
-    seg.iloc[d] = 1 - abs(
-        se.iloc[d] / np.max(abs(se.iloc[d]), 0)
-    )  # TODO np.max in mbari version?
-    # TODO before the line above would error if only times at night...
-    # Get the indices of the min and max
-    seg1 = pd.Series.to_numpy(solpos.elevation)
-    minidx = np.squeeze(np.where(seg1 == min(seg1)))
-    maxidx = np.squeeze(np.where(seg1 == max(seg1)))
+    solpos, seg, minidx, maxidx = solar_shading(ds, lat_lon_for_solpos)
 
     seg3 = np.tile(seg, (50, 1))
 
     # plotting variables
 
-    psdlabl = r"Spectrum level (dB re 1 $\mu$Pa$\mathregular{^{2}}$ Hz$\mathregular{^{-1}}$)"
-    freqlabl = "Frequency (Hz)"
+    psdlabl = PSD_LABEL
+    freqlabl = FREQ_LABEL
 
-    # define percentiles
-    pctlev = np.array([1, 10, 25, 50, 75, 90, 99])
-    # initialize output array
-    pctls = np.empty((pctlev.size, ds.frequency.size))
     # get percentiles
-    np.nanpercentile(ds.psd, pctlev, axis=0, out=pctls)
+    pctls = psd_percentiles(ds)
 
     # create a figure
     fig = plt.figure()
@@ -125,7 +307,7 @@ def plot_dataset_summary(
     # plt.colorbar(location='left', shrink = 0.25, fraction = 0.05)
 
     # Percentile
-    pplabels = ["L99", "L90", "L75", "L50", "L25", "L10", "L1"]
+    pplabels = PCT_LABELS
     ax1 = fig.add_subplot(spec[3])
     ax1.yaxis.tick_right()
     ax1.yaxis.set_label_position("right")
@@ -174,6 +356,7 @@ def run_low_freq_oneday(
     hyd_refdes,
     date,
     logger,
+    render="mesh",
 ):
     output_dir = Path("./output")
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -208,4 +391,5 @@ def run_low_freq_oneday(
         yscale="linear",
         cmap="inferno",
         show=True,
+        render=render,
     )
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import resource
+import threading
+import numpy as np
+
+from pathlib import Path
+from contextlib import contextmanager
+from prefect.artifacts import create_markdown_artifact
+
+"""
+Per-run performance metrics of acoustic_flow_oneday. A RunMetrics records the wall and CPU
+time and the peak resident memory of every stage, distributions of per-file durations
+(fetch, decode, repair, encode, HTTP latency) and counters such as bytes downloaded and
+files per CASE, and writes them as one JSON report per run. Code deeper in the pipeline
+reports through the module level stage/observe/count helpers, which do nothing unless a run
+is active in this process. Memory of process pool workers is not included.
+"""
+
+METRICS_DIR = "./output/metrics"
+RSS_SAMPLE_S = 0.1
+# per-file timing keys of HydrophoneDay.timings that are summarized in the report
+FILE_TIMINGS = ["fetch_s", "preflight_s", "decode_s", "repair_s", "total_s"]
+
+_current = None  # RunMetrics of the run active in this process
+
+
+def current_rss_mb():
+    """resident memory of this process, the lifetime peak where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if os.uname().sysname == "Darwin" else peak / 1024
+
+
+class _RssSampler(threading.Thread):
+    """samples resident memory in the background and keeps the maximum"""
+
+    def __init__(self, interval=RSS_SAMPLE_S):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_mb = current_rss_mb()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+        return self.peak_mb
+
+
+def summarize(values):
+    values = np.asarray(values, dtype=float)
+    if not values.size:
+        return {"count": 0}
+    return {
+        "count": int(values.size),
+        "sum": round(float(values.sum()), 3),
+        "mean": round(float(values.mean()), 3),
+        "median": round(float(np.median(values)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3),
+        "max": round(float(values.max()), 3),
+    }
+
+
+class RunMetrics:
+    def __init__(self, hyd_refdes, date, flag):
+        self.hyd_refdes = hyd_refdes
+        self.date = date
+        self.flag = flag
+        self.started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.stages = {}  # name -> wall_s, cpu_s, peak_rss_mb
+        self.observations = {}  # name -> [values]
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._samplers = []  # of the stages running now
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """time a stage, a stage run more than once adds up and keeps the highest peak"""
+        sampler = _RssSampler()
+        sampler.start()
+        with self._lock:
+            self._samplers.append(sampler)
+        t0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall_s, cpu_s = time.perf_counter() - t0, time.process_time() - cpu0
+            peak_mb = sampler.stop()
+            with self._lock:
+                self._samplers.remove(sampler)
+                for enclosing in self._samplers:  # a nested stage's peak counts for its parent
+                    enclosing.peak_mb = max(enclosing.peak_mb, peak_mb)
+                entry = self.stages.setdefault(
+                    name, {"wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0}
+                )
+                entry["wall_s"] += wall_s
+                entry["cpu_s"] += cpu_s
+                entry["peak_rss_mb"] = max(entry["peak_rss_mb"], peak_mb)
+
+    def observe(self, name, *values):
+        with self._lock:
+            self.observations.setdefault(name, []).extend(values)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_file_timings(self, timings):
+        """per-file timings from HydrophoneDay.timings"""
+        for timing in timings:
+            for key in FILE_TIMINGS:
+                if key in timing:
+                    self.observe(key, timing[key])
+            if timing.get("case") is not None:
+                self.count(f"case_{timing['case']}")
+            if timing.get("bytes") is not None:
+                self.count("bytes_downloaded", timing["bytes"])
+            self.count("files")
+
+    def report(self):
+        with self._lock:
+            stages = {
+                name: {k: round(v, 3) for k, v in entry.items()}
+                for name, entry in self.stages.items()
+            }
+            return {
+                "hyd_refdes": self.hyd_refdes,
+                "date": self.date,
+                "flag": self.flag,
+                "started_at": self.started_at,
+                "wall_s": round(time.perf_counter() - self._t0, 3),
+                "host": {"cpus": os.cpu_count(), "pid": os.getpid()},
+                "stages": stages,
+                "durations": {
+                    name: summarize(values) for name, values in self.observations.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def write(self, metrics_dir=METRICS_DIR):
+        report = self.report()
+        metrics_dir = Path(metrics_dir)
+        metrics_dir.mkdir(parents=True, exist_ok=True)
+        day_str = self.date.replace("/", "")
+        path = metrics_dir / f"{self.hyd_refdes[-9:]}_{day_str}_{self.flag}.json"
+        path.write_text(json.dumps(report, indent=2))
+        return path, report
+
+
+def markdown_report(report):
+    """the stage table and file counters of a report, for a Prefect artifact"""
+    lines = [
+        f"### {report['hyd_refdes']} {report['date']} ({report['flag']})",
+        "",
+        "| stage | wall s | cpu s | peak RSS MB |",
+        "|---|---|---|---|",
+    ]
+    for name, entry in report["stages"].items():
+        lines.append(
+            f"| {name} | {entry['wall_s']:.1f} | {entry['cpu_s']:.1f}"
+            f" | {entry['peak_rss_mb']:.0f} |"
+        )
+    lines += ["", "| metric | value |", "|---|---|"]
+    for name, value in report["counters"].items():
+        lines.append(f"| {name} | {value} |")
+    for name, summary in report["durations"].items():
+        if summary["count"]:
+            lines.append(
+                f"| {name} | median {summary['median']} s, max {summary['max']} s"
+                f" over {summary['count']} |"
+            )
+    return "\n".join(lines)
+
+
+def publish_artifact(report):
+    """attach a report to the running flow as a markdown artifact"""
+    key = f"metrics-{report['hyd_refdes'][-9:]}-{report['date'].replace('/', '')}".lower()
+    create_markdown_artifact(
+        markdown_report(report), key=key, description=f"{report['flag']} run metrics"
+    )
+
+
+def start_run(hyd_refdes, date, flag):
+    global _current
+    _current = RunMetrics(hyd_refdes, date, flag)
+    return _current
+
+
+def end_run():
+    global _current
+    _current = None
+
+
+@contextmanager
+def stage(name):
+    """time a stage of the active run, a no-op without one"""
+    if _current is None:
+        yield
+        return
+    with _current.stage(name):
+        yield
+
+
+def observe(name, *values):
+    if _current is not None:
+        _current.observe(name, *values)
+
+
+def count(name, n=1):
+    if _current is not None:
+        _current.count(name, n)
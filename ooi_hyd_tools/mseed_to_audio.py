@@ -1,4 +1,10 @@
+import io
+import os
+import json
+import math
+import time
 import fsspec
+import threading
 import concurrent.futures
 import obspy as obs
 import numpy as np
@@ -6,17 +12,27 @@ import multiprocessing as mp
 import soundfile as sf
 import matplotlib.pyplot as plt
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from tqdm import tqdm
 from pathlib import Path
 from prefect import task, flow
+from prefect.tasks import task_input_hash
 from importlib.metadata import distributions
+from multiprocessing import shared_memory
 
 from ooi_hyd_tools.audio_to_spec import audio_to_spec
 from ooi_hyd_tools.low_freq import run_low_freq_oneday
 from ooi_hyd_tools.cloud import sync_png_nc_to_s3
 from ooi_hyd_tools.utils import select_logger
 from ooi_hyd_tools.seismometer import run_obs_viz
+from ooi_hyd_tools.cache import MseedCache, ListingIndex, CACHE_MAX_GB
+from ooi_hyd_tools.archive import day_url, list_mseed_entries, RAW_DATA_URL
+from ooi_hyd_tools.fetch import AsyncFetcher, MAX_PER_HOST, REQUEST_RATE
+from ooi_hyd_tools.verify import verify_segment, write_hashed_wav, write_verification_report
+from ooi_hyd_tools.hmb import HmbAccumulator, hmb_to_spec
+from ooi_hyd_tools.hmb_zarr import append_hmb_to_zarr
+from ooi_hyd_tools.ledger import RunLedger
+from ooi_hyd_tools import metrics
 
 
 """
@@ -42,17 +58,77 @@ NORMALIZE_TRACES
 NOTE See cli in pipeline.py for additional help and context.
 """
 
+SEGMENT_SAMPLES = 19_200_000  # 5 minutes at 64 kHz
+JITTER_SAMPLES = 640  # files within this many samples of SEGMENT_SAMPLES are CASE A
+MAX_IN_FLIGHT = 4  # default number of segments held in memory when streaming
+MEM_BUDGET_MB = 4096  # default memory budget for in-flight segments when streaming
+ENCODE_WORKERS = 4  # default FLAC/WAV encoder threads for the pipelined writer
+SEGMENT_CACHE_DAYS = 30  # how long the cached result of a converted file is reused
 
-def _map_concurrency(func, iterator, args=(), max_workers=-1, verbose=False):
-    # automatically set max_workers to 2x(available cores)
+
+def _segment_nbytes(format):
+    """approximate peak bytes held for one 5 minute segment while it is repaired"""
+    itemsize = (
+        np.dtype(np.float64).itemsize if format == "FLOAT" else np.dtype(np.int32).itemsize
+    )
+    # decoded stream plus the merged copy made in _merge_by_timestamps
+    return 2 * SEGMENT_SAMPLES * itemsize
+
+
+def _make_executor(backend, max_workers, hyd=None):
+    if backend == "process":
+        # spawn rather than fork, prefect keeps threads running in the parent
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_process_worker,
+            initargs=(hyd,),
+        )
+    if backend == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    raise ValueError(f"Invalid backend {backend}. Please specify 'thread' or 'process'")
+
+
+def _preflight_case(ids, starts, ends, deltas, npts, fudge_factor):
+    """
+    Vectorized CASE A/B/C decision from trace headers alone, following the same rules as
+    counting samples and then `st.get_gaps()` on a fully decoded stream. Times are POSIX
+    seconds, one entry per trace.
+    """
+    if abs(int(npts.sum()) - SEGMENT_SAMPLES) <= JITTER_SAMPLES:
+        return "A"
+
+    order = np.lexsort((starts, ids))
+    ids, starts, ends, deltas = ids[order], starts[order], ends[order], deltas[order]
+
+    # gap between consecutive traces of the same channel, as in obspy's Stream.get_gaps
+    stime = np.minimum(ends[:-1], ends[1:])
+    gap = starts[1:] - (stime + deltas[:-1])
+    coverage = ends[1:] - starts[1:]
+    gap = np.where((gap < 0) & (-gap > coverage), -coverage, gap)
+    nsamples = np.round(np.abs(gap) / deltas[:-1])
+    counted = (ids[:-1] == ids[1:]) & ~((deltas[:-1] == deltas[1:]) & (nsamples == 0))
+
+    if np.any(np.abs(gap[counted]) > fudge_factor):
+        return "B"
+    return "C"
+
+
+def _map_concurrency(
+    func, iterator, args=(), max_workers=-1, verbose=False, backend="thread", hyd=None
+):
+    # automatically set max_workers to 2x(available cores) for threads, 1x for processes
     if max_workers == -1:
-        max_workers = min(24, 2 * mp.cpu_count())
+        if backend == "process":
+            max_workers = mp.cpu_count()
+        else:
+            max_workers = min(24, 2 * mp.cpu_count())
         print(f"Max workers: {max_workers}")
 
-    results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Start the load operations and mark each future with its URL
-        future_to_url = {executor.submit(func, i, args): i for i in iterator}
+    results = [None] * len(iterator)
+    with _make_executor(backend, max_workers, hyd) as executor:
+        # Start the load operations and mark each future with its position
+        future_to_url = {executor.submit(func, i, args): n for n, i in enumerate(iterator)}
         # Disable progress bar
         is_disabled = not verbose
         for future in tqdm(
@@ -60,11 +136,68 @@ def _map_concurrency(func, iterator, args=(), max_workers=-1, verbose=False):
             total=len(iterator),
             disable=is_disabled,
         ):
-            data = future.result()
-            results.append(data)
+            # keep input order so results don't depend on thread completion
+            results[future_to_url[future]] = future.result()
     return results
 
 
+# HydrophoneDay copy owned by each process pool worker, set once by the pool initializer
+_WORKER_HYD = None
+
+
+def _init_process_worker(hyd):
+    global _WORKER_HYD
+    _WORKER_HYD = hyd
+
+
+def _process_repair_worker(url, format):
+    """
+    Decode and repair one mseed file in a worker process. The repaired samples are
+    merged directly into a shared memory block instead of being pickled, only the
+    block name, dtype and trace header cross the process boundary.
+    """
+    hyd = _WORKER_HYD
+    blocks = []
+
+    def allocate(shape, dtype):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        blocks.append(shm)
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    cs = hyd._deal_with_gaps_and_overlaps(url, format, allocate=allocate)
+    timing = hyd.timings.pop()
+    if cs is None:
+        return None, timing
+
+    data = cs[0].data
+    shm_info = (blocks[-1].name, data.dtype.str, data.shape, dict(cs[0].stats))
+    del cs, data  # the block can only be closed once no array views it
+    for shm in blocks:
+        shm.close()
+    for shm in blocks[:-1]:
+        shm.unlink()
+    return shm_info, timing
+
+
+def _stream_from_shared_memory(name, dtype, shape, header):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return obs.Stream(traces=obs.Trace(data, header=header))
+
+
+def _discard_shared_memory(result):
+    shm_info, _ = result
+    if shm_info is not None:
+        shm = shared_memory.SharedMemory(name=shm_info[0])
+        shm.close()
+        shm.unlink()
+
+
 class HydrophoneDay:
     def __init__(
         self,
@@ -72,43 +205,43 @@ class HydrophoneDay:
         str_date,
         fudge_factor,
         clean_list=None,
+        cache=None,
+        index=None,
+        fetcher=None,
+        preflight=False,
+        mseed_urls=None,
+        base_url=RAW_DATA_URL,
     ):
         self.refdes = refdes
         self.date = datetime.strptime(str_date, "%Y/%m/%d")
         self.fudge_factor = fudge_factor
-        self.mseed_urls = self.get_mseed_urls(str_date, refdes)
+        self.cache = cache  # optional MseedCache for raw archive downloads
+        self.index = index  # optional ListingIndex for archive directory listings
+        self.fetcher = fetcher  # optional AsyncFetcher for pooled, rate limited downloads
+        self.preflight = preflight  # classify files from headers before decoding samples
+        self.base_url = base_url  # the OOI raw data archive, a mirror or a local stand-in
+        # pass mseed_urls to work on known files without listing the archive again
+        self.mseed_urls = mseed_urls or self.get_mseed_urls(str_date, refdes)
         self.clean_list = clean_list
+        self.timings = []
+        self.verification = []
+        self.segment_files = {}  # index in mseed_urls -> audio files written from it
         self.file_str = f"{self.refdes}_{self.date.strftime('%Y_%m_%d')}"
 
     def get_mseed_urls(self, day_str, refdes):
-        base_url = "https://rawdata.oceanobservatories.org/files"
-        mainurl = f"{base_url}/{refdes[0:8]}/{refdes[9:14]}/{refdes[18:27]}/{day_str}/"
-        FS = fsspec.filesystem("http")
-        print(mainurl)
+        print(day_url(refdes, day_str, self.base_url))
         print(Path.cwd())
 
         try:
-            data_url_list = sorted(
-                f["name"]
-                for f in FS.ls(mainurl)
-                if f["type"] == "file" and f["name"].endswith(".mseed")
-            )
-
-            try:
-                addendum_list = sorted(
-                    f["name"]
-                    for f in FS.ls(f"{mainurl}/addendum")
-                    if f["type"] == "file" and f["name"].endswith(".mseed")
-                )
-            except Exception:
-                print(f"No addendum for {day_str}")
-                addendum_list = []
-
+            if self.index is not None:
+                entries = self.index.get(refdes, day_str)
+            else:
+                entries = list_mseed_entries(refdes, day_str, self.base_url)
         except Exception as e:
             print("Client response: ", str(e))
             return None
 
-        data_url_list.extend(addendum_list)
+        data_url_list = [e["name"] for e in entries]
 
         if not data_url_list:
             print("No Data Available for Specified Time")
@@ -116,9 +249,19 @@ class HydrophoneDay:
 
         return data_url_list
 
-    def read_and_repair_gaps(self, format):
+    def read_and_repair_gaps(self, format, backend="thread"):
         if self.mseed_urls is None:
             return None
+        elif backend == "process":
+            results = _map_concurrency(
+                func=_process_repair_worker,
+                args=format,
+                iterator=self.mseed_urls,
+                verbose=False,
+                backend=backend,
+                hyd=self,
+            )
+            self.clean_list = [self._unpack_process_result(result) for result in results]
         else:
             self.clean_list = _map_concurrency(
                 func=self._deal_with_gaps_and_overlaps,
@@ -127,45 +270,201 @@ class HydrophoneDay:
                 verbose=False,
             )
 
-    def _merge_by_timestamps(self, st):
-        cs = st.copy()
+    def _submit_repair(self, executor, backend, url, format):
+        if backend == "process":
+            return executor.submit(_process_repair_worker, url, format)
+        return executor.submit(self._deal_with_gaps_and_overlaps, url, format)
+
+    def _unpack_process_result(self, result):
+        shm_info, timing = result
+        timing["backend"] = "process"
+        self.timings.append(timing)
+        if shm_info is None:
+            return None
+        return _stream_from_shared_memory(*shm_info)
+
+    def timing_summary(self):
+        """summarize per-file timings, in seconds, for comparing backends"""
+        if not self.timings:
+            return {}
+        summary = {"files": len(self.timings)}
+        for key in ["fetch_s", "preflight_s", "decode_s", "read_s", "repair_s", "total_s"]:
+            values = np.array([t[key] for t in self.timings if key in t])
+            if values.size:
+                summary[key] = {
+                    "sum": float(values.sum()),
+                    "mean": float(values.mean()),
+                    "median": float(np.median(values)),
+                    "max": float(values.max()),
+                }
+        summary["cases"] = {
+            case: sum(1 for t in self.timings if t["case"] == case) for case in ["A", "B", "C"]
+        }
+        return summary
+
+    def iter_repaired(
+        self,
+        format,
+        max_in_flight=MAX_IN_FLIGHT,
+        mem_budget_mb=MEM_BUDGET_MB,
+        backend="thread",
+        with_index=False,
+    ):
+        """
+        Yield repaired streams one at a time while holding at most a bounded number of
+        segments in memory. The in-flight window is the smaller of `max_in_flight` and
+        the number of segments that fit in `mem_budget_mb`. Streams come out in completion
+        order, `with_index` yields (position in mseed_urls, stream) pairs instead.
+        """
+        if self.mseed_urls is None:
+            return
 
-        data = []
-        for tr in cs:
-            data.append(tr.data)
-        data_cat = np.concatenate(data)
+        window = min(max_in_flight, (mem_budget_mb * 1024**2) // _segment_nbytes(format))
+        window = max(1, int(window))
+        print(f"Streaming with {window} segments in flight")
 
-        stats = dict(cs[0].stats)
+        urls = enumerate(self.mseed_urls)
+        index = {}
+        with _make_executor(backend, window, self) as executor:
+            pending = set()
+            for n, url in urls:
+                future = self._submit_repair(executor, backend, url, format)
+                index[future] = n
+                pending.add(future)
+                if len(pending) >= window:
+                    break
+
+            try:
+                while pending:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        # refill the window before handing the result downstream
+                        n, url = next(urls, (None, None))
+                        if url is not None:
+                            refill = self._submit_repair(executor, backend, url, format)
+                            index[refill] = n
+                            pending.add(refill)
+                        if backend == "process":
+                            st = self._unpack_process_result(future.result())
+                        else:
+                            st = future.result()
+                        yield (index.pop(future), st) if with_index else st
+            finally:
+                if backend == "process":
+                    # release shared memory for results nobody will consume
+                    for future in pending:
+                        if not future.cancel() and future.exception() is None:
+                            _discard_shared_memory(future.result())
+
+    def _merge_by_timestamps(self, st, allocate=np.empty):
+        """
+        Concatenate traces into a single buffer sized from the summed trace lengths.
+        Each trace is copied straight into its slice of the output and released, so
+        the stream is never deep copied. `allocate(shape, dtype)` lets callers supply
+        the output buffer, e.g. a block of shared memory.
+        """
+        npts = sum(len(tr.data) for tr in st)
+        data_cat = allocate((npts,), st[0].data.dtype)
+
+        stats = dict(st[0].stats)
         stats["starttime"] = st[0].stats["starttime"]
         stats["endtime"] = st[-1].stats[
             "endtime"
         ]  # TODO we may want to set the endtime based on n datapoints and not just the endtime of the last trace
-        stats["npts"] = len(data_cat)
+        stats["npts"] = npts
+
+        offset = 0
+        for tr in st:
+            n = len(tr.data)
+            data_cat[offset : offset + n] = tr.data
+            offset += n
+            tr.data = tr.data[:0]  # drop the decoded trace as soon as it is copied
 
         cs = obs.Stream(traces=obs.Trace(data_cat, header=stats))
 
         return cs
 
-    def _deal_with_gaps_and_overlaps(self, url, format):
+    def _deal_with_gaps_and_overlaps(self, url, format, allocate=np.empty):
         if format not in ["PCM_32", "PCM_24", "FLOAT"]:
             raise ValueError("Invalid wav data subtype. Please specify 'PCM_32' or 'FLOAT'")
-        # first read in mseed
-        if format == "PCM_32" or format == "PCM_24":
-            st = obs.read(url, apply_calib=False, dtype=np.int32)
-        if format == "FLOAT":
-            st = obs.read(url, apply_calib=False, dtype=np.float64)
+        t0 = time.perf_counter()
+        timing = {"url": url, "backend": "thread", "pid": os.getpid()}
+        case = None
+        # fetch once, time the download apart from decoding
+        data = self._fetch_mseed(url)
+        t_fetch = time.perf_counter()
+        timing.update(fetch_s=t_fetch - t0, bytes=len(data))
+        if self.preflight:
+            # check headers and only decode samples for files we will write
+            case = self._preflight(data)
+            timing["preflight_s"] = time.perf_counter() - t_fetch
+            if case == "B":
+                print(f"{url}: preflight found large gaps, skipping decode")
+                t1 = time.perf_counter()
+                timing.update(case=case, read_s=t1 - t0, repair_s=0.0, total_s=t1 - t0)
+                self.timings.append(timing)
+                return None
+        t_decode = time.perf_counter()
+        st = self._decode_mseed(data, format)
+        del data
+        t1 = time.perf_counter()
+        timing["decode_s"] = t1 - t_decode
+        cs, case = self._repair_stream(st, allocate, case)
+        t2 = time.perf_counter()
+
+        timing.update(case=case, read_s=t1 - t0, repair_s=t2 - t1, total_s=t2 - t0)
+        self.timings.append(timing)
+        return cs
+
+    def _fetch_mseed(self, url):
+        fetch = self.fetcher.get if self.fetcher is not None else None
+        if self.cache is not None:
+            return self.cache.get(url, fetch=fetch)
+        if fetch is not None:
+            return fetch(url)
+        fs, _ = fsspec.core.url_to_fs(url)  # the archive over http, or a local copy
+        return fs.cat_file(url)
+
+    def _decode_mseed(self, data, format):
+        dtype = np.float64 if format == "FLOAT" else np.int32
+        return obs.read(io.BytesIO(data), format="MSEED", apply_calib=False, dtype=dtype)
 
+    def _preflight(self, data):
+        """CASE A/B/C from mseed record headers only, no samples are decoded"""
+        st = obs.read(io.BytesIO(data), format="MSEED", headonly=True)
+        ids = np.array([tr.id for tr in st])
+        starts = np.array([tr.stats.starttime.timestamp for tr in st])
+        ends = np.array([tr.stats.endtime.timestamp for tr in st])
+        deltas = np.array([tr.stats.delta for tr in st])
+        npts = np.array([tr.stats.npts for tr in st], dtype=np.int64)
+        return _preflight_case(ids, starts, ends, deltas, npts, self.fudge_factor)
+
+    def _repair_stream(self, st, allocate=np.empty, case=None):
+        """
+        returns the repaired stream (or None) and which CASE applied, `case` skips the
+        checks when preflight already decided between A and C
+        """
         trace_id = st[0].stats["starttime"]
         print("total traces before concatenation: " + str(len(st)), flush=True)
+        if case in ["A", "C"]:
+            # merged in file order, like the checks below (get_gaps sorts a copy)
+            cs = self._merge_by_timestamps(st, allocate)
+            return cs, case
+
         # if 19.2 samples +- 640 then concat
         samples = 0
         for trace in st:
             samples += len(trace)
 
-        if 19199360 <= samples <= 19200640:  # CASE A: just jitter, no true gaps
+        if (
+            abs(samples - SEGMENT_SAMPLES) <= JITTER_SAMPLES
+        ):  # CASE A: just jitter, no true gaps
             print(f"There are {samples} samples in this stream, Simply concatenating")
-            cs = self._merge_by_timestamps(st)
+            cs = self._merge_by_timestamps(st, allocate)
             print("total traces after concatenation: " + str(len(cs)))
+            case = "A"
         else:
             print(
                 f"{trace_id}: there are a unexpected number of samples in this file: {samples} Checking for large gaps:"
@@ -182,16 +481,333 @@ class HydrophoneDay:
                 print(
                     f"{trace_id}: This file contains large gaps - {gap}. Cannot repair with currently implimented methods"
                 )
-                return None
+                return None, "B"
                 # raise ValueError(f"{trace_id}: This file contains large gaps - {gap}. Cannot repair with currently implimented methods")
                 # TODO if this is deployed we want to make multiple files seperated by gaps > fudge factor
             else:  # CASE C: shortened mseed file before divert with no large gaps
                 print(
                     f"{trace_id}: This file is short but only contains jitter. Simply concatenating"
                 )
-                cs = self._merge_by_timestamps(st)
+                cs = self._merge_by_timestamps(st, allocate)
                 print("total traces after concatenation: " + str(len(cs)), flush=True)
-        return cs
+                case = "C"
+        return cs, case
+
+
+def _make_data_dirs(hyd):
+    date_str = datetime.strftime(hyd.date, "%Y_%m_%d")
+    flac_dir = Path.cwd() / f"data/flac/{date_str}/{hyd.refdes[18:]}"
+    png_dir = Path.cwd() / f"data/png/{date_str}/{hyd.refdes[18:]}"
+    wav_dir = Path.cwd() / f"data/wav/{date_str}/{hyd.refdes[18:]}"
+
+    flac_dir.mkdir(parents=True, exist_ok=True)
+    png_dir.mkdir(parents=True, exist_ok=True)
+    wav_dir.mkdir(parents=True, exist_ok=True)
+    return flac_dir, png_dir, wav_dir, date_str
+
+
+def _prepare_segment(st, hyd_refdes, format, normalize_traces, flac_dir, wav_dir):
+    start_time = str(st[0].stats["starttime"])
+    sr = int(st[0].stats["sampling_rate"])
+    dt = datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%S.%fZ")
+
+    new_format = dt.strftime("%Y%m%d_%H%M%S")  # dt.strftime("%y%m%d%H%M%S%z")
+
+    if format == "FLOAT":
+        st[0].data = st[0].data.astype(np.float64, copy=False)
+
+    if normalize_traces:
+        st = st.normalize()
+
+    flac_path = flac_dir / f"{hyd_refdes[-9:]}_{new_format}.flac"
+    wav_path = wav_dir / f"{hyd_refdes[-9:]}_{new_format}.wav"
+    return st, sr, flac_path, wav_path
+
+
+def _write_segment(
+    st, hyd_refdes, format, normalize_traces, write_wav, flac_dir, wav_dir, verify=False
+):
+    st, sr, flac_path, wav_path = _prepare_segment(
+        st, hyd_refdes, format, normalize_traces, flac_dir, wav_dir
+    )
+
+    print(str(flac_path))
+    t0 = time.perf_counter()
+    sf.write(
+        flac_path, st[0].data, sr, subtype=format
+    )  # use sf package to write instead of obspy
+    metrics.observe("encode_s", time.perf_counter() - t0)
+    paths = [flac_path]
+    wav_md5 = None
+    if write_wav:
+        print(str(wav_path))
+        t0 = time.perf_counter()
+        if verify:
+            wav_md5 = write_hashed_wav(wav_path, st[0].data, sr, format)
+        else:
+            sf.write(
+                wav_path, st[0].data, sr, subtype=format
+            )  # use sf package to write instead of obspy
+        metrics.observe("encode_s", time.perf_counter() - t0)
+        paths.append(wav_path)
+
+    result = None
+    if verify:
+        wav_path = wav_path if write_wav else None
+        result = verify_segment(st[0].data, format, flac_path, wav_path, wav_md5)
+    return paths, result
+
+
+def _encode(data, sr, path, audio_format, subtype, verify=False):
+    # write next to the final name, SegmentWriter moves it into place in segment order
+    tmp_path = path.with_name(path.name + ".part")
+    print(str(path))
+    t0 = time.perf_counter()
+    md5 = None
+    if verify and audio_format == "WAV":
+        md5 = write_hashed_wav(tmp_path, data, sr, subtype)  # hashed as it is written
+    else:
+        sf.write(tmp_path, data, sr, subtype=subtype, format=audio_format)
+    metrics.observe("encode_s", time.perf_counter() - t0)
+    return tmp_path, path, md5
+
+
+class SegmentWriter:
+    """
+    Pipelined FLAC/WAV encoder. Segments are encoded on a thread pool while later files are
+    still downloading, FLAC and WAV of the same segment concurrently (libsndfile releases
+    the GIL). Files are written as `.part` and renamed in mseed_urls order, so what lands on
+    disk is committed in deterministic time order. At most `max_pending` segments wait to be
+    encoded, which bounds the memory the encoder holds.
+    """
+
+    def __init__(
+        self,
+        hyd_refdes,
+        format,
+        normalize_traces,
+        write_wav,
+        flac_dir,
+        wav_dir,
+        workers=ENCODE_WORKERS,
+        max_pending=None,
+        release=False,
+        verify=False,
+        hmb=None,
+    ):
+        self.hyd_refdes = hyd_refdes
+        self.format = format
+        self.normalize_traces = normalize_traces
+        self.write_wav = write_wav
+        self.flac_dir = flac_dir
+        self.wav_dir = wav_dir
+        self.release = release  # drop samples once a segment is encoded
+        self.verify = verify  # check each segment against its buffer before committing it
+        self.verification = {}  # index -> verify_segment result
+        self.hmb = hmb  # fused HMB accumulator fed each prepared segment
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self.lock = threading.Lock()
+        self.finished = {}  # index -> encoded (tmp, final) paths waiting to be committed
+        self.next_index = 0
+        self.segments = {}  # index -> stream, for clean_list
+        self.outputs = {}  # index -> committed file paths
+        self.errors = []
+
+    def skip(self, index):
+        """mark a position that produced no segment (CASE B)"""
+        if self.hmb is not None:
+            self.hmb.skip(index)
+        self._finish(index, [])
+
+    def submit(self, index, st):
+        self.slots.acquire()
+        st, sr, flac_path, wav_path = _prepare_segment(
+            st,
+            self.hyd_refdes,
+            self.format,
+            self.normalize_traces,
+            self.flac_dir,
+            self.wav_dir,
+        )
+        self.segments[index] = st
+        if self.hmb is not None:
+            self.hmb.add(index, st)
+        data = st[0].data
+        futures = [self.executor.submit(_encode, data, sr, flac_path, "FLAC", self.format)]
+        if self.write_wav:
+            futures.append(
+                self.executor.submit(
+                    _encode, data, sr, wav_path, "WAV", self.format, self.verify
+                )
+            )
+
+        remaining = [len(futures)]
+
+        def done(_):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            self.slots.release()
+            failures = [f.exception() for f in futures if f.exception() is not None]
+            if failures:
+                # commit neither format of a segment that did not fully encode
+                self.errors.extend(failures)
+                for path in [flac_path, wav_path][: len(futures)]:
+                    path.with_name(path.name + ".part").unlink(missing_ok=True)
+                self._finish(index, [])
+                return
+            encoded = [future.result() for future in futures]
+            paths = [(tmp_path, path) for tmp_path, path, _ in encoded]
+            if self.verify:
+                wav_tmp, _, wav_md5 = encoded[1] if self.write_wav else (None, None, None)
+                try:
+                    result = verify_segment(data, self.format, paths[0][0], wav_tmp, wav_md5)
+                    result["file"] = flac_path.name
+                    self.verification[index] = result
+                except Exception as e:
+                    self.errors.append(e)
+            if self.release:
+                st[0].data = st[0].data[:0]
+            self._finish(index, paths)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def _finish(self, index, paths):
+        with self.lock:
+            self.finished[index] = paths
+            while self.next_index in self.finished:
+                committed = []
+                for tmp_path, path in self.finished.pop(self.next_index):
+                    os.replace(tmp_path, path)
+                    committed.append(path)
+                self.outputs[self.next_index] = committed
+                self.next_index += 1
+
+    def close(self):
+        """wait for every encode and return the encoded streams in segment order"""
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+        return [self.segments[i] for i in sorted(self.segments)]
+
+
+def _report_verification(hyd, png_dir, verify):
+    if not verify or png_dir is None:
+        return
+    logger = select_logger()
+    report_path = png_dir / f"{hyd.file_str}_verification.json"
+    summary = write_verification_report(hyd.verification, report_path)
+    logger.info(f"flac/wav verification: {summary}, report at {report_path}")
+    if summary["failed"]:
+        logger.warning(f"{len(summary['failed'])} segments failed verification")
+
+
+def _write_concurrency_history(hyd, fetcher):
+    """record the fetch concurrency chosen over the day so deployments can be tuned"""
+    output_dir = Path("./output")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    history_path = output_dir / f"{hyd.file_str}_fetch_concurrency.json"
+    stats = {k: v for k, v in fetcher.stats.items() if k != "latency_s"}
+    history = {
+        "adaptive": fetcher.adaptive,
+        "stats": stats,
+        "hosts": fetcher.concurrency_history(),
+    }
+    history_path.write_text(json.dumps(history, indent=2))
+    print(f"fetch concurrency history written to {history_path}")
+
+
+def _stream_mseed_to_audio(
+    hyd,
+    format,
+    normalize_traces,
+    write_wav,
+    max_in_flight,
+    mem_budget_mb,
+    backend,
+    encode_workers=0,
+    release=True,
+    verify=False,
+    hmb=None,
+):
+    """
+    fetch, repair and encode segments as they arrive, with `release` each one is dropped
+    once it is written. `encode_workers` > 0 hands encoding to a SegmentWriter pool.
+    """
+    if hyd.mseed_urls is None:
+        return None, None, None
+
+    flac_dir, png_dir, wav_dir, date_str = _make_data_dirs(hyd)
+
+    max_pending = None
+    if encode_workers > 0 and math.isinf(mem_budget_mb):  # unbounded, nothing to split
+        max_pending = 2 * encode_workers
+    elif encode_workers > 0:
+        # segments waiting on the encoder come out of the same budget as those in flight
+        segment_mb = _segment_nbytes(format) / 1024**2
+        max_pending = max(1, min(2 * encode_workers, int(mem_budget_mb / segment_mb) // 2))
+        mem_budget_mb = max(0, mem_budget_mb - max_pending * segment_mb)
+
+    repaired = hyd.iter_repaired(
+        format,
+        max_in_flight=max_in_flight,
+        mem_budget_mb=mem_budget_mb,
+        backend=backend,
+        with_index=True,
+    )
+
+    if encode_workers > 0:
+        writer = SegmentWriter(
+            hyd.refdes,
+            format,
+            normalize_traces,
+            write_wav,
+            flac_dir,
+            wav_dir,
+            workers=encode_workers,
+            max_pending=max_pending,
+            release=release,
+            verify=verify,
+            hmb=hmb,
+        )
+        try:
+            for index, st in repaired:
+                if st is None:
+                    writer.skip(index)
+                else:
+                    writer.submit(index, st)
+        finally:
+            hyd.clean_list = writer.close()
+        hyd.segment_files = dict(writer.outputs)
+        hyd.verification = [writer.verification[i] for i in sorted(writer.verification)]
+        return hyd, png_dir, date_str
+
+    segments = {}
+    verification = {}
+    for index, st in repaired:
+        if st is None:
+            if hmb is not None:
+                hmb.skip(index)
+            hyd.segment_files[index] = []
+            continue
+        hyd.segment_files[index], result = _write_segment(
+            st, hyd.refdes, format, normalize_traces, write_wav, flac_dir, wav_dir, verify
+        )
+        if result is not None:
+            verification[index] = result
+        if hmb is not None:
+            hmb.add(index, st)
+        if release:
+            # keep the header for downstream logging but drop the samples
+            st[0].data = st[0].data[:0]
+        segments[index] = st
+    hyd.clean_list = [segments[i] for i in sorted(segments)]
+    hyd.verification = [verification[i] for i in sorted(verification)]
+
+    return hyd, png_dir, date_str
 
 
 @task(retries=2, retry_delay_seconds=60)
@@ -202,59 +818,264 @@ def convert_mseed_to_audio(
     format,
     normalize_traces,
     write_wav,
+    streaming=False,
+    max_in_flight=MAX_IN_FLIGHT,
+    mem_budget_mb=MEM_BUDGET_MB,
+    backend="thread",
+    cache_dir=None,
+    cache_max_gb=CACHE_MAX_GB,
+    listing_index_dir=None,
+    async_fetch=False,
+    max_per_host=MAX_PER_HOST,
+    request_rate=REQUEST_RATE,
+    adaptive_concurrency=False,
+    preflight=False,
+    encode_workers=0,
+    verify=False,
+    hmb=None,
+    skip_urls=None,
+    archive_url=RAW_DATA_URL,
 ):
     logger = select_logger()
-    hyd = HydrophoneDay(hyd_refdes, date, fudge_factor)
+    if hmb is not None:
+        hmb.reset()  # start over on task retries
+    cache = None
+    if cache_dir is not None:
+        logger.info(f"Caching raw archive downloads in {cache_dir} (max {cache_max_gb} GB)")
+        cache = MseedCache(cache_dir, max_bytes=int(cache_max_gb * 1024**3))
+    index = None
+    if listing_index_dir is not None:
+        index = ListingIndex(listing_index_dir, base_url=archive_url)
+    fetcher = None
+    if (async_fetch or adaptive_concurrency) and backend == "process":
+        # each worker process would build its own limiter and multiply --max-per-host
+        logger.warning("Async fetch needs one limiter for the day, using the thread backend")
+        backend = "thread"
+    if async_fetch or adaptive_concurrency:
+        logger.info(f"Async fetch with {max_per_host} requests per host at {request_rate}/s")
+        fetcher = AsyncFetcher(
+            max_per_host=max_per_host, rate=request_rate, adaptive=adaptive_concurrency
+        )
+    hyd = HydrophoneDay(
+        hyd_refdes,
+        date,
+        fudge_factor,
+        cache=cache,
+        index=index,
+        fetcher=fetcher,
+        preflight=preflight,
+        base_url=archive_url,
+    )
+    if skip_urls and hyd.mseed_urls is not None:
+        # files whose audio is already on disk, only the rest is fetched and written
+        hyd.mseed_urls = [url for url in hyd.mseed_urls if url not in skip_urls]
+        logger.info(f"{len(skip_urls)} files already converted, {len(hyd.mseed_urls)} to go")
+        if not hyd.mseed_urls:
+            hyd.clean_list = []
+            flac_dir, png_dir, wav_dir, date_str = _make_data_dirs(hyd)
+            return hyd, png_dir, date_str
+
+    try:
+        if streaming or encode_workers > 0:
+            if streaming:
+                logger.info("Streaming mseed to audio conversion")
+            else:
+                # keep the whole day in memory as before, just overlap repair and encode
+                max_in_flight = min(24, 2 * mp.cpu_count())
+                mem_budget_mb = float("inf")
+            result = _stream_mseed_to_audio(
+                hyd,
+                format,
+                normalize_traces,
+                write_wav,
+                max_in_flight,
+                mem_budget_mb,
+                backend,
+                encode_workers=encode_workers,
+                release=streaming,
+                verify=verify,
+                hmb=hmb,
+            )
+            logger.info(f"{backend} backend timings: {hyd.timing_summary()}")
+            _report_verification(hyd, result[1], verify)
+            return result
 
-    hyd.read_and_repair_gaps(format=format)
+        hyd.read_and_repair_gaps(format=format, backend=backend)
+        logger.info(f"{backend} backend timings: {hyd.timing_summary()}")
+    finally:
+        if fetcher is not None:
+            fetcher.close()
+            _write_concurrency_history(hyd, fetcher)
+            metrics.observe("http_latency_s", *fetcher.stats["latency_s"])
+            metrics.count("http_requests", fetcher.stats["requests"])
+            metrics.count("http_errors", fetcher.stats["errors"])
 
     if hyd.clean_list is None:  # retun None if no data available on that day
         return None, None, None
     else:
         # make dirs
         logger.info("Creating data directories")
-        date_str = datetime.strftime(hyd.date, "%Y_%m_%d")
-        flac_dir = Path.cwd() / f"data/flac/{date_str}/{hyd.refdes[18:]}"
-        png_dir = Path.cwd() / f"data/png/{date_str}/{hyd.refdes[18:]}"
-        wav_dir = Path.cwd() / f"data/wav/{date_str}/{hyd.refdes[18:]}"
+        flac_dir, png_dir, wav_dir, date_str = _make_data_dirs(hyd)
 
-        flac_dir.mkdir(parents=True, exist_ok=True)
-        png_dir.mkdir(parents=True, exist_ok=True)
-        wav_dir.mkdir(parents=True, exist_ok=True)
-
-        for st in hyd.clean_list:
+        hyd.verification = []
+        for index, st in enumerate(hyd.clean_list):
+            hyd.segment_files[index] = []
+            if st is None and hmb is not None:
+                hmb.skip(index)
             if (
                 st is not None
             ):  # TODO as of now we are throwing out 5 minute segments with gaps > fudge factor
-                start_time = str(st[0].stats["starttime"])
-                sr = int(st[0].stats["sampling_rate"])
-                dt = datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%S.%fZ")
+                hyd.segment_files[index], result = _write_segment(
+                    st,
+                    hyd_refdes,
+                    format,
+                    normalize_traces,
+                    write_wav,
+                    flac_dir,
+                    wav_dir,
+                    verify,
+                )
+                if result is not None:
+                    hyd.verification.append(result)
+                if hmb is not None:
+                    hmb.add(index, st)
+        _report_verification(hyd, png_dir, verify)
+
+        return hyd, png_dir, date_str
+
+
+@task(
+    retries=2,
+    retry_delay_seconds=60,
+    cache_key_fn=task_input_hash,
+    cache_expiration=timedelta(days=SEGMENT_CACHE_DAYS),
+    persist_result=True,
+)
+def convert_mseed_file(
+    hyd_refdes,
+    date,
+    url,
+    fudge_factor,
+    format,
+    normalize_traces,
+    write_wav,
+    cache_dir=None,
+    cache_max_gb=CACHE_MAX_GB,
+    preflight=False,
+    verify=False,
+):
+    """
+    fetch, repair and write the audio of one archive file. Returns the stream header without
+    its samples and what was written, cached on the inputs so a retried day skips the files
+    that already went through.
+    """
+    cache = None
+    if cache_dir is not None:
+        cache = MseedCache(cache_dir, max_bytes=int(cache_max_gb * 1024**3))
+    hyd = HydrophoneDay(
+        hyd_refdes, date, fudge_factor, cache=cache, preflight=preflight, mseed_urls=[url]
+    )
+    st = hyd._deal_with_gaps_and_overlaps(url, format)
+    result = {"url": url, "header": None, "paths": [], "verification": None}
+    result["timing"] = hyd.timings[0] if hyd.timings else None
+    if st is None:
+        return result
+
+    flac_dir, _, wav_dir, _ = _make_data_dirs(hyd)
+    paths, verification = _write_segment(
+        st, hyd_refdes, format, normalize_traces, write_wav, flac_dir, wav_dir, verify
+    )
+    st[0].data = st[0].data[:0]  # only the header goes into the cached result
+    result.update(header=st, paths=[str(path) for path in paths], verification=verification)
+    return result
+
+
+@task
+def collect_mseed_files(hyd, results, verify=False):
+    """reduce the per-file results into hyd the way convert_mseed_to_audio leaves it"""
+    logger = select_logger()
+    failed = [
+        url for url, result in zip(hyd.mseed_urls, results) if isinstance(result, Exception)
+    ]
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(results)} files failed: {failed}")
 
-                new_format = dt.strftime("%Y%m%d_%H%M%S")  # dt.strftime("%y%m%d%H%M%S%z")
+    _, png_dir, _, date_str = _make_data_dirs(hyd)
+    hyd.segment_files = {n: [Path(p) for p in r["paths"]] for n, r in enumerate(results)}
+    hyd.clean_list = [r["header"] for r in results if r["header"] is not None]
+    hyd.verification = [r["verification"] for r in results if r["verification"] is not None]
+    hyd.timings = [r["timing"] for r in results if r["timing"] is not None]
+    logger.info(f"per-file timings: {hyd.timing_summary()}")
+    _report_verification(hyd, png_dir, verify)
+    return hyd, png_dir, date_str
 
-                if format == "FLOAT":
-                    st[0].data = st[0].data.astype(np.float64)
 
-                if normalize_traces:
-                    st = st.normalize()
+def convert_mseed_files_mapped(
+    hyd_refdes,
+    date,
+    fudge_factor,
+    format,
+    normalize_traces,
+    write_wav,
+    max_in_flight=MAX_IN_FLIGHT,
+    mem_budget_mb=MEM_BUDGET_MB,
+    cache_dir=None,
+    cache_max_gb=CACHE_MAX_GB,
+    listing_index_dir=None,
+    preflight=False,
+    verify=False,
+    skip_urls=None,
+    archive_url=RAW_DATA_URL,
+):
+    """
+    the audio stage as one convert_mseed_file task per archive file plus a reduce step, so a
+    transient failure only retries its own file and every file shows up in the Prefect UI.
+    Files are submitted in order with at most the streaming window of them unfinished, each
+    holds a whole segment in memory. Must be called from inside a flow.
+    """
+    logger = select_logger()
+    index = None
+    if listing_index_dir is not None:
+        index = ListingIndex(listing_index_dir, base_url=archive_url)
+    hyd = HydrophoneDay(hyd_refdes, date, fudge_factor, index=index, base_url=archive_url)
+    if hyd.mseed_urls is None:
+        return None, None, None
+    if skip_urls:
+        hyd.mseed_urls = [url for url in hyd.mseed_urls if url not in skip_urls]
+        logger.info(f"{len(skip_urls)} files already converted, {len(hyd.mseed_urls)} to go")
 
-                # print(type(st[0].data[0]))
-                # print(st[0].data[:5])
+    window = min(max_in_flight, (mem_budget_mb * 1024**2) // _segment_nbytes(format))
+    window = max(1, int(window))
+    logger.info(f"Converting {len(hyd.mseed_urls)} files as tasks, {window} at a time")
+    kwargs = {
+        "hyd_refdes": hyd_refdes,
+        "date": date,
+        "fudge_factor": fudge_factor,
+        "format": format,
+        "normalize_traces": normalize_traces,
+        "write_wav": write_wav,
+        "cache_dir": cache_dir,
+        "cache_max_gb": cache_max_gb,
+        "preflight": preflight,
+        "verify": verify,
+    }
 
-                flac_path = flac_dir / f"{hyd_refdes[-9:]}_{new_format}.flac"
-                wav_path = wav_dir / f"{hyd_refdes[-9:]}_{new_format}.wav"
+    futures = []
+    for url in hyd.mseed_urls:
+        if len(futures) >= window:
+            futures[-window].wait()
+        futures.append(convert_mseed_file.submit(url=url, **kwargs))
+    results = [future.result(raise_on_failure=False) for future in futures]
 
-                print(str(flac_path))
-                sf.write(
-                    flac_path, st[0].data, sr, subtype=format
-                )  # use sf package to write instead of obspy
-                if write_wav:
-                    print(str(wav_path))
-                    sf.write(
-                        wav_path, st[0].data, sr, subtype=format
-                    )  # use sf package to write instead of obspy
+    # a cached result is only good while its files are still on disk
+    refresh = convert_mseed_file.with_options(refresh_cache=True)
+    for n, result in enumerate(results):
+        if isinstance(result, dict) and not all(Path(p).exists() for p in result["paths"]):
+            logger.info(f"Audio of {result['url']} is gone, converting it again")
+            future = refresh.submit(url=result["url"], **kwargs)
+            results[n] = future.result(raise_on_failure=False)
 
-        return hyd, png_dir, date_str
+    return collect_mseed_files(hyd, results, verify)
 
 
 @task  # TODO remove this once FLAC are being distributed or sooner
@@ -315,42 +1136,222 @@ def acoustic_flow_oneday(
     s3_sync,
     flag,
     obs_run_type,
+    streaming=False,
+    max_in_flight=MAX_IN_FLIGHT,
+    mem_budget_mb=MEM_BUDGET_MB,
+    backend="thread",
+    cache_dir=None,
+    cache_max_gb=CACHE_MAX_GB,
+    listing_index_dir=None,
+    async_fetch=False,
+    max_per_host=MAX_PER_HOST,
+    request_rate=REQUEST_RATE,
+    adaptive_concurrency=False,
+    preflight=False,
+    encode_workers=0,
+    verify=False,
+    fused_hmb=False,
+    zarr_store=False,
+    plot_render="mesh",
+    ledger_db=None,
+    per_file_tasks=False,
+    metrics_artifact=False,
+    archive_url=RAW_DATA_URL,
 ):
     logger = select_logger()
     # log python package versions on cloud machine
     installed_packages = {dist.metadata["Name"]: dist.version for dist in distributions()}
     logger.info(f"Installed packages: {installed_packages}")
 
-    if flag == "audio" or flag == "all":
-        hyd, png_dir, date_str = convert_mseed_to_audio(
-            hyd_refdes=hyd_refdes,
-            date=date,
-            format=format,
-            normalize_traces=normalize_traces,
-            fudge_factor=fudge_factor,
-            write_wav=write_wav,
-        )
-        if hyd is None:
-            logger.warning(f"No data availale for {date}. Moving to next day.")
-            return
+    run_metrics = metrics.start_run(hyd_refdes, date, flag)
+    try:
+        ledger = RunLedger(ledger_db) if ledger_db is not None else None
+        instrument = hyd_refdes[-9:]
+        day_str = date.replace("/", "")
+        # parameters that change each stage's products, part of its ledger key
+        audio_params = {
+            "format": format,
+            "normalize_traces": normalize_traces,
+            "fudge_factor": fudge_factor,
+            "write_wav": write_wav,
+        }
+        viz_params = {
+            "apply_cals": apply_cals,
+            "freq_lims": list(freq_lims),
+            "fused_hmb": fused_hmb,
+        }
+
+        def done(stage, params):
+            return ledger is not None and ledger.is_done(hyd_refdes, date, stage, params)
+
+        def unit(stage, params, func, outputs=None):
+            with metrics.stage(stage):
+                if ledger is None:
+                    return func()
+                return ledger.run(hyd_refdes, date, stage, params, func, outputs)
+
+        def segment_outputs(result):
+            hyd = result[0]
+            if hyd is None:  # no data on the archive (yet)
+                return None
+            return {hyd.mseed_urls[index]: paths for index, paths in hyd.segment_files.items()}
 
-        # first element of list is different each time due to multithreading - could add sort step?
-        logger.info(f"first 5 elements of cleaned mseed list: {hyd.clean_list[:5]}")
+        def day_products(_):
+            paths = [Path(f"./output/{instrument}_{day_str}.{ext}") for ext in ["nc", "png"]]
+            paths = [path for path in paths if path.exists()]
+            return {"": paths} if paths else None
 
-        if write_wav:
-            compare_flac_wav(hyd_refdes, format, hyd, png_dir, date_str)
+        hmb = None
+        if flag == "all" and fused_hmb:
+            # compute the HMB product from the repaired segments instead of re-reading the FLACs
+            hmb = HmbAccumulator(hyd_refdes, date, format, apply_cals, freq_lims)
 
-    if flag == "viz" or flag == "all":
-        audio_to_spec(date, "flac", hyd_refdes, apply_cals, freq_lims)
+        audio_changed = False
+        if flag == "audio" or flag == "all":
+            if done("audio", audio_params) and (hmb is None or done("viz", viz_params)):
+                logger.info(f"Audio of {date} is complete in {ledger_db}, skipping")
+            else:
+                skip_urls = None
+                if ledger is not None and hmb is None:  # the fused HMB needs every segment
+                    skip_urls = ledger.intact_sources(hyd_refdes, date, "audio", audio_params)
+                if per_file_tasks and hmb is None:
 
-    if flag == "low_freq":
-        run_low_freq_oneday(hyd_refdes, date, logger)
+                    def convert():
+                        return convert_mseed_files_mapped(
+                            hyd_refdes=hyd_refdes,
+                            date=date,
+                            fudge_factor=fudge_factor,
+                            format=format,
+                            normalize_traces=normalize_traces,
+                            write_wav=write_wav,
+                            max_in_flight=max_in_flight,
+                            mem_budget_mb=mem_budget_mb,
+                            cache_dir=cache_dir,
+                            cache_max_gb=cache_max_gb,
+                            listing_index_dir=listing_index_dir,
+                            preflight=preflight,
+                            verify=verify,
+                            skip_urls=skip_urls,
+                            archive_url=archive_url,
+                        )
+                else:
+                    if per_file_tasks:
+                        logger.warning(
+                            "The fused HMB needs the whole day in one task, not per file"
+                        )
 
-    if flag == "obs":
-        run_obs_viz(hyd_refdes, date, obs_run_type)
+                    def convert():
+                        return convert_mseed_to_audio(
+                            hyd_refdes=hyd_refdes,
+                            date=date,
+                            format=format,
+                            normalize_traces=normalize_traces,
+                            fudge_factor=fudge_factor,
+                            write_wav=write_wav,
+                            streaming=streaming,
+                            max_in_flight=max_in_flight,
+                            mem_budget_mb=mem_budget_mb,
+                            backend=backend,
+                            cache_dir=cache_dir,
+                            cache_max_gb=cache_max_gb,
+                            listing_index_dir=listing_index_dir,
+                            async_fetch=async_fetch,
+                            max_per_host=max_per_host,
+                            request_rate=request_rate,
+                            adaptive_concurrency=adaptive_concurrency,
+                            preflight=preflight,
+                            encode_workers=encode_workers,
+                            verify=verify,
+                            hmb=hmb,
+                            skip_urls=skip_urls,
+                            archive_url=archive_url,
+                        )
+
+                hyd, png_dir, date_str = unit("audio", audio_params, convert, segment_outputs)
+                if hyd is None:
+                    logger.warning(f"No data availale for {date}. Moving to next day.")
+                    return
+                run_metrics.add_file_timings(hyd.timings)
+                audio_changed = bool(hyd.segment_files)
+                if audio_changed and ledger is not None:
+                    ledger.invalidate(hyd_refdes, date, ["viz", "zarr", "sync"])
+
+                # clean_list follows mseed_urls order regardless of thread completion order
+                logger.info(f"first 5 elements of cleaned mseed list: {hyd.clean_list[:5]}")
+
+                # verify checks every segment while encoding instead
+                if write_wav and not verify and len(hyd.clean_list) > 1:
+                    compare_flac_wav(hyd_refdes, format, hyd, png_dir, date_str)
+
+        viz_changed = False
+        if hmb is not None or flag == "viz" or flag == "all":
+            if not audio_changed and done("viz", viz_params):
+                logger.info(f"HMB products of {date} are complete in {ledger_db}, skipping")
+            elif hmb is not None:
+                unit(
+                    "viz",
+                    viz_params,
+                    lambda: hmb_to_spec(hmb, hyd_refdes, freq_lims),
+                    day_products,
+                )
+                viz_changed = True
+            else:
+                unit(
+                    "viz",
+                    viz_params,
+                    lambda: audio_to_spec(date, "flac", hyd_refdes, apply_cals, freq_lims),
+                    day_products,
+                )
+                viz_changed = True
+
+        if viz_changed and ledger is not None:
+            ledger.invalidate(hyd_refdes, date, ["zarr", "sync"])
+
+        zarr_keys = None
+        zarr_changed = False
+        if zarr_store and flag in ["viz", "all"]:
+            if viz_changed or not done("zarr", viz_params):
+                zarr_keys = unit(
+                    "zarr", viz_params, lambda: append_hmb_to_zarr(hyd_refdes, date)
+                )
+                zarr_changed = True
+
+        if flag == "low_freq":
+            if done("low_freq", {"plot_render": plot_render}):
+                logger.info(
+                    f"Low frequency plot of {date} is complete in {ledger_db}, skipping"
+                )
+            else:
+                unit(
+                    "low_freq",
+                    {"plot_render": plot_render},
+                    lambda: run_low_freq_oneday(hyd_refdes, date, logger, render=plot_render),
+                    day_products,
+                )
+                viz_changed = True
+
+        if flag == "obs":
+            with metrics.stage("obs"):
+                run_obs_viz(hyd_refdes, date, obs_run_type)
+
+        if s3_sync:
+            sync_params = {"flag": flag, "zarr_store": zarr_store}
+            changed = audio_changed or viz_changed or zarr_changed
+            if flag != "obs" and not changed and done("sync", sync_params):
+                logger.info(f"Products of {date} already synced to S3, skipping")
+            else:
+                unit(
+                    "sync",
+                    sync_params,
+                    lambda: sync_png_nc_to_s3(hyd_refdes, date, flag, zarr_keys=zarr_keys),
+                )
 
-    if s3_sync:
-        sync_png_nc_to_s3(hyd_refdes, date, flag)
+    finally:
+        metrics.end_run()
+        path, report = run_metrics.write()
+        logger.info(f"Run metrics written to {path}, stages: {report['stages']}")
+        if metrics_artifact:
+            metrics.publish_artifact(report)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,21 @@
 import click
 import yaml
+import asyncio
 
 from abc import ABC, abstractmethod
 from prefect.deployments import run_deployment
 from datetime import datetime, timedelta, timezone
-from ooi_hyd_tools.mseed_to_audio import acoustic_flow_oneday
+from ooi_hyd_tools.mseed_to_audio import acoustic_flow_oneday, MAX_IN_FLIGHT, MEM_BUDGET_MB
 from ooi_hyd_tools.utils import select_logger
+from ooi_hyd_tools.cache import ListingIndex, CACHE_MAX_GB
+from ooi_hyd_tools.fetch import MAX_PER_HOST, REQUEST_RATE
+from ooi_hyd_tools.archive import RAW_DATA_URL
+from ooi_hyd_tools.deployments import DEPLOYMENTS
+from ooi_hyd_tools.hmb_batch import run_hmb_batch
+from ooi_hyd_tools.hmb_zarr import append_hmb_to_zarr
+from ooi_hyd_tools.cloud import sync_png_nc_to_s3
+from ooi_hyd_tools.scheduler import DayScheduler, LEDGER_DIR
+from ooi_hyd_tools.dispatch import DeploymentDispatcher
 
 logger = select_logger()
 
@@ -42,6 +52,27 @@ def build_params(
     s3_sync,
     flag,
     obs_run_type,
+    streaming=False,
+    max_in_flight=MAX_IN_FLIGHT,
+    mem_budget_mb=MEM_BUDGET_MB,
+    backend="thread",
+    cache_dir=None,
+    cache_max_gb=CACHE_MAX_GB,
+    listing_index_dir=None,
+    async_fetch=False,
+    max_per_host=MAX_PER_HOST,
+    request_rate=REQUEST_RATE,
+    adaptive_concurrency=False,
+    preflight=False,
+    encode_workers=0,
+    verify=False,
+    fused_hmb=False,
+    zarr_store=False,
+    plot_render="mesh",
+    ledger_db=None,
+    per_file_tasks=False,
+    metrics_artifact=False,
+    archive_url=RAW_DATA_URL,
 ) -> dict:
     return {
         "hyd_refdes": hyd_refdes,
@@ -55,6 +86,27 @@ def build_params(
         "s3_sync": s3_sync,
         "flag": flag,
         "obs_run_type": obs_run_type,
+        "streaming": streaming,
+        "max_in_flight": max_in_flight,
+        "mem_budget_mb": mem_budget_mb,
+        "backend": backend,
+        "cache_dir": cache_dir,
+        "cache_max_gb": cache_max_gb,
+        "listing_index_dir": listing_index_dir,
+        "async_fetch": async_fetch,
+        "max_per_host": max_per_host,
+        "request_rate": request_rate,
+        "adaptive_concurrency": adaptive_concurrency,
+        "preflight": preflight,
+        "encode_workers": encode_workers,
+        "verify": verify,
+        "fused_hmb": fused_hmb,
+        "zarr_store": zarr_store,
+        "plot_render": plot_render,
+        "ledger_db": ledger_db,
+        "per_file_tasks": per_file_tasks,
+        "metrics_artifact": metrics_artifact,
+        "archive_url": archive_url,
     }
 
 
@@ -62,18 +114,47 @@ class Runner(ABC):
     @abstractmethod
     def run(self, date: datetime, params: dict) -> None: ...
 
+    def finish(self) -> None:
+        """called once after every date has been passed to run"""
+
 
 class LocalRunner(Runner):
     def run(self, date: datetime, params: dict) -> None:
         acoustic_flow_oneday(**params)
 
 
+class ParallelLocalRunner(Runner):
+    def __init__(self, max_workers=None, mem_limit_gb=None, ledger=None):
+        self.max_workers = max_workers
+        self.mem_limit_gb = mem_limit_gb
+        self.ledger = ledger
+        self.scheduler = None
+        self.failed = {}  # {date: error} of the days that failed
+
+    def run(self, date: datetime, params: dict) -> None:
+        if self.scheduler is None:
+            ledger = self.ledger or (
+                f"{LEDGER_DIR}/{params['hyd_refdes'][-9:]}_{params['flag']}.jsonl"
+            )
+            self.scheduler = DayScheduler(ledger, self.max_workers, mem_gb=self.mem_limit_gb)
+        self.scheduler.add(params)
+
+    def finish(self) -> None:
+        if self.scheduler is not None:
+            self.failed = self.scheduler.run()
+
+
 class PrefectRunner(Runner):
-    def __init__(self, deployment_name: str):
+    def __init__(self, deployment_name: str, max_concurrent_runs: int = 0):
         self.deployment_name = deployment_name
+        self.max_concurrent_runs = max_concurrent_runs
+        self.jobs = []
 
     def run(self, date: datetime, params: dict) -> None:
         run_name = f"{params['hyd_refdes']}_{date.strftime('%Y-%m-%d')}"
+        if self.max_concurrent_runs > 0:
+            self.jobs.append((run_name, params))  # dispatched together in finish
+            return
         logger.info(f"Launching workflow for {run_name} in cloud")
         run_deployment(
             name=self.deployment_name,
@@ -82,12 +163,40 @@ class PrefectRunner(Runner):
             timeout=TIMEOUT,
         )
 
+    def finish(self) -> None:
+        if self.jobs:
+            dispatcher = DeploymentDispatcher(self.deployment_name, self.max_concurrent_runs)
+            asyncio.run(dispatcher.dispatch(self.jobs))
+
 
 class CeleryRunner(Runner):
     def run(self, date: datetime, params: dict) -> None:
         raise NotImplementedError("CeleryRunner is not yet implemented")
 
 
+def run_hmb_batch_range(
+    hyd_refdes, start_date, end_date, apply_cals, freq_lims, workers, zarr_store, s3_sync
+):
+    """the viz step of a date range in one process pool, then zarr and s3 for the days that worked"""
+    end = end_date or start_date
+    summary = run_hmb_batch(hyd_refdes, start_date, end, apply_cals, freq_lims, workers)
+
+    done = [datetime.strptime(r["date"], "%Y%m%d") for r in summary["results"] if r["ok"]]
+    zarr_keys = {}  # year -> keys, sync uploads a whole year of products at once
+    for date in done:
+        keys = append_hmb_to_zarr(hyd_refdes, date.strftime("%Y/%m/%d")) if zarr_store else []
+        zarr_keys.setdefault(date.year, set()).update(keys)
+    if s3_sync:
+        for year, keys in zarr_keys.items():
+            date = next(d for d in done if d.year == year)
+            # outside a flow, so the task function is called directly
+            sync_png_nc_to_s3.fn(hyd_refdes, date.strftime("%Y/%m/%d"), "viz", zarr_keys=keys)
+
+    if summary["failed"]:
+        logger.warning(f"HMB failed for {len(summary['failed'])} days: {summary['failed']}")
+    return summary
+
+
 @click.command()
 @click.option(
     "--start-date",
@@ -172,14 +281,228 @@ class CeleryRunner(Runner):
     help="Only use with --flag 'obs', 'daily' run-type generates plots for 1, 7 day spans, 'weekly'"
     "also includes 30 day span.",
 )
+@click.option(
+    "--streaming",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Set to True to fetch, repair and encode each 5 minute file and release it before moving on,"
+    " instead of holding the whole day of repaired data in memory.",
+)
+@click.option(
+    "--max-in-flight",
+    type=int,
+    default=MAX_IN_FLIGHT,
+    show_default=True,
+    help="Only used with --streaming True or --per-file-tasks True. Maximum number of 5 minute"
+    " segments held in memory at once.",
+)
+@click.option(
+    "--mem-budget-mb",
+    type=int,
+    default=MEM_BUDGET_MB,
+    show_default=True,
+    help="Only used with --streaming True or --per-file-tasks True. Memory budget (MB) for"
+    " in-flight segments, caps --max-in-flight.",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["thread", "process"], case_sensitive=False),
+    default="thread",
+    show_default=True,
+    help="Concurrency backend for mseed decode/repair: 'thread' uses a thread pool, 'process' uses"
+    " a process pool that returns repaired data through shared memory.",
+)
+@click.option(
+    "--cache-dir",
+    type=str,
+    default=None,
+    help="Directory for a persistent cache of raw archive mseed downloads (e.g., './cache/mseed')."
+    " Leave blank to disable caching.",
+)
+@click.option(
+    "--cache-max-gb",
+    type=float,
+    default=CACHE_MAX_GB,
+    show_default=True,
+    help="Size cap for --cache-dir, least recently used files are evicted past this size.",
+)
+@click.option(
+    "--listing-index-dir",
+    type=str,
+    default=None,
+    help="Directory for a persistent index of raw archive directory listings (e.g., './cache/listings')."
+    " Past days are then listed once. With the local runner the whole date range is pre-listed"
+    " concurrently. Leave blank to list the archive every run.",
+)
+@click.option(
+    "--async-fetch",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Set to True to download mseed through a pooled, rate limited asyncio client instead of"
+    " one new connection per file. Runs with the thread backend, the per-host limit is shared"
+    " within one process.",
+)
+@click.option(
+    "--max-per-host",
+    type=int,
+    default=MAX_PER_HOST,
+    show_default=True,
+    help="Only used with --async-fetch True. Maximum in-flight requests to the raw data archive.",
+)
+@click.option(
+    "--request-rate",
+    type=float,
+    default=REQUEST_RATE,
+    show_default=True,
+    help="Only used with --async-fetch True. Maximum requests per second to the raw data archive.",
+)
+@click.option(
+    "--adaptive-concurrency",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Set to True to let the async fetcher adjust in-flight requests while the day runs (AIMD),"
+    " bounded by --max-per-host. Implies --async-fetch True. The chosen concurrency and throughput"
+    " are written to ./output as JSON.",
+)
+@click.option(
+    "--preflight",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Set to True to classify each mseed file from its record headers first and skip the"
+    " sample decode of files with gaps larger than --fudge-factor.",
+)
+@click.option(
+    "--encode-workers",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Number of threads encoding FLAC/WAV while later files are still downloading. 0 encodes"
+    " serially after the repair phase (or inline with --streaming True).",
+)
+@click.option(
+    "--verify",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Set to True to verify every FLAC (and WAV) while encoding against an MD5 of the PCM buffer,"
+    " writing a per-day JSON report instead of the flac/wav comparison plots.",
+)
+@click.option(
+    "--fused-hmb",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Only use with --flag 'all'. Set to True to compute the hybrid millidecade spectrogram"
+    " from the repaired mseed data in memory instead of re-reading the day's FLAC files.",
+)
+@click.option(
+    "--plot-render",
+    type=click.Choice(["mesh", "raster"], case_sensitive=False),
+    default="mesh",
+    show_default=True,
+    help="How low_freq summary plots are drawn. 'raster' draws the spectrogram as an image"
+    " on a fixed frequency grid and reuses one figure for every day, much faster for backfills.",
+)
+@click.option(
+    "--zarr-store",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Set to True to also append each day's HMB product to a yearly, time-chunked Zarr store"
+    " per instrument under ./output/zarr. With --s3-sync only the changed chunks are uploaded.",
+)
+@click.option(
+    "--hmb-workers",
+    type=int,
+    default=0,
+    show_default=True,
+    help="With --flag viz and the local runner, generate the HMB products of the whole date range"
+    " from existing FLAC files in a pool of this many processes, set up once per worker."
+    " 0 processes one day at a time.",
+)
+@click.option(
+    "--refresh-deployments",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Set to True to re-download the OOI asset management deployment CSV for this node before"
+    " running. Calibration lookups otherwise use the local copy in ./metadata/deployments.",
+)
+@click.option(
+    "--ledger-db",
+    type=str,
+    default=None,
+    help="SQLite run ledger (e.g. ./output/ledger/runs.sqlite) recording each stage of each day"
+    " with its outputs and checksums. Reruns skip complete stages and redo only the segments"
+    " whose files are missing or corrupt.",
+)
+@click.option(
+    "--per-file-tasks",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Set to True to run the audio stage as one Prefect task per archive file with results"
+    " cached on their inputs, so retries only redo the files that failed. At most"
+    " --max-in-flight files are converted at once. Not used with --fused-hmb.",
+)
+@click.option(
+    "--metrics-artifact",
+    type=bool,
+    default=False,
+    show_default=True,
+    help="Set to True to also attach each day's run metrics (stage durations, peak memory, bytes"
+    " downloaded, files per CASE) to the flow run as a Prefect artifact. The JSON report is"
+    " always written to ./output/metrics.",
+)
+@click.option(
+    "--archive-url",
+    type=str,
+    default=RAW_DATA_URL,
+    show_default=True,
+    help="Base URL of the raw data archive, e.g. a mirror or a local stand-in started with"
+    " `python -m ooi_hyd_tools.archive_server`. Defaults to $OOI_RAW_DATA_URL when set.",
+)
 @click.option(
     "--runner",
-    type=click.Choice(["local", "prefect", "celery"], case_sensitive=False),
+    type=click.Choice(["local", "parallel", "prefect", "celery"], case_sensitive=False),
     default="local",
     show_default=True,
-    help="Runner backend: 'local' runs in-process, 'prefect' dispatches to Prefect cloud deployment parallelized by date,"
+    help="Runner backend: 'local' runs in-process, 'parallel' runs days and their stages in a local"
+    " process pool, 'prefect' dispatches to Prefect cloud deployment parallelized by date,"
     " 'celery' dispatches to Celery workers (not yet implemented).",
 )
+@click.option(
+    "--max-concurrent-runs",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Only used with --runner prefect. Submit every date without waiting and keep at most this"
+    " many deployment runs in flight, fewer after failures. 0 launches one date at a time.",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=None,
+    help="Only used with --runner parallel. Maximum stages running at once, defaults to the CPU count.",
+)
+@click.option(
+    "--mem-limit-gb",
+    type=float,
+    default=None,
+    help="Only used with --runner parallel. Memory the scheduler may hand out to running stages,"
+    " defaults to 80% of physical memory.",
+)
+@click.option(
+    "--ledger",
+    type=str,
+    default=None,
+    help="Only used with --runner parallel. Progress ledger of finished stages, rerunning with the"
+    " same ledger and options skips them. Defaults to ./output/ledger/{instrument}_{flag}.jsonl.",
+)
 def run_acoustic_pipeline(
     start_date,
     end_date,
@@ -193,7 +516,34 @@ def run_acoustic_pipeline(
     s3_sync,
     flag,
     obs_run_type,
+    streaming,
+    max_in_flight,
+    mem_budget_mb,
+    backend,
+    cache_dir,
+    cache_max_gb,
+    listing_index_dir,
+    async_fetch,
+    max_per_host,
+    request_rate,
+    adaptive_concurrency,
+    preflight,
+    encode_workers,
+    verify,
+    fused_hmb,
+    zarr_store,
+    plot_render,
+    hmb_workers,
+    refresh_deployments,
+    ledger_db,
+    per_file_tasks,
+    metrics_artifact,
+    archive_url,
     runner,
+    max_concurrent_runs,
+    max_workers,
+    mem_limit_gb,
+    ledger,
 ):
     config_dict = OBS_CONFIG_DICT if flag == "obs" else HYD_CONFIG_DICT
     deployment_name = (
@@ -204,7 +554,8 @@ def run_acoustic_pipeline(
 
     runners = {
         "local": LocalRunner(),
-        "prefect": PrefectRunner(deployment_name),
+        "parallel": ParallelLocalRunner(max_workers, mem_limit_gb, ledger),
+        "prefect": PrefectRunner(deployment_name, max_concurrent_runs),
         "celery": CeleryRunner(),
     }
     _runner = runners[runner]
@@ -212,6 +563,32 @@ def run_acoustic_pipeline(
     start_date = datetime.strptime(start_date, "%Y/%m/%d")
     end_date = datetime.strptime(end_date, "%Y/%m/%d") if end_date else None
 
+    if refresh_deployments:
+        DEPLOYMENTS.refresh([hyd_refdes[:8]])
+
+    if (
+        listing_index_dir is not None
+        and runner in ["local", "parallel"]
+        and flag in ["audio", "all"]
+    ):
+        day_strs = [d.strftime("%Y/%m/%d") for d in iter_dates(start_date, end_date)]
+        index = ListingIndex(listing_index_dir, base_url=archive_url)
+        listed = index.prefetch(hyd_refdes, day_strs)
+        logger.info(f"Pre-listed {len(listed)} days for {hyd_refdes}")
+
+    if hmb_workers > 0 and runner == "local" and flag == "viz":
+        run_hmb_batch_range(
+            hyd_refdes,
+            start_date,
+            end_date,
+            apply_cals,
+            freq_lims,
+            hmb_workers,
+            zarr_store,
+            s3_sync,
+        )
+        return
+
     for date in iter_dates(start_date, end_date):
         params = build_params(
             date=date,
@@ -225,8 +602,30 @@ def run_acoustic_pipeline(
             s3_sync=s3_sync,
             flag=flag,
             obs_run_type=obs_run_type,
+            streaming=streaming,
+            max_in_flight=max_in_flight,
+            mem_budget_mb=mem_budget_mb,
+            backend=backend,
+            cache_dir=cache_dir,
+            cache_max_gb=cache_max_gb,
+            listing_index_dir=listing_index_dir,
+            async_fetch=async_fetch,
+            max_per_host=max_per_host,
+            request_rate=request_rate,
+            adaptive_concurrency=adaptive_concurrency,
+            preflight=preflight,
+            encode_workers=encode_workers,
+            verify=verify,
+            fused_hmb=fused_hmb,
+            zarr_store=zarr_store,
+            plot_render=plot_render,
+            ledger_db=ledger_db,
+            per_file_tasks=per_file_tasks,
+            metrics_artifact=metrics_artifact,
+            archive_url=archive_url,
         )
         _runner.run(date, params)
+    _runner.finish()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import hashlib
+import traceback
+import multiprocessing as mp
+import concurrent.futures
+
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from ooi_hyd_tools.utils import select_logger
+
+"""
+Local parallel execution of acoustic_flow_oneday over many days. A day of --flag all is split
+into its audio and viz stages so the viz of one day overlaps the audio of the next. Stages are
+started on a process pool only while their expected CPU and memory footprint fits in what is
+left of the machine, a failed stage only stops its own day, and every finished stage is
+appended to a progress ledger so an interrupted backfill skips what already finished.
+"""
+
+LEDGER_DIR = "./output/ledger"
+MEM_FRACTION = 0.8  # share of physical memory the scheduler hands out
+AUDIO_DAY_GB = 24  # a whole repaired day of 64 kHz samples held in memory
+# rough peak (cpus, GB) of the stages that do not depend on the run options
+STAGE_FOOTPRINTS = {
+    "viz": (1, 4),
+    "low_freq": (1, 2),
+    "obs": (1, 4),
+}
+# options that do not change the products, left out of the ledger key
+LEDGER_IGNORED_PARAMS = [
+    "date",
+    "s3_sync",
+    "max_in_flight",
+    "backend",
+    "encode_workers",
+    "ledger_db",
+    "per_file_tasks",
+    "metrics_artifact",
+]
+
+
+def machine_capacity():
+    """(cpus, GB of memory) available to the scheduler"""
+    mem_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return os.cpu_count() or 1, mem_bytes / 1024**3 * MEM_FRACTION
+
+
+def stage_footprint(stage, params):
+    """expected (cpus, GB) of one stage of one day"""
+    if stage in STAGE_FOOTPRINTS:
+        return STAGE_FOOTPRINTS[stage]
+    cpus = 1 + params.get("encode_workers", 0)
+    if params.get("streaming") or params.get("per_file_tasks"):
+        mem_gb = params["mem_budget_mb"] / 1024 + 1
+    else:
+        mem_gb = AUDIO_DAY_GB
+    if stage == "all":  # fused HMB, audio and spectra in one pass
+        mem_gb += 1
+    return cpus, mem_gb
+
+
+def split_stages(params):
+    """the (stage, params) chain of one day"""
+    flag = params["flag"]
+    if flag != "all" or params.get("fused_hmb"):
+        return [(flag, params)]
+    return [
+        ("audio", {**params, "flag": "audio", "s3_sync": False}),
+        ("viz", {**params, "flag": "viz"}),
+    ]
+
+
+class ProgressLedger:
+    """
+    Append-only JSON lines of finished stages. Entries are keyed by date, stage and a hash of
+    the options that shape the products, so a rerun with other settings starts over.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.done = set()
+        if self.path.exists():
+            for line in self.path.read_text().splitlines():
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # last line of an interrupted write
+                    continue
+                if entry["status"] == "done":
+                    self.done.add((entry["date"], entry["stage"], entry["params_hash"]))
+
+    @staticmethod
+    def params_hash(params):
+        kept = {k: v for k, v in params.items() if k not in LEDGER_IGNORED_PARAMS}
+        return hashlib.sha256(json.dumps(kept, sort_keys=True).encode()).hexdigest()[:16]
+
+    def is_done(self, date, stage, params):
+        return (date, stage, self.params_hash(params)) in self.done
+
+    def record(self, date, stage, params, status, seconds, error=None):
+        entry = {
+            "date": date,
+            "stage": stage,
+            "params_hash": self.params_hash(params),
+            "status": status,
+            "seconds": round(seconds, 1),
+            "error": error,
+            "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if status == "done":
+            self.done.add((date, stage, entry["params_hash"]))
+
+
+def _run_stage(params):
+    """worker side, returns (ok, seconds, error) instead of raising"""
+    from ooi_hyd_tools.mseed_to_audio import acoustic_flow_oneday
+
+    t0 = time.perf_counter()
+    try:
+        acoustic_flow_oneday(**params)
+    except Exception as e:
+        return (
+            False,
+            time.perf_counter() - t0,
+            f"{type(e).__name__}: {e}\n{traceback.format_exc()}",
+        )
+    return True, time.perf_counter() - t0, None
+
+
+class DayScheduler:
+    def __init__(self, ledger_path, max_workers=None, cpus=None, mem_gb=None):
+        machine_cpus, machine_mem_gb = machine_capacity()
+        self.cpus = cpus or machine_cpus
+        self.mem_gb = mem_gb or machine_mem_gb
+        self.max_workers = max_workers or self.cpus
+        self.ledger = ProgressLedger(ledger_path)
+        self.days = []  # (date str, [(stage, params), ...])
+
+    def add(self, params):
+        chain = [
+            (stage, stage_params)
+            for stage, stage_params in split_stages(params)
+            if not self.ledger.is_done(params["date"], stage, stage_params)
+        ]
+        if chain:
+            self.days.append((params["date"], chain))
+
+    def _new_pool(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=mp.get_context("spawn")
+        )
+
+    def run(self):
+        """run every added day, returns {date: error} of the days that failed"""
+        logger = select_logger()
+        ready = deque(self.days)  # days with their remaining stages, next stage first
+        running = {}  # future -> (date, chain, cpus, mem_gb)
+        free_cpus, free_mem_gb = self.cpus, self.mem_gb
+        failed = {}
+        logger.info(
+            f"Scheduling {len(ready)} days on {self.max_workers} workers,"
+            f" {self.cpus} cpus and {self.mem_gb:.0f} GB"
+        )
+
+        pool = self._new_pool()
+        try:
+            while ready or running:
+                # admit in order while the next stage fits, an idle machine always takes one
+                while ready and len(running) < self.max_workers:
+                    date, chain = ready[0]
+                    stage, params = chain[0]
+                    cpus, mem_gb = stage_footprint(stage, params)
+                    if running and (cpus > free_cpus or mem_gb > free_mem_gb):
+                        break
+                    ready.popleft()
+                    free_cpus -= cpus
+                    free_mem_gb -= mem_gb
+                    running[pool.submit(_run_stage, params)] = (date, chain, cpus, mem_gb)
+                    logger.info(f"Started {stage} of {date} ({cpus} cpus, {mem_gb:.0f} GB)")
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                broken = False
+                for future in finished:
+                    date, chain, cpus, mem_gb = running.pop(future)
+                    free_cpus += cpus
+                    free_mem_gb += mem_gb
+                    stage, params = chain[0]
+                    try:
+                        ok, seconds, error = future.result()
+                    except BrokenProcessPool as e:
+                        # a worker was killed (e.g. out of memory), which takes down every
+                        # stage running with it, they are retried on the next run
+                        ok, seconds, error = False, 0.0, f"{type(e).__name__}: {e}"
+                        broken = True
+
+                    self.ledger.record(
+                        date, stage, params, "done" if ok else "failed", seconds, error
+                    )
+                    if not ok:
+                        logger.warning(
+                            f"{stage} of {date} failed, skipping the rest of the day"
+                        )
+                        failed[date] = error
+                    elif len(chain) > 1:
+                        ready.appendleft((date, chain[1:]))  # finish started days first
+                    else:
+                        logger.info(f"Finished {date} ({stage} took {seconds:.0f} s)")
+
+                if broken:
+                    # the other stages of the dead pool come back as broken on the next wait
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = self._new_pool()
+        finally:
+            pool.shutdown(wait=True)
+
+        if failed:
+            logger.warning(
+                f"{len(failed)} days failed: {sorted(failed)}, see {self.ledger.path}"
+            )
+        return failed
@@ -0,0 +1,82 @@
+import io
+import threading
+import numpy as np
+import pandas as pd
+import pvlib
+
+from pathlib import Path
+
+from ooi_hyd_tools.cache import _atomic_write
+
+"""
+Per-site tables of solar elevation at one-minute resolution, one per calendar year. A table is
+computed once with a single vectorized SPA evaluation over the whole year, kept in memory and
+as a small .npz in SOLAR_CACHE_DIR, and plots look up and linearly interpolate their time
+steps instead of running the SPA for every plot.
+"""
+
+SOLAR_CACHE_DIR = "./cache/solar"
+TABLE_STEP_S = 60
+
+_lock = threading.Lock()
+_tables = {}  # (lat, lon, year) -> minute elevations in degrees
+
+
+def _table_path(latitude, longitude, year, cache_dir):
+    return Path(cache_dir) / f"{latitude:.5f}_{longitude:.5f}_{year}.npz"
+
+
+def _compute_table(latitude, longitude, year):
+    # one extra step past the end of the year so interpolation up to Dec 31 23:59:59 works
+    times = pd.date_range(
+        f"{year}-01-01", f"{year + 1}-01-01", freq=f"{TABLE_STEP_S}s", tz="UTC"
+    )
+    solpos = pvlib.solarposition.get_solarposition(
+        times, latitude=latitude, longitude=longitude, method="nrel_numpy"
+    )
+    return solpos["elevation"].to_numpy(dtype=np.float32)
+
+
+def elevation_table(latitude, longitude, year, cache_dir=SOLAR_CACHE_DIR):
+    """minute solar elevations of a site for a year, starting Jan 1 00:00 UTC"""
+    key = (round(latitude, 5), round(longitude, 5), year)
+    with _lock:
+        if key in _tables:
+            return _tables[key]
+
+    path = _table_path(latitude, longitude, year, cache_dir)
+    try:
+        with np.load(path) as npz:
+            table = npz["elevation"]
+    except (FileNotFoundError, KeyError, ValueError, OSError):
+        table = _compute_table(latitude, longitude, year)
+        buf = io.BytesIO()
+        np.savez(buf, elevation=table)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _atomic_write(path, buf.getvalue())
+
+    with _lock:
+        _tables[key] = table
+    return table
+
+
+def solar_elevation(times, lat_lon_for_solpos, cache_dir=SOLAR_CACHE_DIR):
+    """
+    solar elevation in degrees at `times` (naive means UTC), as a Series indexed like
+    pvlib's get_solarposition(...).elevation
+    """
+    latitude, longitude = lat_lon_for_solpos
+    index = pd.DatetimeIndex(np.asarray(times))
+    utc = index.tz_localize("UTC") if index.tz is None else index.tz_convert("UTC")
+    utc = utc.as_unit("ns")  # pandas keeps s/ms/us input, asi8 below counts nanoseconds
+    seconds = utc.asi8 // 1_000_000_000 + (utc.asi8 % 1_000_000_000) / 1e9
+
+    elevation = np.empty(len(utc))
+    years = utc.year.to_numpy()
+    for year in np.unique(years):
+        in_year = years == year
+        origin = pd.Timestamp(f"{year}-01-01", tz="UTC").value // 1_000_000_000
+        table = elevation_table(latitude, longitude, int(year), cache_dir)
+        steps = np.arange(len(table)) * TABLE_STEP_S
+        elevation[in_year] = np.interp(seconds[in_year] - origin, steps, table)
+    return pd.Series(elevation, index=utc, name="elevation")
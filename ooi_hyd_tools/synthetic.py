@@ -0,0 +1,133 @@
+import numpy as np
+import obspy as obs
+import scipy.signal as sig
+
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from ooi_hyd_tools.archive import day_url
+
+"""
+Synthetic broadband hydrophone mseed files for benchmarks and offline runs. Each file holds
+5 minutes of 64 kHz int32 samples, red ambient noise plus a few tones at 24-bit ADC levels,
+split into traces like the archive's. Timing jitter and overlaps between traces, large gaps
+(CASE B) and truncated files (CASE C) can be dialed in. A day is written in the archive's
+directory layout, so it can be read from disk or served over http in place of the archive.
+"""
+
+SAMPLE_RATE = 64000
+FILE_SECONDS = 300
+FILES_PER_DAY = 86400 // FILE_SECONDS
+NETWORK, STATION, CHANNEL = "OO", "HYEA1", "YDH"
+NOISE_COUNTS = 20_000  # rms of the ambient noise in counts
+TONES_HZ = [60, 1250, 9000]  # ship lines and an instrument tone
+AR_COEF = 0.98  # red noise, most energy below a few hundred Hz
+
+
+def synthetic_samples(n, rng, offset=0):
+    """n int32 samples, `offset` keeps the tones continuous across traces and files"""
+    white = rng.standard_normal(n)
+    noise = sig.lfilter([1.0], [1.0, -AR_COEF], white)
+    noise *= NOISE_COUNTS / noise.std()
+    t = (np.arange(n) + offset) / SAMPLE_RATE
+    for k, freq in enumerate(TONES_HZ):
+        noise += NOISE_COUNTS / (2 + k) * np.sin(2 * np.pi * freq * t)
+    return np.clip(noise, -(2**23), 2**23 - 1).astype(np.int32)
+
+
+def synthetic_stream(
+    start,
+    rng=None,
+    seconds=FILE_SECONDS,
+    n_traces=8,
+    jitter_s=0.0,
+    overlap_s=0.0,
+    gap_s=0.0,
+):
+    """
+    one file worth of traces starting at `start` (UTCDateTime or ISO string). Traces after
+    the first are shifted by up to `jitter_s`, every other boundary repeats `overlap_s` of
+    samples, and `gap_s` drops that much data after the first trace.
+    """
+    rng = rng or np.random.default_rng()
+    start = obs.UTCDateTime(start)
+    npts = int(seconds * SAMPLE_RATE)
+    data = synthetic_samples(npts, rng, offset=int(start.timestamp % 86400 * SAMPLE_RATE))
+    bounds = np.linspace(0, npts, n_traces + 1).astype(int)
+    overlap = int(overlap_s * SAMPLE_RATE)
+    gap = int(gap_s * SAMPLE_RATE)
+
+    st = obs.Stream()
+    for k, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if k > 0 and overlap and k % 2 == 0:
+            lo = max(0, lo - overlap)
+        if k == 1 and gap:
+            lo = min(hi, lo + gap)
+        shift = rng.uniform(-jitter_s, jitter_s) if k > 0 else 0.0
+        header = {
+            "network": NETWORK,
+            "station": STATION,
+            "channel": CHANNEL,
+            "sampling_rate": float(SAMPLE_RATE),
+            "starttime": start + lo / SAMPLE_RATE + shift,
+        }
+        st += obs.Trace(data[lo:hi].copy(), header=header)
+    return st
+
+
+def mseed_name(start):
+    start = obs.UTCDateTime(start)
+    return f"{NETWORK}-{STATION}--{CHANNEL}-{start.strftime('%Y-%m-%dT%H:%M:%S.%f')}.mseed"
+
+
+def write_synthetic_day(
+    root,
+    hyd_refdes,
+    day_str,
+    n_files=FILES_PER_DAY,
+    jitter_s=1e-4,
+    overlap_s=0.0,
+    gap_every=0,
+    gap_s=5.0,
+    short_every=0,
+    short_s=120.0,
+    n_traces=8,
+    seed=0,
+    addendum=0,
+):
+    """
+    write `n_files` consecutive 5 minute files of a day (YYYY/MM/DD) under `root` in the
+    archive layout. Every `gap_every`th file has a large gap and every `short_every`th file
+    ends `short_s` early, 0 turns either off. The last `addendum` files go to the addendum/
+    subdirectory like late uploads. Existing files are kept, so a day is generated once and
+    reused. Returns the file paths in time order.
+    """
+    day_dir = Path(day_url(hyd_refdes, day_str, base_url=str(root)))
+    day_dir.mkdir(parents=True, exist_ok=True)
+    day = datetime.strptime(day_str, "%Y/%m/%d")
+
+    paths = []
+    for n in range(n_files):
+        start = obs.UTCDateTime(day + timedelta(seconds=n * FILE_SECONDS))
+        path = day_dir / mseed_name(start)
+        if n >= n_files - addendum:
+            path = day_dir / "addendum" / path.name
+            path.parent.mkdir(exist_ok=True)
+        paths.append(path)
+        if path.exists():
+            continue
+        has_gap = gap_every > 0 and n % gap_every == gap_every - 1
+        is_short = short_every > 0 and n % short_every == short_every - 1
+        st = synthetic_stream(
+            start,
+            rng=np.random.default_rng([seed, n]),
+            seconds=FILE_SECONDS - (short_s if is_short else 0.0),
+            n_traces=n_traces,
+            jitter_s=jitter_s,
+            overlap_s=overlap_s,
+            gap_s=gap_s if has_gap else 0.0,
+        )
+        tmp_path = path.with_name(path.name + ".part")
+        st.write(str(tmp_path), format="MSEED", reclen=4096, encoding="STEIM2")
+        tmp_path.replace(path)
+    return paths
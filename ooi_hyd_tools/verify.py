@@ -0,0 +1,111 @@
+import io
+import json
+import hashlib
+import numpy as np
+import soundfile as sf
+
+from pathlib import Path
+
+"""
+In-memory verification of the audio written by mseed_to_audio. The PCM buffer handed to the
+encoder is hashed as libsndfile writes it, and compared with the MD5 the FLAC encoder stores in
+STREAMINFO and with the MD5 of the WAV sample bytes. No audio is decoded and no samples are
+read back from disk: the FLAC is checked from its header, and the WAV is encoded into memory
+and its data chunk hashed before the same bytes are written out (see write_hashed_wav).
+"""
+
+# libsndfile scales int32 input down to the target width by dropping low bits
+INT32_SHIFT = {"PCM_16": 16, "PCM_24": 8, "PCM_32": 0}
+
+
+def pcm_bytes(data, subtype):
+    """samples as signed little-endian bytes at the written width, or None if unsupported"""
+    if data.dtype == np.int32 and subtype in INT32_SHIFT:
+        shifted = (data >> INT32_SHIFT[subtype]).astype("<i4")
+        if subtype == "PCM_24":
+            return shifted.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+        if subtype == "PCM_16":
+            return shifted.astype("<i2").tobytes()
+        return shifted.tobytes()
+    if np.issubdtype(data.dtype, np.floating) and subtype in ["FLOAT", "DOUBLE"]:
+        return data.astype("<f4" if subtype == "FLOAT" else "<f8").tobytes()
+    return None
+
+
+def flac_streaminfo(path):
+    """(total samples, bits per sample, md5 hex) from the STREAMINFO block of a FLAC file"""
+    with open(path, "rb") as f:
+        header = f.read(42)
+    if header[:4] != b"fLaC" or header[4] & 0x7F != 0:
+        raise ValueError(f"{path} does not start with a FLAC STREAMINFO block")
+    packed = int.from_bytes(header[18:26], "big")
+    total_samples = packed & ((1 << 36) - 1)
+    bits_per_sample = ((packed >> 36) & 0x1F) + 1
+    return total_samples, bits_per_sample, header[26:42].hex()
+
+
+def wav_data_chunk(buf):
+    """(offset, size) of the sample bytes in a RIFF/WAV buffer"""
+    if buf[:4] != b"RIFF" or buf[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE buffer")
+    offset = 12
+    while offset + 8 <= len(buf):
+        size = int.from_bytes(buf[offset + 4 : offset + 8], "little")
+        if buf[offset : offset + 4] == b"data":
+            return offset + 8, size
+        offset += 8 + size + (size & 1)  # chunks are padded to an even length
+    raise ValueError("WAV buffer has no data chunk")
+
+
+def write_hashed_wav(path, data, sr, subtype):
+    """
+    encode a WAV in memory and write it to `path`, returns the md5 hex of its sample bytes.
+    Costs one encoded copy of the segment in memory, in exchange for not rereading the file.
+    """
+    buf = io.BytesIO()
+    sf.write(buf, data, sr, subtype=subtype, format="WAV")
+    view = buf.getbuffer()
+    offset, size = wav_data_chunk(view)
+    md5 = hashlib.md5(view[offset : offset + size]).hexdigest()
+    with open(path, "wb") as f:
+        f.write(view)
+    view.release()
+    return md5
+
+
+def verify_segment(data, subtype, flac_path, wav_path=None, wav_md5=None):
+    """
+    check one written segment against the buffer it was encoded from, `wav_md5` is the hash
+    write_hashed_wav returned for the WAV at `wav_path`
+    """
+    result = {"file": Path(flac_path).name, "npts": int(data.size)}
+    raw = pcm_bytes(data, subtype)
+    result["pcm_md5"] = hashlib.md5(raw).hexdigest() if raw is not None else None
+
+    checks = []
+    total_samples, _, flac_md5 = flac_streaminfo(flac_path)
+    checks.append(total_samples == data.size)
+    if result["pcm_md5"] is not None and flac_md5 != "0" * 32:  # all zero means not computed
+        checks.append(flac_md5 == result["pcm_md5"])
+    result["flac_md5"] = flac_md5
+
+    if wav_path is not None:
+        info = sf.info(str(wav_path))
+        checks.append(info.frames == data.size)
+        if raw is not None:
+            result["wav_md5"] = wav_md5
+            checks.append(wav_md5 == result["pcm_md5"])
+
+    result["ok"] = all(checks)
+    return result
+
+
+def summarize_verification(results):
+    failed = [r["file"] for r in results if not r["ok"]]
+    return {"segments": len(results), "verified": len(results) - len(failed), "failed": failed}
+
+
+def write_verification_report(results, path):
+    report = {"summary": summarize_verification(results), "segments": results}
+    Path(path).write_text(json.dumps(report, indent=2))
+    return report["summary"]